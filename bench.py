@@ -0,0 +1,634 @@
+'''
+Offline benchmarks of the bulk operations against an in-process fake of the
+Discord HTTP API and gateway. Run it from the bot root as a module, e.g.
+
+    python -m extensions.<this module>.bench --messages 20000 --speedup 20
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import aiofiles
+import aiofiles.os
+import argparse
+import asyncio
+import bisect
+import datetime
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import asdict, dataclass
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Optional
+
+from . import scheduler
+from .channeledit import EditTarget, apply_channel_edits, collect_thread_targets
+from .channelexport import ExportStats, export_channel
+from .deletion import scan_and_delete, snowflake_time
+from .export import FORMAT_CSV, MEMBER_FIELDS, file_suffix, write_rows
+from .guildsettings import GuildSettings
+from .history import HISTORY_SHARDS, MessageMeta
+from .journal import JobJournal
+from .memberindex import GuildJoinIndex
+from .metrics import RateLimitLogCounter, metrics
+from .permissions import PermissionIndex
+from .reactions import ReactionCleaner
+from .roles import RoleEditStats, apply_role_edits
+from .scheduler import TokenBucket, request_scheduler
+from .sweep import SweepStats, sweep_guild
+from .threads import thread_directory
+
+GUILD_ID: int = 1000
+BOT_ID: int = 2000
+TARGET_USER_ID: int = 3000
+OWNER_ID: int = 4000
+EMOJIS: tuple[str, ...] = ("👍", "🎉", "❤️")
+
+# (requests, per seconds) enforced by the fake per route and major parameter, like Discord does
+FAKE_ROUTE_LIMITS: dict[str, tuple[int, float]] = {
+    "delete_message": (5, 1.0),
+    "bulk_delete": (1, 1.0),
+    "get_messages": (5, 1.0),
+    "get_reactions": (5, 1.0),
+    "remove_reaction": (5, 1.0),
+    "modify_channel": (5, 5.0),
+    "list_threads": (10, 1.0),
+    "modify_member": (10, 10.0),
+    "member_role": (10, 10.0),
+}
+FAKE_GLOBAL_LIMIT: tuple[int, float] = (50, 1.0)
+
+def make_snowflake(timestamp: float, increment: int) -> int:
+    return ((int(timestamp * 1000) - interactions.DISCORD_EPOCH) << 22) | (increment & 0x3FFFFF)
+
+def _iso(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+def _user_payload(user_id: int, bot: bool = False) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "bot": bot}
+
+def _http_error(status: int, code: int, message: str) -> None:
+    '''
+    Raise the error of the HTTP client for a failed request
+    '''
+    error: type = {400: interactions.errors.BadRequest, 403: interactions.errors.Forbidden, 404: interactions.errors.NotFound}.get(
+        status, interactions.errors.HTTPException
+    )
+    raise error(SimpleNamespace(status=status, reason=message), response_data={"code": code, "message": message})
+
+class FakeDiscord:
+    '''
+    The state of one fake guild and the HTTP methods of `interactions.HTTPClient` used by this extension, with
+    their signatures and the validation of the API that the extension depends on
+    Each request waits for the configured latency. A request over the rate limits is counted and logged
+    as a 429, then retried after the limit resets, like the real HTTP client does.
+    '''
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        route_limits: Optional[dict[str, tuple[int, float]]] = None,
+        global_limit: tuple[int, float] = FAKE_GLOBAL_LIMIT,
+        seed: int = 0
+    ) -> None:
+        self.latency: float = latency
+        self.route_limits: dict[str, tuple[int, float]] = route_limits if route_limits is not None else dict(FAKE_ROUTE_LIMITS)
+        self.global_bucket: TokenBucket = TokenBucket(*global_limit)
+        self.buckets: dict[tuple[str, int], TokenBucket] = {}
+        self.random: random.Random = random.Random(seed)
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.FakeDiscord")
+        self.logger.propagate = False
+        self.calls: Counter = Counter()
+        self.ratelimit_hits: int = 0
+        # channel_id -> message payloads sorted by ID, and their IDs
+        self.messages: dict[int, list[dict]] = {}
+        self.message_ids: dict[int, list[int]] = {}
+        # (message_id, emoji) -> sorted reactor IDs
+        self.reactors: dict[tuple[int, str], list[int]] = {}
+        self.threads: dict[int, dict] = {}
+
+    async def _request(self, route: str, major: int) -> None:
+        self.calls[route] += 1
+        while True:
+            now: float = time.monotonic()
+            bucket: Optional[TokenBucket] = self.buckets.get((route, int(major)))
+            if bucket is None:
+                bucket = self.buckets[(route, int(major))] = TokenBucket(*self.route_limits.get(route, FAKE_GLOBAL_LIMIT))
+            retry_after: float = max(bucket.delay(now), self.global_bucket.delay(now))
+            if retry_after <= 0:
+                bucket.take()
+                self.global_bucket.take()
+                break
+            self.ratelimit_hits += 1
+            self.logger.warning(f"{route}::{major} The resource is being rate limited! Reset in {retry_after:.3f} seconds")
+            await asyncio.sleep(retry_after)
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+
+    def add_channel(self, client: interactions.Client, channel_id: int, *, channel_type: int = 0) -> interactions.GuildChannel:
+        self.messages.setdefault(channel_id, [])
+        self.message_ids.setdefault(channel_id, [])
+        return client.cache.place_channel_data({
+            "id": str(channel_id), "type": channel_type, "guild_id": str(GUILD_ID),
+            "name": f"channel-{channel_id}", "position": 0, "permission_overwrites": []
+        })
+
+    def add_message(self, channel_id: int, message_id: int, author_id: int, reactions: dict[str, list[int]]) -> None:
+        payload: dict = {
+            "id": str(message_id), "channel_id": str(channel_id), "author": _user_payload(author_id),
+            "content": "", "timestamp": _iso(snowflake_time(message_id)),
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+            "attachments": [], "embeds": [], "pinned": False, "type": 0,
+            "reactions": [
+                {"count": len(users), "me": BOT_ID in users, "emoji": {"id": None, "name": emoji}}
+                for emoji, users in reactions.items()
+            ]
+        }
+        for emoji, users in reactions.items():
+            self.reactors[(message_id, emoji)] = sorted(users)
+        pos: int = bisect.bisect_left(self.message_ids[channel_id], message_id)
+        self.message_ids[channel_id].insert(pos, message_id)
+        self.messages[channel_id].insert(pos, payload)
+
+    def add_thread(self, parent_id: int, thread_id: int, *, archived: bool, archive_timestamp: float, private: bool = False) -> None:
+        self.threads[thread_id] = {
+            "id": str(thread_id), "type": 12 if private else 11, "guild_id": str(GUILD_ID), "parent_id": str(parent_id), "name": f"thread-{thread_id}",
+            "rate_limit_per_user": 0,
+            "thread_metadata": {"archived": archived, "locked": False, "archive_timestamp": _iso(archive_timestamp), "auto_archive_duration": 1440}
+        }
+
+    def message_count(self) -> int:
+        return sum(len(_) for _ in self.messages.values())
+
+    async def get_channel_messages(
+        self, channel_id, limit: int = 50, *, around: Optional["interactions.Snowflake_Type"] = None, before: Optional["interactions.Snowflake_Type"] = None, after: Optional["interactions.Snowflake_Type"] = None
+    ) -> list[dict]:
+        if sum(bool(_) for _ in (before, after, around)) > 1:
+            raise ValueError("`before` `after` and `around` are mutually exclusive, only one may be passed at a time.")
+        if not 1 <= limit <= 100:
+            _http_error(400, 50035, "Invalid Form Body")
+        await self._request("get_messages", channel_id)
+        msgs: list[dict] = self.messages.get(int(channel_id), [])
+        ids: list[int] = self.message_ids.get(int(channel_id), [])
+        # The HTTP client passes MISSING for the absent parameters
+        # Fresh copies like a real response, as the client rewrites the payloads it builds messages from
+        if after:
+            start: int = bisect.bisect_right(ids, int(after))
+            return [dict(_) for _ in msgs[start:start + limit]]
+        end: int = bisect.bisect_left(ids, int(before)) if before else len(msgs)
+        return [dict(_) for _ in reversed(msgs[max(end - limit, 0):end])]
+
+    def _pop_message(self, channel_id: int, message_id: int) -> bool:
+        msgs: list[dict] = self.messages.get(int(channel_id), [])
+        ids: list[int] = self.message_ids.get(int(channel_id), [])
+        pos: int = bisect.bisect_left(ids, int(message_id))
+        if pos < len(ids) and ids[pos] == int(message_id):
+            del msgs[pos]
+            del ids[pos]
+            return True
+        return False
+
+    async def delete_message(self, channel_id, message_id, reason: Optional[str] = None) -> None:
+        await self._request("delete_message", channel_id)
+        if not self._pop_message(channel_id, message_id):
+            _http_error(404, 10008, "Unknown Message")
+
+    async def bulk_delete_messages(self, channel_id, message_ids: list, reason: Optional[str] = None) -> None:
+        await self._request("bulk_delete", channel_id)
+        if not 2 <= len(message_ids) <= 100:
+            _http_error(400, 50016, "You must provide at least 2 and fewer than 100 messages to delete.")
+        # The whole request is rejected, like the real API
+        now: float = time.time()
+        if any(now - snowflake_time(int(_)) >= 14 * 86400 for _ in message_ids):
+            _http_error(400, 50034, "You can only bulk delete messages that are under 14 days old.")
+        for _ in message_ids:
+            self._pop_message(channel_id, _)
+
+    async def get_reactions(self, channel_id, message_id, emoji: str, limit: "interactions.Absent[int]" = interactions.MISSING, after: "interactions.Snowflake_Type" = interactions.MISSING) -> list[dict]:
+        await self._request("get_reactions", channel_id)
+        users: list[int] = self.reactors.get((int(message_id), emoji), [])
+        start: int = bisect.bisect_right(users, int(after)) if after else 0
+        return [_user_payload(_) for _ in users[start:start + (limit or 25)]]
+
+    async def remove_user_reaction(self, channel_id, message_id, emoji: str, user_id) -> None:
+        await self._request("remove_reaction", channel_id)
+        users: list[int] = self.reactors.get((int(message_id), emoji), [])
+        pos: int = bisect.bisect_left(users, int(user_id))
+        if pos < len(users) and users[pos] == int(user_id):
+            del users[pos]
+
+    async def list_active_threads(self, guild_id) -> dict:
+        await self._request("list_threads", guild_id)
+        return {"threads": [_ for _ in self.threads.values() if not _["thread_metadata"]["archived"]], "members": []}
+
+    async def _list_archived_threads(self, channel_id, limit: Optional[int], before, private: bool) -> dict:
+        await self._request("list_threads", channel_id)
+        # The HTTP client sends the time of the `before` snowflake, and the threads archived before it are listed
+        until: Optional[float] = interactions.Timestamp.from_snowflake(before).timestamp() if before else None
+        threads: list[dict] = sorted(
+            (
+                _ for _ in self.threads.values()
+                if _["thread_metadata"]["archived"] and int(_["parent_id"]) == int(channel_id) and (_["type"] == 12) == private
+                and (until is None or interactions.Timestamp.fromisoformat(_["thread_metadata"]["archive_timestamp"]).timestamp() < until)
+            ),
+            key=lambda _: _["thread_metadata"]["archive_timestamp"],
+            reverse=True
+        )
+        limit = limit or 50
+        return {"threads": threads[:limit], "members": [], "has_more": len(threads) > limit}
+
+    async def list_public_archived_threads(self, channel_id, limit: Optional[int] = None, before: Optional["interactions.Snowflake_Type"] = None) -> dict:
+        return await self._list_archived_threads(channel_id, limit, before, False)
+
+    async def list_private_archived_threads(self, channel_id, limit: Optional[int] = None, before: Optional["interactions.Snowflake_Type"] = None) -> dict:
+        return await self._list_archived_threads(channel_id, limit, before, True)
+
+    async def modify_channel(self, channel_id, data: dict, reason: Optional[str] = None) -> dict:
+        await self._request("modify_channel", channel_id)
+        thread: Optional[dict] = self.threads.get(int(channel_id))
+        if thread is None:
+            return {"id": str(channel_id), **data}
+        if thread["thread_metadata"]["archived"] and data.get("archived", True):
+            raise RuntimeError(f"Thread {channel_id} is archived")
+        thread.update({k: v for k, v in data.items() if k not in ("archived", "locked")})
+        thread["thread_metadata"].update({k: v for k, v in data.items() if k in ("archived", "locked")})
+        return thread
+
+    async def modify_guild_member(
+        self, guild_id, user_id, nickname=interactions.MISSING, roles: Optional[list] = None, mute: Optional[bool] = None, deaf: Optional[bool] = None,
+        channel_id=interactions.MISSING, communication_disabled_until=interactions.MISSING, flags=interactions.MISSING, reason: Optional[str] = None
+    ) -> dict:
+        await self._request("modify_member", guild_id)
+        return {
+            "user": _user_payload(int(user_id)), "roles": [str(_) for _ in roles or []],
+            "joined_at": _iso(time.time()), "deaf": False, "mute": False
+        }
+
+    async def add_guild_member_role(self, guild_id, user_id, role_id, reason: Optional[str] = None) -> None:
+        await self._request("member_role", guild_id)
+
+    async def remove_guild_member_role(self, guild_id, user_id, role_id, reason: Optional[str] = None) -> None:
+        await self._request("member_role", guild_id)
+
+@dataclass
+class BenchResult:
+    scenario: str
+    items: int
+    seconds: float
+    rate: float
+    api_calls: int
+    ratelimit_hits: int
+    peak_bytes: int
+
+def _fake_client(fake: FakeDiscord) -> interactions.Client:
+    client: interactions.Client = interactions.Client()
+    client.http = fake
+    client._user = interactions.ClientUser.from_dict({**_user_payload(BOT_ID, bot=True), "verified": True, "mfa_enabled": False}, client)
+    return client
+
+def _fake_guild(client: interactions.Client, role_ids: list[int]) -> interactions.Guild:
+    # The roles are below the top role of the bot, except the last one
+    def __role(role_id: int, position: int) -> dict:
+        return {
+            "id": str(role_id), "name": f"role-{role_id}", "position": position, "permissions": "0",
+            "color": 0, "hoist": False, "managed": False, "mentionable": False
+        }
+    guild: interactions.Guild = client.cache.place_guild_data({
+        "id": str(GUILD_ID), "name": "bench", "owner_id": str(BOT_ID), "emojis": [], "features": [], "preferred_locale": "en-US",
+        "afk_timeout": 0, "verification_level": 0, "default_message_notifications": 0, "explicit_content_filter": 0,
+        "mfa_level": 0, "system_channel_flags": 0, "premium_tier": 0, "nsfw_level": 0, "premium_progress_bar_enabled": False,
+        "roles": [__role(GUILD_ID, 0), *(__role(_, i + 1) for i, _ in enumerate(role_ids))]
+    })
+    client.cache.place_member_data(GUILD_ID, {
+        "user": _user_payload(BOT_ID, bot=True), "roles": [str(role_ids[-2])], "joined_at": _iso(0), "deaf": False, "mute": False
+    })
+    return guild
+
+def _channel_snowflake(args: argparse.Namespace, increment: int) -> int:
+    # The channels are created a day before their oldest message, so the history scans can split their lifetime
+    return make_snowflake(time.time() - (args.max_age_days + 1) * 86400, increment)
+
+def _populate_messages(fake: FakeDiscord, channel_ids: list[int], args: argparse.Namespace) -> None:
+    rng: random.Random = random.Random(args.seed)
+    now: float = time.time()
+    for i in range(args.messages):
+        channel_id: int = channel_ids[i % len(channel_ids)]
+        author: int = TARGET_USER_ID if rng.random() < args.user_share else 10000 + rng.randrange(args.members)
+        reactions: dict[str, list[int]] = {}
+        if rng.random() < args.reaction_density:
+            for emoji in EMOJIS[:rng.randint(1, len(EMOJIS))]:
+                users: set[int] = {10000 + rng.randrange(args.members) for _ in range(rng.randint(1, args.reactors))}
+                if rng.random() < 0.5:
+                    users.add(TARGET_USER_ID)
+                reactions[emoji] = list(users)
+        fake.add_message(channel_id, make_snowflake(now - rng.uniform(0, args.max_age_days * 86400), i), author, reactions)
+
+async def bench_delete_messages(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    The scan of `delete_user_messages` in one channel
+    '''
+    client: interactions.Client = _fake_client(fake)
+    channel: interactions.GuildChannel = fake.add_channel(client, _channel_snowflake(args, 0))
+    _populate_messages(fake, [int(channel.id)], args)
+    scanned: int = 0
+    def __is_delete(message: MessageMeta) -> bool:
+        nonlocal scanned
+        scanned += 1
+        return message.author_id == TARGET_USER_ID
+    await scan_and_delete(client, channel, __is_delete, kind="bench", shards=args.shards)
+    return scanned
+
+async def bench_channel_export(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    `channel export` of one channel to a gzip file, with a journal in a temporary directory
+    '''
+    client: interactions.Client = _fake_client(fake)
+    channel: interactions.GuildChannel = fake.add_channel(client, _channel_snowflake(args, 0))
+    _populate_messages(fake, [int(channel.id)], args)
+    with tempfile.TemporaryDirectory() as directory:
+        journal: JobJournal = JobJournal(os.path.join(directory, "jobs.db"))
+        await journal.start("bench", "export", GUILD_ID)
+        stats: ExportStats = await export_channel(
+            client, channel, journal, "bench", os.path.join(directory, "export.jsonl.gz"), shards=args.shards
+        )
+        journal.close()
+    return stats.messages
+
+async def bench_guild_sweep(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    The sweep of `delete_all_ur_msg`: the channels are swept concurrently, the user's messages
+    are deleted one by one, and the reactions are removed in a deferred pass
+    '''
+    client: interactions.Client = _fake_client(fake)
+    channels: list[interactions.GuildChannel] = [fake.add_channel(client, _channel_snowflake(args, _)) for _ in range(args.channels)]
+    _populate_messages(fake, [int(_.id) for _ in channels], args)
+    with tempfile.TemporaryDirectory() as directory:
+        journal: JobJournal = JobJournal(os.path.join(directory, "jobs.db"))
+        await journal.start("bench", "delete_all_ur_msg", GUILD_ID)
+        cleaner: ReactionCleaner = ReactionCleaner(client, TARGET_USER_ID, deferred=True, journal=journal, job_key="bench")
+        stats: SweepStats = await sweep_guild(
+            client, GUILD_ID, channels, TARGET_USER_ID, journal, "bench",
+            reaction_cleaner=cleaner, concurrency=args.concurrency, shards=args.shards
+        )
+        if stats.incomplete:
+            print(f"guild_sweep: {stats.incomplete} channels incomplete", file=sys.stderr)
+        await cleaner.run_deferred()
+        journal.close()
+    return stats.scanned
+
+async def bench_members_older_than(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    Building the join-date index, querying it, exporting the result and applying gateway member events
+    '''
+    client: interactions.Client = _fake_client(fake)
+    rng: random.Random = random.Random(args.seed)
+    now: float = time.time()
+    roles: list[int] = [5000 + _ for _ in range(10)]
+    def __member(member_id: int) -> interactions.Member:
+        return client.cache.place_member_data(GUILD_ID, {
+            "user": _user_payload(member_id, bot=rng.random() < 0.02),
+            "roles": [str(_) for _ in rng.sample(roles, rng.randint(0, 3))],
+            "joined_at": _iso(now - rng.uniform(0, 3 * 365 * 86400)), "deaf": False, "mute": False
+        })
+    members: list[interactions.Member] = [__member(10000 + _) for _ in range(args.members)]
+    idx: GuildJoinIndex = GuildJoinIndex.from_members(members)
+    valid_members: list[tuple[float, int]] = idx.older_than(now - 30 * 86400, role_id=roles[0])
+    def __member_rows():
+        for joined, member_id in valid_members:
+            yield {"id": str(member_id), "username": f"user{member_id}", "joined_at": _iso(joined), "days_in_guild": int((now - joined) // 86400)}
+    async with aiofiles.tempfile.NamedTemporaryFile(suffix=file_suffix(FORMAT_CSV, True), delete=False) as afp:
+        await write_rows(afp, __member_rows(), MEMBER_FIELDS, FORMAT_CSV, compress=True)
+        filename: str = afp.name
+    await aiofiles.os.remove(filename)
+    # Gateway churn: members leaving, joining and changing roles
+    events: int = max(args.members // 10, 1)
+    for i in range(events):
+        member: interactions.Member = members[rng.randrange(len(members))]
+        match i % 3:
+            case 0:
+                idx.remove(member.id)
+            case 1:
+                idx.add(__member(10000 + args.members + i))
+            case _:
+                idx.update_roles(member)
+    return args.members + len(valid_members) + events
+
+async def bench_bulk_roles(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    `bulk_roles` removing a role from the members who joined more than 30 days ago, one member edit each
+    '''
+    client: interactions.Client = _fake_client(fake)
+    rng: random.Random = random.Random(args.seed)
+    now: float = time.time()
+    roles: list[int] = [5000 + _ for _ in range(10)]
+    guild: interactions.Guild = _fake_guild(client, roles)
+    for i in range(args.role_members):
+        client.cache.place_member_data(GUILD_ID, {
+            "user": _user_payload(10000 + i),
+            "roles": [str(_) for _ in rng.sample(roles[:-2], rng.randint(0, 3))],
+            "joined_at": _iso(now - rng.uniform(0, 3 * 365 * 86400)), "deaf": False, "mute": False
+        })
+    idx: GuildJoinIndex = GuildJoinIndex.from_members(guild.members)
+    members: list[interactions.Member] = [guild.get_member(member_id) for _, member_id in idx.older_than(now - 30 * 86400)]
+    stats: RoleEditStats = await apply_role_edits(client, guild, members, remove=[roles[0]])
+    if stats.failed:
+        print(f"bulk_roles: {stats.failed} edits failed", file=sys.stderr)
+    return stats.handled
+
+async def bench_rate_limit(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    `rate_limit` on a channel with active and archived threads
+    '''
+    client: interactions.Client = _fake_client(fake)
+    channel: interactions.GuildChannel = fake.add_channel(client, 1)
+    now: float = time.time()
+    for i in range(args.threads):
+        fake.add_thread(1, make_snowflake(now, i), archived=i % 2 == 1, archive_timestamp=now - i, private=i % 4 == 3)
+    targets: list[EditTarget] = [EditTarget(int(channel.id))] + await collect_thread_targets(client, channel)
+    edited, failed = await apply_channel_edits(client, targets, {"rate_limit_per_user": 10})
+    if failed:
+        print(f"rate_limit: {failed} edits failed", file=sys.stderr)
+    return edited + failed
+
+async def bench_thread_discovery(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    Listing the threads of a channel with more archived public and private threads than one page
+    '''
+    client: interactions.Client = _fake_client(fake)
+    channel: interactions.GuildChannel = fake.add_channel(client, 1)
+    now: float = time.time()
+    for i in range(args.archived_threads):
+        # Some threads are archived in the same millisecond
+        fake.add_thread(1, make_snowflake(now, i), archived=True, archive_timestamp=now - (i // 3) * 0.0007, private=i % 2 == 1)
+    threads: list[interactions.ThreadChannel] = await thread_directory.threads(client, channel)
+    if len(threads) != args.archived_threads:
+        print(f"thread_discovery: {len(threads)} of {args.archived_threads} threads listed", file=sys.stderr)
+    return len(threads)
+
+async def bench_permission_checks(args: argparse.Namespace, fake: FakeDiscord) -> int:
+    '''
+    The permission checks run before every command, with member updates invalidating the cache
+    '''
+    rng: random.Random = random.Random(args.seed)
+    index: PermissionIndex = PermissionIndex()
+    roles: list[int] = [5000 + _ for _ in range(20)]
+    index.set_guild(GuildSettings(
+        GUILD_ID,
+        operator_users=[10000 + _ for _ in range(0, args.members, 97)],
+        operator_roles=roles[:2],
+        elevation_members=[10000 + _ for _ in range(0, args.members, 89)],
+        elevation_roles=roles[2:4]
+    ))
+    bot: SimpleNamespace = SimpleNamespace(owner_ids={OWNER_ID})
+    contexts: list[SimpleNamespace] = [
+        SimpleNamespace(
+            guild_id=GUILD_ID, bot=bot,
+            author=SimpleNamespace(id=10000 + rng.randrange(args.members), _role_ids=rng.sample(roles, rng.randint(0, 5)))
+        )
+        for _ in range(args.checks)
+    ]
+    for i, ctx in enumerate(contexts):
+        index.is_privileged(ctx)
+        index.is_operator(ctx)
+        if i % 100 == 0:
+            index.invalidate_member(GUILD_ID, ctx.author.id)
+    return len(contexts) * 2
+
+SCENARIOS: dict[str, Callable[[argparse.Namespace, FakeDiscord], Awaitable[int]]] = {
+    "delete_messages": bench_delete_messages,
+    "guild_sweep": bench_guild_sweep,
+    "channel_export": bench_channel_export,
+    "members_older_than": bench_members_older_than,
+    "rate_limit": bench_rate_limit,
+    "thread_discovery": bench_thread_discovery,
+    "bulk_roles": bench_bulk_roles,
+    "permission_checks": bench_permission_checks,
+}
+
+def _scale(rate: tuple[int, float], speedup: float) -> tuple[int, float]:
+    return rate[0], rate[1] / speedup
+
+def _speed_up_scheduler(speedup: float) -> None:
+    '''
+    Speed up the pacing of the shared scheduler as much as the fake rate limits
+    '''
+    for route, rate in list(scheduler.ROUTE_RATES.items()):
+        scheduler.ROUTE_RATES[route] = _scale(rate, speedup)
+    scheduler.DEFAULT_ROUTE_RATE = _scale(scheduler.DEFAULT_ROUTE_RATE, speedup)
+    scheduler.GLOBAL_RATE = _scale(scheduler.GLOBAL_RATE, speedup)
+
+async def run_scenario(name: str, args: argparse.Namespace, route_limits: dict[str, tuple[int, float]]) -> BenchResult:
+    fake: FakeDiscord = FakeDiscord(
+        latency=args.latency,
+        route_limits={k: _scale(v, args.speedup) for k, v in route_limits.items()},
+        global_limit=_scale(FAKE_GLOBAL_LIMIT, args.speedup),
+        seed=args.seed
+    )
+    request_scheduler.global_bucket = TokenBucket(*scheduler.GLOBAL_RATE)
+    request_scheduler.route_buckets.clear()
+    # The channels of the scenarios share their IDs
+    thread_directory.clear()
+    # Free the objects of the previous scenario so that they are not part of the baseline
+    gc.collect()
+    tracemalloc.reset_peak()
+    base: int = tracemalloc.get_traced_memory()[0]
+    start: float = time.perf_counter()
+    items: int = await SCENARIOS[name](args, fake)
+    seconds: float = time.perf_counter() - start
+    peak: int = tracemalloc.get_traced_memory()[1] - base
+    return BenchResult(name, items, seconds, items / max(seconds, 1e-9), sum(fake.calls.values()), fake.ratelimit_hits, peak)
+
+def _parse_limit(text: str) -> tuple[str, tuple[int, float]]:
+    route, _, rate = text.partition("=")
+    count, _, per = rate.partition("/")
+    return route, (int(count), float(per or 1))
+
+def compare(results: list[BenchResult], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    '''
+    The scenarios slower or using more memory than the baseline beyond the tolerance
+    '''
+    regressions: list[str] = []
+    for res in results:
+        base: Optional[dict] = baseline.get(res.scenario)
+        if base is None:
+            continue
+        if res.rate < base["rate"] * (1 - tolerance):
+            regressions.append(f"{res.scenario}: {res.rate:.1f}/s, baseline {base['rate']:.1f}/s")
+        if res.peak_bytes > base["peak_bytes"] * (1 + tolerance):
+            regressions.append(f"{res.scenario}: peak {res.peak_bytes / 2**20:.1f} MiB, baseline {base['peak_bytes'] / 2**20:.1f} MiB")
+    return regressions
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument("--messages", type=int, default=5000, help="messages in the channels")
+    parser.add_argument("--channels", type=int, default=8, help="channels of the guild sweep")
+    parser.add_argument("--concurrency", type=int, default=8, help="channels swept at the same time, like `sweep.GUILD_SWEEP_CONCURRENCY`")
+    parser.add_argument("--shards", type=int, default=HISTORY_SHARDS, help="time ranges of a channel history read at the same time")
+    parser.add_argument("--user-share", type=float, default=0.2, help="share of the messages sent by the user to clean up")
+    parser.add_argument("--reaction-density", type=float, default=0.1, help="share of the messages with reactions")
+    parser.add_argument("--reactors", type=int, default=20, help="maximum users per reaction")
+    parser.add_argument("--max-age-days", type=float, default=30, help="age of the oldest message")
+    parser.add_argument("--members", type=int, default=20000, help="members of the guild")
+    parser.add_argument("--role-members", type=int, default=2000, help="members of the bulk role edit")
+    parser.add_argument("--threads", type=int, default=100, help="threads of the rate limited channel")
+    parser.add_argument("--archived-threads", type=int, default=500, help="archived threads of the thread discovery")
+    parser.add_argument("--checks", type=int, default=100000, help="permission checks")
+    parser.add_argument("--latency", type=float, default=0.02, help="mean latency of a request in seconds")
+    parser.add_argument("--limit", type=_parse_limit, action="append", default=[], metavar="ROUTE=N/SECONDS", help="override a rate limit of the fake")
+    parser.add_argument("--speedup", type=float, default=10, help="divide the rate limit windows of the fake and the scheduler")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown or memory growth against the baseline")
+    args: argparse.Namespace = parser.parse_args(argv)
+    for _ in args.scenarios:
+        if _ not in SCENARIOS:
+            parser.error(f"unknown scenario {_}")
+
+    route_limits: dict[str, tuple[int, float]] = {**FAKE_ROUTE_LIMITS, **dict(args.limit)}
+    _speed_up_scheduler(args.speedup)
+    logging.getLogger(f"{__name__}.FakeDiscord").addHandler(RateLimitLogCounter(metrics))
+    tracemalloc.start()
+    results: list[BenchResult] = []
+    print(f"{'scenario':<20}{'items':>10}{'seconds':>10}{'items/s':>12}{'requests':>10}{'429s':>8}{'peak MiB':>10}")
+    for name in args.scenarios or SCENARIOS:
+        res: BenchResult = await run_scenario(name, args, route_limits)
+        results.append(res)
+        print(f"{res.scenario:<20}{res.items:>10}{res.seconds:>10.2f}{res.rate:>12.1f}{res.api_calls:>10}{res.ratelimit_hits:>8}{res.peak_bytes / 2**20:>10.1f}")
+    tracemalloc.stop()
+    request_scheduler.close()
+
+    if args.json:
+        async with aiofiles.open(args.json, "w", encoding="utf-8") as f:
+            await f.write(json.dumps({"args": {k: v for k, v in vars(args).items() if k != "limit"}, "results": [asdict(_) for _ in results]}, indent=2))
+    if args.baseline:
+        async with aiofiles.open(args.baseline, "r", encoding="utf-8") as f:
+            baseline: dict[str, dict] = {_["scenario"]: _ for _ in json.loads(await f.read())["results"]}
+        regressions: list[str] = compare(results, baseline, args.tolerance)
+        for _ in regressions:
+            print(f"REGRESSION {_}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
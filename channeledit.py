@@ -0,0 +1,92 @@
+'''
+Bulk channel settings engine. It applies the same edit to a channel and all
+of its threads concurrently.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+from src import logutil
+
+from .logqueue import log_pipeline
+from .scheduler import request_scheduler
+from .threads import thread_directory
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+EDIT_CONCURRENCY: int = 10
+
+@dataclass
+class EditTarget:
+    channel_id: int
+    archived: bool = False
+    locked: bool = False
+
+async def collect_thread_targets(client: interactions.Client, channel: interactions.GuildChannel) -> list[EditTarget]:
+    '''
+    The active and archived threads (or forum posts) of the channel
+    '''
+    targets: list[EditTarget] = []
+    for thread in await thread_directory.thread_payloads(client, channel):
+        metadata: dict = thread.get("thread_metadata", {})
+        targets.append(EditTarget(int(thread["id"]), metadata.get("archived", False), metadata.get("locked", False)))
+    return targets
+
+async def _edit(client: interactions.Client, target: EditTarget, data: dict, reason: Optional[str]) -> None:
+    if not target.archived:
+        await request_scheduler.run("modify_channel", target.channel_id, lambda: client.http.modify_channel(target.channel_id, data, reason))
+        return
+    # An archived thread can only be edited while unarchiving it. Archive it again afterwards.
+    await request_scheduler.run("modify_channel", target.channel_id, lambda: client.http.modify_channel(
+        target.channel_id, {**data, "archived": False}, reason
+    ))
+    await request_scheduler.run("modify_channel", target.channel_id, lambda: client.http.modify_channel(
+        target.channel_id, {"archived": True, "locked": target.locked}, reason
+    ))
+
+async def apply_channel_edits(
+    client: interactions.Client,
+    targets: list[EditTarget],
+    data: dict,
+    *,
+    reason: Optional[str] = None,
+    concurrency: int = EDIT_CONCURRENCY,
+    on_progress: Optional[Callable[[int, int, int], Awaitable[None]]] = None
+) -> tuple[int, int]:
+    '''
+    Send the edit to all targets with a bounded number of requests in flight
+    `on_progress` is called with the count of edited, failed and all targets after each edit
+    Returns the count of edited and failed targets
+    '''
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max(concurrency, 1))
+    count_edited: int = 0
+    count_failed: int = 0
+    async def __edit_one(target: EditTarget) -> None:
+        nonlocal count_edited, count_failed
+        async with semaphore:
+            try:
+                await _edit(client, target, data, reason)
+                count_edited += 1
+            except Exception:
+                count_failed += 1
+                log_pipeline.exception(logger)
+        if on_progress is not None:
+            await on_progress(count_edited, count_failed, len(targets))
+    await asyncio.gather(*(__edit_one(_) for _ in targets))
+    return count_edited, count_failed
@@ -0,0 +1,175 @@
+'''
+Channel history export. The history is read in sharded time ranges, and each
+range is streamed to its own gzip part, which are joined in order at the end.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import contextlib
+import gzip
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+from src import logutil
+
+from .export import CHUNK_BYTES, ChunkedWriter
+from .history import HISTORY_SHARDS, ShardedHistory, payload_emoji, payload_interaction_user
+from .journal import STATUS_DONE, ExportShard, JobJournal
+from .logqueue import log_pipeline
+from .metrics import metrics
+from .progress import ProgressReporter
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+# Exported messages between the saved cursors. A resumed export reads at most this many messages again.
+EXPORT_CHECKPOINT_EVERY: int = 5000
+
+@dataclass(slots=True)
+class ExportLine:
+    id: int
+    line: str
+
+@dataclass
+class ExportStats:
+    messages: int = 0
+    size: int = 0
+
+def message_row(data: dict, *, attachment_urls: bool = False) -> dict:
+    '''
+    The exported fields of the message payload
+    The attachment URLs expire after a while, so they are only included on request
+    '''
+    reference: dict = data.get("message_reference") or {}
+    return {
+        "id": data["id"],
+        "timestamp": data.get("timestamp"),
+        "edited_timestamp": data.get("edited_timestamp"),
+        "type": data.get("type", 0),
+        "author_id": data["author"]["id"],
+        "author": data["author"].get("username"),
+        "interaction_user_id": payload_interaction_user(data),
+        "reply_to": reference.get("message_id"),
+        "content": data.get("content", ""),
+        "embeds": data.get("embeds") or [],
+        "attachments": [
+            {"filename": _.get("filename"), "size": _.get("size"), **({"url": _.get("url")} if attachment_urls else {})}
+            for _ in data.get("attachments") or []
+        ],
+        "reactions": [{"emoji": payload_emoji(_["emoji"]), "count": _["count"]} for _ in data.get("reactions") or []],
+        "pinned": data.get("pinned", False)
+    }
+
+def part_filename(path: str, shard: ExportShard) -> str:
+    return f"{path}.{shard.shard}.part"
+
+async def _join_parts(path: str, shards: list[ExportShard]) -> int:
+    '''
+    Concatenate the parts, newest first. Concatenated gzip members are one gzip stream.
+    Without any part, the file is an empty gzip member, so it is still valid.
+    '''
+    import aiofiles
+    import aiofiles.os
+    size: int = 0
+    async with aiofiles.open(path, "wb") as out:
+        if not shards:
+            data: bytes = gzip.compress(b"")
+            await out.write(data)
+            size += len(data)
+        for shard in shards:
+            async with aiofiles.open(part_filename(path, shard), "rb") as afp:
+                while chunk := await afp.read(CHUNK_BYTES):
+                    await out.write(chunk)
+                    size += len(chunk)
+    for shard in shards:
+        await aiofiles.os.remove(part_filename(path, shard))
+    return size
+
+async def export_channel(
+    client: interactions.Client,
+    channel: interactions.MessageableMixin,
+    journal: JobJournal,
+    job_key: str,
+    path: str,
+    *,
+    attachment_urls: bool = False,
+    shards: int = HISTORY_SHARDS,
+    progress: Optional[ProgressReporter] = None
+) -> ExportStats:
+    '''
+    Export the history of the channel to `path` as gzip compressed JSON Lines, newest message first
+    Each time range of the sharded scan is written to its own part file in chunks, so the memory usage does not
+    grow with the channel size. The cursor and the written size of each part are saved in the journal, and an
+    interrupted export resumes from them after cutting the parts back to the saved size.
+    '''
+    import aiofiles
+    stats: ExportStats = ExportStats()
+    parts: list[ExportShard] = await journal.list_export_shards(job_key)
+    for shard in parts:
+        filename: str = part_filename(path, shard)
+        if (os.path.getsize(filename) if os.path.exists(filename) else -1) < shard.size:
+            logger.error(f"The parts of {path} are missing. Starting the export again.")
+            await journal.clear_export_shards(job_key)
+            parts = []
+            break
+    def __convert(data: dict) -> ExportLine:
+        return ExportLine(int(data["id"]), json.dumps(message_row(data, attachment_urls=attachment_urls), ensure_ascii=False) + "\n")
+    if parts:
+        history: ShardedHistory = ShardedHistory(
+            channel, raw=True, convert=__convert, bounds=[_.remaining for _ in parts if _.status != STATUS_DONE]
+        )
+    else:
+        history = ShardedHistory(channel, shards=shards, raw=True, convert=__convert)
+        await history.start()
+        parts = [ExportShard(i, high, low) for i, (high, low) in enumerate(history.bounds)]
+        await journal.save_export_shards(job_key, parts)
+    todo: list[ExportShard] = [_ for _ in parts if _.status != STATUS_DONE]
+    stats.messages = sum(_.scanned for _ in parts)
+    writers: list[ChunkedWriter] = []
+
+    async def __checkpoint() -> None:
+        for shard, writer in zip(todo, writers):
+            await writer.flush()
+            shard.size = writer.written
+        await journal.save_export_shards(job_key, todo)
+
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            for shard in todo:
+                afp: Any = await stack.enter_async_context(aiofiles.open(part_filename(path, shard), "ab"))
+                # Drop what was written after the last checkpoint
+                await afp.truncate(shard.size)
+                writer: ChunkedWriter = ChunkedWriter(afp, compress=True, members=True)
+                writer.written = shard.size
+                writers.append(writer)
+            async for item in history:
+                shard = todo[history.shard]
+                await writers[history.shard].write(item.line)
+                shard.cursor = item.id
+                shard.scanned += 1
+                stats.messages += 1
+                metrics.inc("utility_messages_exported_total")
+                if progress is not None:
+                    progress.update(stats.messages, fraction=history.fraction)
+                if stats.messages % EXPORT_CHECKPOINT_EVERY == 0:
+                    await __checkpoint()
+            for shard in todo:
+                shard.status = STATUS_DONE
+            await __checkpoint()
+    finally:
+        history.close()
+    stats.size = await _join_parts(path, parts)
+    return stats
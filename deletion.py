@@ -0,0 +1,248 @@
+'''
+Message deletion engine. Messages younger than 14 days are deleted with
+bulk-delete requests of up to 100 IDs, the rest with single deletes.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+from .history import HISTORY_SHARDS, MessageMeta, ShardedHistory
+from .journal import ChannelCursor
+from .messageindex import MessageIndex
+from .metrics import metrics
+from .progress import ProgressReporter
+from .scheduler import request_scheduler
+
+BULK_DELETE_MAX: int = 100
+# Discord rejects bulk deletes containing messages older than 14 days.
+# Keep a safety margin so a message does not age out while the request is in flight.
+BULK_DELETE_MAX_AGE: float = 14 * 24 * 3600 - 600
+
+def snowflake_time(snowflake: int) -> float:
+    '''
+    Unix timestamp in seconds of a snowflake
+    '''
+    return ((int(snowflake) >> 22) + interactions.DISCORD_EPOCH) / 1000
+
+def is_bulk_deletable(snowflake: int, now: float) -> bool:
+    return now - snowflake_time(snowflake) < BULK_DELETE_MAX_AGE
+
+async def _delete_single(client: interactions.Client, channel_id: int, message_id: int) -> bool:
+    try:
+        await request_scheduler.run("delete_message", channel_id, lambda: client.http.delete_message(channel_id, message_id))
+    except interactions.errors.HTTPException as e:
+        # Unknown message. It is already gone.
+        return int(e.code or 0) == 10008
+    except Exception:
+        return False
+    return True
+
+async def _delete_batch(client: interactions.Client, channel_id: int, batch: list[int]) -> tuple[int, int]:
+    if len(batch) == 1:
+        return (1, 0) if await _delete_single(client, channel_id, batch[0]) else (0, 1)
+    try:
+        await request_scheduler.run("bulk_delete", channel_id, lambda: client.http.bulk_delete_messages(channel_id, batch))
+    except Exception:
+        # The whole batch is rejected if a single ID is invalid. Fall back to single deletes to find out which.
+        deleted: int = 0
+        failed: int = 0
+        for message_id in batch:
+            if await _delete_single(client, channel_id, message_id):
+                deleted += 1
+            else:
+                failed += 1
+        return deleted, failed
+    return len(batch), 0
+
+async def delete_message_ids(client: interactions.Client, channel_id: int, message_ids: Iterable[int]) -> tuple[int, int]:
+    '''
+    Delete the messages in the channel
+    Returns the count of deleted and failed messages
+    '''
+    count_deleted: int = 0
+    count_failed: int = 0
+    now: float = time.time()
+    batch: list[int] = []
+    old: list[int] = []
+    for message_id in dict.fromkeys(int(_) for _ in message_ids):
+        if is_bulk_deletable(message_id, now):
+            batch.append(message_id)
+        else:
+            old.append(message_id)
+        if len(batch) == BULK_DELETE_MAX:
+            d, f = await _delete_batch(client, channel_id, batch)
+            count_deleted += d
+            count_failed += f
+            batch = []
+            now = time.time()
+    if batch:
+        # Messages may have aged out during the previous requests
+        now = time.time()
+        old.extend(_ for _ in batch if not is_bulk_deletable(_, now))
+        batch = [_ for _ in batch if is_bulk_deletable(_, now)]
+        if batch:
+            d, f = await _delete_batch(client, channel_id, batch)
+            count_deleted += d
+            count_failed += f
+    for message_id in old:
+        if await _delete_single(client, channel_id, message_id):
+            count_deleted += 1
+        else:
+            count_failed += 1
+    return count_deleted, count_failed
+
+SCAN_QUEUE_SIZE: int = 1000
+BATCH_WAIT_SECONDS: float = 2.0
+CHECKPOINT_EVERY: int = 1000
+
+async def _delete_consumer(
+    client: interactions.Client, channel_id: int, queue: asyncio.Queue, cur: ChannelCursor, outstanding: set[int], kind: str
+) -> None:
+    finished: bool = False
+    while not finished:
+        message_id: Optional[int] = await queue.get()
+        if message_id is None:
+            break
+        batch: list[int] = [message_id]
+        # Wait a bit for the batch to fill up so that the bulk delete requests are not wasted
+        while len(batch) < BULK_DELETE_MAX:
+            try:
+                message_id = await asyncio.wait_for(queue.get(), BATCH_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                break
+            if message_id is None:
+                finished = True
+                break
+            batch.append(message_id)
+        d, f = await delete_message_ids(client, channel_id, batch)
+        cur.deleted += d
+        cur.failed += f
+        metrics.inc("utility_messages_deleted_total", d, kind=kind)
+        metrics.inc("utility_messages_failed_total", f, kind=kind)
+        outstanding.difference_update(batch)
+
+def _safe_cursor(watermark: Optional[int], outstanding: set[int]) -> Optional[int]:
+    # Everything newer than the watermark is scanned. The scan resumes before the newest outstanding message too.
+    if outstanding and (watermark is None or max(outstanding) >= watermark):
+        return max(outstanding) + 1
+    return watermark
+
+async def scan_and_delete(
+    client: interactions.Client,
+    channel: interactions.MessageableMixin,
+    predicate: Callable[[MessageMeta], bool],
+    *,
+    cursor: Optional[ChannelCursor] = None,
+    on_checkpoint: Optional[Callable[[ChannelCursor], Awaitable[None]]] = None,
+    deleters: int = 1,
+    queue_size: int = SCAN_QUEUE_SIZE,
+    kind: str = "scan",
+    progress: Optional[ProgressReporter] = None,
+    shards: int = HISTORY_SHARDS,
+    since: Optional[float] = None,
+    index: Optional[MessageIndex] = None
+) -> tuple[int, int]:
+    '''
+    Scan the channel history and delete the matching messages at the same time
+    Only the message IDs are kept in a bounded queue, so the memory usage does not grow with the channel size
+    The history is read as raw payloads, and `predicate` gets their `MessageMeta`. The message cache is not filled.
+    The scan resumes before `cursor.cursor`, and `on_checkpoint` is called with the progress regularly
+    The history is read in `shards` time ranges at the same time, only back to the `since` timestamp if given
+    The scanned messages are recorded in the `index`. A complete scan of the whole history syncs the channel in it.
+    `kind` labels the metrics of the scan, and `progress` is updated with the counters
+    Returns the count of deleted and failed messages
+    '''
+    cur: ChannelCursor = cursor if cursor is not None else ChannelCursor(int(channel.id))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    outstanding: set[int] = set()
+    consumers: list[asyncio.Task] = [
+        asyncio.create_task(_delete_consumer(client, int(channel.id), queue, cur, outstanding, kind)) for _ in range(max(deleters, 1))
+    ]
+    guild_id: Optional[int] = getattr(channel, "_guild_id", None)
+    synced_until: Optional[int] = None
+    if index is not None and cur.cursor is None and since is None:
+        synced_until = index.track(channel.id)
+    history: ShardedHistory = ShardedHistory(channel, before=cur.cursor, since=since, shards=shards, raw=True)
+    try:
+        while True:
+            # Time the history fetches apart from the time spent waiting for the deleters
+            start: float = time.monotonic()
+            try:
+                message: MessageMeta = await history.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                metrics.inc("utility_scan_seconds_total", time.monotonic() - start, kind=kind)
+            cur.scanned += 1
+            metrics.inc("utility_messages_scanned_total", kind=kind)
+            if index is not None:
+                index.record(guild_id, message)
+            if progress is not None:
+                progress.update(cur.scanned, fraction=history.fraction, deleted=cur.deleted, failed=cur.failed)
+            if predicate(message):
+                outstanding.add(message.id)
+                await queue.put(message.id)
+            if on_checkpoint is not None and cur.scanned % CHECKPOINT_EVERY == 0:
+                cur.cursor = _safe_cursor(history.watermark, outstanding)
+                await on_checkpoint(cur)
+    except BaseException:
+        # Stop deleting at once, e.g. when the job is cancelled. The last checkpoint is still valid.
+        for _ in consumers:
+            _.cancel()
+        if index is not None:
+            index.untrack(channel.id)
+        raise
+    finally:
+        history.close()
+    for _ in consumers:
+        await queue.put(None)
+    await asyncio.gather(*consumers)
+    cur.cursor = _safe_cursor(history.watermark, outstanding)
+    if on_checkpoint is not None:
+        await on_checkpoint(cur)
+    if synced_until is not None:
+        if history.complete:
+            await index.mark_synced(channel.id, guild_id, synced_until)
+        else:
+            index.untrack(channel.id)
+    return cur.deleted, cur.failed
+
+async def delete_listed(
+    client: interactions.Client,
+    channel_id: int,
+    message_ids: list[int],
+    *,
+    kind: str = "scan",
+    progress: Optional[ProgressReporter] = None
+) -> tuple[int, int]:
+    '''
+    Delete the listed messages, e.g. looked up in the message index, without scanning the history
+    Returns the count of deleted and failed messages
+    '''
+    count_deleted: int = 0
+    count_failed: int = 0
+    for i in range(0, len(message_ids), BULK_DELETE_MAX):
+        d, f = await delete_message_ids(client, channel_id, message_ids[i:i + BULK_DELETE_MAX])
+        count_deleted += d
+        count_failed += f
+        metrics.inc("utility_messages_deleted_total", d, kind=kind)
+        metrics.inc("utility_messages_failed_total", f, kind=kind)
+        if progress is not None:
+            progress.update(count_deleted + count_failed, total=len(message_ids), deleted=count_deleted, failed=count_failed)
+    return count_deleted, count_failed
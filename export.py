@@ -0,0 +1,114 @@
+'''
+Streaming file export. The rows are written in chunks as they are produced,
+optionally gzip compressed, so the memory usage does not grow with the
+number of rows.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import csv
+import io
+import json
+import zlib
+from typing import Any, Iterable, Optional
+
+CHUNK_BYTES: int = 64 * 1024
+
+FORMAT_TXT: str = "txt"
+FORMAT_CSV: str = "csv"
+FORMAT_JSONL: str = "jsonl"
+
+MEMBER_FIELDS: tuple[str, ...] = ("id", "username", "joined_at", "days_in_guild")
+
+class ChunkedWriter:
+    '''
+    Buffer the text and write it to the file in chunks. With `compress`, the file is a gzip stream.
+    With `members`, each chunk is a complete gzip member, so the file is valid gzip after every `flush()`
+    and files written this way can be concatenated. `written` counts the bytes written to the file.
+    '''
+    def __init__(self, afp: Any, *, compress: bool = False, members: bool = False) -> None:
+        self.afp: Any = afp
+        self.members: bool = compress and members
+        self.written: int = 0
+        self._buffer: list[bytes] = []
+        self._buffered: int = 0
+        # wbits=31 writes the gzip header and trailer
+        self._compressor: Optional[Any] = zlib.compressobj(wbits=31) if compress and not members else None
+
+    async def _write_out(self, data: bytes) -> None:
+        if self.members:
+            compressor: Any = zlib.compressobj(wbits=31)
+            data = compressor.compress(data) + compressor.flush()
+        elif self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            await self.afp.write(data)
+            self.written += len(data)
+
+    async def write(self, text: str) -> None:
+        data: bytes = text.encode("utf-8")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= CHUNK_BYTES:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self._buffer:
+            data: bytes = b"".join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            await self._write_out(data)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._compressor is not None:
+            data: bytes = self._compressor.flush()
+            await self.afp.write(data)
+            self.written += len(data)
+            self._compressor = None
+
+def file_suffix(fmt: str, compress: bool) -> str:
+    return f".{fmt}.gz" if compress else f".{fmt}"
+
+async def write_rows(afp: Any, rows: Iterable[dict], fields: tuple[str, ...], fmt: str, *, compress: bool = False) -> int:
+    '''
+    Write the rows to the opened binary file in the format
+    `txt` writes the first field as a Python list like the older versions
+    Returns the number of rows written
+    '''
+    writer: ChunkedWriter = ChunkedWriter(afp, compress=compress)
+    count: int = 0
+    line: io.StringIO = io.StringIO()
+    csv_writer = csv.writer(line)
+    if fmt == FORMAT_CSV:
+        csv_writer.writerow(fields)
+        await writer.write(line.getvalue())
+    elif fmt == FORMAT_TXT:
+        await writer.write("[")
+    for row in rows:
+        if fmt == FORMAT_CSV:
+            line.seek(0)
+            line.truncate()
+            csv_writer.writerow([row[_] for _ in fields])
+            await writer.write(line.getvalue())
+        elif fmt == FORMAT_JSONL:
+            await writer.write(json.dumps({_: row[_] for _ in fields}, ensure_ascii=False) + "\n")
+        else:
+            await writer.write(f"{', ' if count > 0 else ''}'{row[fields[0]]}'")
+        count += 1
+    if fmt == FORMAT_TXT:
+        await writer.write("]")
+    await writer.close()
+    return count
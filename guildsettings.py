@@ -0,0 +1,203 @@
+'''
+Per-guild operator and elevation settings stored in SQLite. The guilds are
+loaded lazily and the changes are written in debounced transactions.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+FLUSH_DELAY: float = 2.0
+
+KINDS: tuple[str, ...] = ("operator_users", "operator_roles", "elevation_members", "elevation_roles")
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS settings (
+    guild_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    target_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, kind, target_id)
+);
+"""
+
+@dataclass
+class GuildSettings:
+    guild_id: int
+    operator_users: list[int] = field(default_factory=list)
+    operator_roles: list[int] = field(default_factory=list)
+    elevation_members: list[int] = field(default_factory=list)
+    elevation_roles: list[int] = field(default_factory=list)
+
+class SettingsStore:
+    '''
+    The in-memory settings are authoritative. The database is only read on the first access of a guild.
+    `on_change` is called with the settings of a guild whenever they are loaded or changed.
+    '''
+    def __init__(self, filename: str, legacy_operators_filename: Optional[str] = None) -> None:
+        self.filename: str = filename
+        self.legacy_operators_filename: Optional[str] = legacy_operators_filename
+        self.on_change: Optional[Callable[[GuildSettings], None]] = None
+        self._guilds: dict[int, GuildSettings] = {}
+        self._loading: dict[int, asyncio.Future] = {}
+        # (operation, guild_id, kind, target_id) waiting for the next flush
+        self._pending: list[tuple[str, int, str, Optional[int]]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="guild-settings")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def _legacy_operators(self) -> dict[str, list[int]]:
+        if not self.legacy_operators_filename or not os.path.exists(self.legacy_operators_filename):
+            return {}
+        try:
+            with open(self.legacy_operators_filename, "r", encoding="utf-8") as f:
+                data: dict = json.load(f)
+            return {k: [int(_) for _ in data.get(k, [])] for k in ("operator_users", "operator_roles")}
+        except (ValueError, TypeError, AttributeError):
+            return {}
+
+    def _load(self, guild_id: int) -> GuildSettings:
+        conn: sqlite3.Connection = self._connect()
+        gs: GuildSettings = GuildSettings(guild_id)
+        with conn:
+            if conn.execute("SELECT 1 FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone() is None:
+                # The operators used to be shared by all guilds in operators.json
+                conn.execute("INSERT INTO guilds (guild_id) VALUES (?)", (guild_id,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO settings (guild_id, kind, target_id) VALUES (?, ?, ?)",
+                    [(guild_id, k, t) for k, targets in self._legacy_operators().items() for t in targets]
+                )
+            for kind, target_id in conn.execute(
+                "SELECT kind, target_id FROM settings WHERE guild_id = ? ORDER BY rowid", (guild_id,)
+            ):
+                if kind in KINDS:
+                    getattr(gs, kind).append(target_id)
+        return gs
+
+    def is_loaded(self, guild_id: int) -> bool:
+        return int(guild_id) in self._guilds
+
+    async def get(self, guild_id: int) -> GuildSettings:
+        guild_id = int(guild_id)
+        gs: Optional[GuildSettings] = self._guilds.get(guild_id)
+        if gs is not None:
+            return gs
+        if guild_id in self._loading:
+            return await self._loading[guild_id]
+        fut: asyncio.Future = asyncio.get_running_loop().run_in_executor(self._executor, self._load, guild_id)
+        self._loading[guild_id] = fut
+        try:
+            gs = await fut
+        finally:
+            del self._loading[guild_id]
+        self._guilds[guild_id] = gs
+        self._changed(gs)
+        return gs
+
+    def _changed(self, gs: GuildSettings) -> None:
+        if self.on_change is not None:
+            self.on_change(gs)
+
+    def add(self, guild_id: int, kind: str, target_id: int) -> bool:
+        '''
+        The guild must be loaded with `get()` first
+        Returns whether the setting is added
+        '''
+        gs: GuildSettings = self._guilds[int(guild_id)]
+        targets: list[int] = getattr(gs, kind)
+        if int(target_id) in targets:
+            return False
+        targets.append(int(target_id))
+        self._queue(("add", gs.guild_id, kind, int(target_id)))
+        self._changed(gs)
+        return True
+
+    def remove(self, guild_id: int, kind: str, target_id: int) -> bool:
+        gs: GuildSettings = self._guilds[int(guild_id)]
+        targets: list[int] = getattr(gs, kind)
+        if int(target_id) not in targets:
+            return False
+        targets.remove(int(target_id))
+        self._queue(("remove", gs.guild_id, kind, int(target_id)))
+        self._changed(gs)
+        return True
+
+    def clear(self, guild_id: int, *kinds: str) -> None:
+        gs: GuildSettings = self._guilds[int(guild_id)]
+        for kind in kinds:
+            getattr(gs, kind).clear()
+            self._queue(("clear", gs.guild_id, kind, None))
+        self._changed(gs)
+
+    def _queue(self, op: tuple[str, int, str, Optional[int]]) -> None:
+        self._pending.append(op)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # Coalesce the burst of changes into one transaction
+        await asyncio.sleep(FLUSH_DELAY)
+        await self.flush()
+
+    def _write(self, ops: list[tuple[str, int, str, Optional[int]]]) -> None:
+        conn: sqlite3.Connection = self._connect()
+        with conn:
+            for op, guild_id, kind, target_id in ops:
+                if op == "add":
+                    conn.execute(
+                        "INSERT OR IGNORE INTO settings (guild_id, kind, target_id) VALUES (?, ?, ?)",
+                        (guild_id, kind, target_id)
+                    )
+                elif op == "remove":
+                    conn.execute(
+                        "DELETE FROM settings WHERE guild_id = ? AND kind = ? AND target_id = ?",
+                        (guild_id, kind, target_id)
+                    )
+                elif op == "clear":
+                    conn.execute("DELETE FROM settings WHERE guild_id = ? AND kind = ?", (guild_id, kind))
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        ops: list[tuple[str, int, str, Optional[int]]] = self._pending
+        self._pending = []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, ops)
+
+    def close(self) -> None:
+        '''
+        Write the pending changes synchronously, e.g. when the extension is unloaded
+        '''
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        ops: list[tuple[str, int, str, Optional[int]]] = self._pending
+        self._pending = []
+        self._executor.submit(self._write, ops).result()
+        self._executor.shutdown()
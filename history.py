@@ -0,0 +1,275 @@
+'''
+Sharded history scanner. The lifetime of a channel is split into snowflake
+time ranges, and the ranges are paged at the same time. The bulk scans read
+only the metadata of the messages from the raw payloads.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from .scheduler import request_scheduler
+
+HISTORY_SHARDS: int = 4
+HISTORY_PAGE_SIZE: int = 100
+# Messages of all shards read ahead of the consumer
+HISTORY_BUFFER: int = 500
+# A shard spans at least one day, so a short history is not split into shards of a few messages
+MIN_SHARD_SPAN_MS: int = 24 * 3600 * 1000
+
+def time_snowflake(timestamp: float) -> int:
+    '''
+    The smallest snowflake at the Unix timestamp in seconds
+    '''
+    return max(int(timestamp * 1000) - interactions.DISCORD_EPOCH, 0) << 22
+
+def payload_interaction_user(data: dict) -> Optional[str]:
+    '''
+    ID of the user who ran the command of an interaction response in the message payload
+    '''
+    interaction: Optional[dict] = data.get("interaction_metadata") or data.get("interaction")
+    if not interaction:
+        return None
+    return (interaction.get("user") or {}).get("id") or interaction.get("user_id")
+
+def payload_emoji(emoji: dict) -> str:
+    '''
+    The request format of the emoji payload
+    '''
+    return f"{emoji['name']}:{emoji['id']}" if emoji.get("id") else emoji["name"]
+
+@dataclass(slots=True)
+class MessageMeta:
+    '''
+    The fields of a message the bulk deletions need, read from the payload without building a message object
+    '''
+    id: int
+    channel_id: int
+    author_id: int
+    # The user who ran the command of an interaction response
+    interaction_user_id: Optional[int]
+    timestamp: float
+    # (emoji in the request format, count, whether the bot reacted) of each reaction
+    reactions: tuple[tuple[str, int, bool], ...] = ()
+
+    @classmethod
+    def from_payload(cls, data: dict) -> "MessageMeta":
+        interaction_user_id: Optional[str] = payload_interaction_user(data)
+        message_id: int = int(data["id"])
+        return cls(
+            message_id,
+            int(data["channel_id"]),
+            int(data["author"]["id"]),
+            int(interaction_user_id) if interaction_user_id else None,
+            # The creation time is in the snowflake, so the timestamp is not parsed
+            ((message_id >> 22) + interactions.DISCORD_EPOCH) / 1000,
+            tuple((payload_emoji(_["emoji"]), _["count"], _.get("me", False)) for _ in data.get("reactions") or ())
+        )
+
+    @classmethod
+    def from_message(cls, message: interactions.Message) -> "MessageMeta":
+        return cls(
+            int(message.id),
+            int(message._channel_id),
+            int(message.author.id),
+            int(message.interaction_metadata._user_id) if message.interaction_metadata else None,
+            message.timestamp.timestamp(),
+            tuple((_.emoji.req_format, _.count, _.me) for _ in message.reactions)
+        )
+
+class ShardedHistory:
+    '''
+    Iterate the messages between `after` and `before` (exclusive snowflakes), or since the `since` timestamp.
+    Each shard is read from its newest message down, and the shards are merged in the order the messages arrive.
+    Everything newer than `watermark` has been yielded, so it is the cursor to resume the scan before.
+    With `raw`, the payloads converted by `convert` are yielded instead of the messages, `MessageMeta` by default,
+    and the message cache of the client is not filled. The converted payloads must have the `id` of the message.
+    `bounds` gives the time ranges of the shards instead of splitting the history, e.g. to resume the shards of
+    an earlier scan. `shard` is the index of the shard of the last yielded message.
+    `close()` stops the shards when the iteration is left early.
+    '''
+    def __init__(
+        self,
+        channel: interactions.MessageableMixin,
+        *,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        since: Optional[float] = None,
+        shards: int = HISTORY_SHARDS,
+        buffer: int = HISTORY_BUFFER,
+        raw: bool = False,
+        convert: Callable[[dict], Any] = MessageMeta.from_payload,
+        bounds: Optional[list[tuple[Optional[int], int]]] = None
+    ) -> None:
+        self.channel: interactions.MessageableMixin = channel
+        self.raw: bool = raw
+        self.convert: Callable[[dict], Any] = convert
+        self.before: Optional[int] = int(before) if before else None
+        # Every message is newer than its channel, and the starter message of a post has the ID of the post
+        self.after: int = max(int(after or 0), int(channel.id) - 1, time_snowflake(since) - 1 if since is not None else 0)
+        self.shards: int = max(shards, 1)
+        # (high exclusive, low inclusive) of each shard, newest first. The high of a single shard may be open.
+        self._bounds: list[tuple[Optional[int], int]] = []
+        self._given_bounds: Optional[list[tuple[Optional[int], int]]] = bounds
+        self.shard: Optional[int] = None
+        # The oldest yielded message of each shard
+        self._positions: list[Optional[int]] = []
+        self._finished: list[bool] = []
+        self._newest: Optional[int] = None
+        self._queue: asyncio.Queue = asyncio.Queue(buffer)
+        self._tasks: list[asyncio.Task] = []
+        self._running: int = 0
+        self._started: bool = False
+
+    async def _fetch(self, limit: int, *, before: Optional[int] = None, after: Optional[int] = None) -> list[Any]:
+        if self.raw:
+            data: list[dict] = await request_scheduler.run("get_messages", self.channel.id, lambda: self.channel._client.http.get_channel_messages(
+                self.channel.id, limit=limit, before=before or interactions.MISSING, after=after or interactions.MISSING
+            ))
+            return [self.convert(_) for _ in data]
+        return await request_scheduler.run("get_messages", self.channel.id, lambda: self.channel.fetch_messages(
+            limit=limit, before=before or interactions.MISSING, after=after or interactions.MISSING
+        ))
+
+    async def _split(self) -> None:
+        high: Optional[int] = self.before
+        low: int = self.after + 1
+        if self.shards > 1:
+            # Find the newest and the oldest message, so the shards split the time the channel was used
+            newest: list[Any] = await self._fetch(1, before=high)
+            if not newest or int(newest[0].id) < low:
+                return
+            high = int(newest[0].id) + 1
+            oldest: list[Any] = await self._fetch(1, after=self.after)
+            if oldest:
+                low = max(low, int(oldest[0].id))
+        count: int = 1
+        if high is not None:
+            count = min(self.shards, max(((high - 1) >> 22) - (low >> 22), 0) // MIN_SHARD_SPAN_MS) or 1
+        cuts: list[int] = [
+            (((high - 1) >> 22) - (((high - 1) >> 22) - (low >> 22)) * i // count) << 22 for i in range(1, count)
+        ]
+        edges: list[Optional[int]] = [high, *cuts, low]
+        self._bounds = list(zip(edges[:-1], edges[1:]))
+
+    async def _shard(self, index: int, high: Optional[int], low: int) -> None:
+        try:
+            before: Optional[int] = high
+            while True:
+                messages: list[Any] = sorted(
+                    await self._fetch(HISTORY_PAGE_SIZE, before=before), key=lambda _: int(_.id), reverse=True
+                )
+                for message in messages:
+                    if int(message.id) < low:
+                        break
+                    await self._queue.put((index, message))
+                if len(messages) < HISTORY_PAGE_SIZE or int(messages[-1].id) <= low:
+                    break
+                before = int(messages[-1].id)
+        except Exception as e:
+            # Raised by the consumer
+            await self._queue.put((index, e))
+        else:
+            await self._queue.put((index, None))
+
+    async def start(self) -> None:
+        '''
+        Split the history and start the shards. The iteration starts them if they are not started yet.
+        '''
+        if self._started:
+            return
+        self._started = True
+        if self._given_bounds is not None:
+            self._bounds = list(self._given_bounds)
+        else:
+            await self._split()
+        self._positions = [None] * len(self._bounds)
+        self._finished = [False] * len(self._bounds)
+        self._running = len(self._bounds)
+        self._tasks = [asyncio.create_task(self._shard(i, high, low)) for i, (high, low) in enumerate(self._bounds)]
+
+    def __aiter__(self) -> "ShardedHistory":
+        return self
+
+    async def __anext__(self) -> Any:
+        if not self._started:
+            await self.start()
+        while self._running:
+            item: Any
+            index, item = await self._queue.get()
+            if item is None:
+                self._finished[index] = True
+                self._running -= 1
+                continue
+            if isinstance(item, Exception):
+                self._running -= 1
+                raise item
+            self._positions[index] = int(item.id)
+            self.shard = index
+            if self._newest is None:
+                self._newest = int(item.id)
+            return item
+        raise StopAsyncIteration
+
+    @property
+    def bounds(self) -> list[tuple[Optional[int], int]]:
+        '''
+        (high exclusive, low inclusive) of each shard, newest first, once started
+        '''
+        return list(self._bounds)
+
+    @property
+    def complete(self) -> bool:
+        '''
+        Whether every shard was read to its end without an error
+        '''
+        return self._started and all(self._finished)
+
+    @property
+    def watermark(self) -> Optional[int]:
+        for i, (high, low) in enumerate(self._bounds):
+            if not self._finished[i]:
+                return self._positions[i] if self._positions[i] is not None else high
+        return self._bounds[-1][1] if self._bounds else self.before
+
+    @property
+    def fraction(self) -> Optional[float]:
+        '''
+        Estimated fraction of the time range scanned
+        '''
+        if not self._bounds:
+            return None
+        top: Optional[int] = self._bounds[0][0] or self._newest
+        if top is None:
+            return 0
+        total: int = (top >> 22) - (self._bounds[-1][1] >> 22)
+        if total <= 0:
+            return None
+        covered: int = 0
+        for i, (high, low) in enumerate(self._bounds):
+            high = high or top
+            if self._finished[i]:
+                covered += (high >> 22) - (low >> 22)
+            elif self._positions[i] is not None:
+                covered += (high >> 22) - (self._positions[i] >> 22)
+        return min(max(covered / total, 0), 1)
+
+    def close(self) -> None:
+        for _ in self._tasks:
+            _.cancel()
+        self._tasks.clear()
@@ -0,0 +1,211 @@
+'''
+Background job manager. The heavy commands submit their work as jobs, which
+run in a bounded worker pool with fair queueing between guilds.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import asyncio
+import os
+import time
+import traceback
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+from src import logutil
+
+from .logqueue import log_pipeline
+from .metrics import metrics
+from .scheduler import PRIORITY_NORMAL, job_context
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+JOB_WORKERS: int = 8
+# Jobs of one guild running at the same time. The others wait in the queue of the guild.
+JOB_GUILD_LIMIT: int = 2
+# Finished jobs kept for `/utility jobs list`
+JOB_HISTORY: int = 50
+
+JOB_QUEUED: str = "queued"
+JOB_RUNNING: str = "running"
+JOB_DONE: str = "done"
+JOB_FAILED: str = "failed"
+JOB_CANCELLED: str = "cancelled"
+
+@dataclass
+class Job:
+    job_id: int
+    key: str
+    kind: str
+    guild_id: int
+    user_id: int
+    description: str
+    run: Callable[[], Awaitable[None]]
+    priority: int = PRIORITY_NORMAL
+    status: str = JOB_QUEUED
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+class JobManager:
+    '''
+    The workers take the jobs round robin over the guilds, and a guild runs at most `guild_limit` jobs at once.
+    Jobs with the same key are deduplicated while one of them is queued or running.
+    The job runs in the job context of the request scheduler with its key and priority.
+    '''
+    def __init__(self, workers: int = JOB_WORKERS, guild_limit: int = JOB_GUILD_LIMIT, history: int = JOB_HISTORY) -> None:
+        self.workers: int = max(workers, 1)
+        self.guild_limit: int = max(guild_limit, 1)
+        self.jobs: dict[int, Job] = {}
+        self._active: dict[str, Job] = {}
+        self._queues: OrderedDict[int, deque[Job]] = OrderedDict()
+        self._running: Counter = Counter()
+        self._finished: deque[int] = deque()
+        self._history: int = history
+        self._next_id: int = 1
+        self._wake: asyncio.Event = asyncio.Event()
+        self._worker_tasks: list[asyncio.Task] = []
+
+    def find(self, key: str) -> Optional[Job]:
+        '''
+        The queued or running job with the key
+        '''
+        return self._active.get(key)
+
+    def submit(
+        self,
+        key: str,
+        kind: str,
+        guild_id: Optional[int],
+        user_id: int,
+        description: str,
+        run: Callable[[], Awaitable[None]],
+        *,
+        priority: int = PRIORITY_NORMAL
+    ) -> tuple[Job, bool]:
+        '''
+        Queue the job unless a job with the same key is queued or running
+        Returns the job and whether it is new
+        '''
+        job: Optional[Job] = self._active.get(key)
+        if job is not None:
+            return job, False
+        job = Job(self._next_id, key, kind, int(guild_id or 0), int(user_id), description, run, priority)
+        self._next_id += 1
+        self.jobs[job.job_id] = job
+        self._active[key] = job
+        self._queues.setdefault(job.guild_id, deque()).append(job)
+        self._start_workers()
+        self._wake.set()
+        return job, True
+
+    def cancel(self, job_id: int) -> bool:
+        '''
+        Remove a queued job, or cancel a running job. Returns whether the job was active.
+        '''
+        job: Optional[Job] = self.jobs.get(job_id)
+        if job is None or not job.active:
+            return False
+        if job.status == JOB_QUEUED:
+            queue: deque[Job] = self._queues.get(job.guild_id, deque())
+            queue.remove(job)
+            if not queue:
+                self._queues.pop(job.guild_id, None)
+            self._finish(job, JOB_CANCELLED)
+        elif job.task is not None:
+            job.task.cancel()
+        return True
+
+    def list(self, guild_id: Optional[int] = None) -> list[Job]:
+        return [_ for _ in self.jobs.values() if guild_id is None or _.guild_id == int(guild_id)]
+
+    def _start_workers(self) -> None:
+        self._worker_tasks = [_ for _ in self._worker_tasks if not _.done()]
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+    def _next(self) -> Optional[Job]:
+        for guild_id in list(self._queues):
+            if self._running[guild_id] >= self.guild_limit:
+                continue
+            queue: deque[Job] = self._queues[guild_id]
+            job: Job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+            return job
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            job: Optional[Job] = self._next()
+            if job is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Job) -> None:
+        job.status = JOB_RUNNING
+        job.started = time.time()
+        self._running[job.guild_id] += 1
+        with job_context(job.guild_id, job.key, job.priority):
+            job.task = asyncio.create_task(job.run())
+        status: str = JOB_CANCELLED
+        try:
+            # Wait without propagating the cancellation of the job to the worker
+            await asyncio.wait((job.task,))
+            status = JOB_DONE
+            if job.task.cancelled():
+                status = JOB_CANCELLED
+            elif job.task.exception() is not None:
+                status = JOB_FAILED
+                job.error = repr(job.task.exception())
+                logger.error("".join(traceback.format_exception(job.task.exception())))
+        finally:
+            self._running[job.guild_id] -= 1
+            if self._running[job.guild_id] <= 0:
+                del self._running[job.guild_id]
+            self._finish(job, status)
+            # A slot of the guild is free
+            self._wake.set()
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.status = status
+        job.finished = time.time()
+        job.task = None
+        if self._active.get(job.key) is job:
+            del self._active[job.key]
+        metrics.inc("utility_jobs_total", kind=job.kind, status=status)
+        if job.started is not None:
+            metrics.observe("utility_job_seconds", job.finished - job.started, kind=job.kind)
+        self._finished.append(job.job_id)
+        while len(self._finished) > self._history:
+            self.jobs.pop(self._finished.popleft(), None)
+
+    def close(self) -> None:
+        for job in list(self._active.values()):
+            if job.task is not None:
+                job.task.cancel()
+        for _ in self._worker_tasks:
+            _.cancel()
+        self._worker_tasks.clear()
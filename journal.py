@@ -0,0 +1,262 @@
+'''
+Persistent job journal. It keeps the per-channel cursors of long running jobs
+in SQLite so that an interrupted job resumes where it stopped.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+STATUS_RUNNING: str = "running"
+STATUS_DONE: str = "done"
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    job_key TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    cursor INTEGER,
+    scanned INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    target INTEGER,
+    PRIMARY KEY (job_key, channel_id)
+);
+CREATE TABLE IF NOT EXISTS export_shards (
+    job_key TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    high INTEGER,
+    low INTEGER NOT NULL,
+    cursor INTEGER,
+    scanned INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    PRIMARY KEY (job_key, shard)
+);
+CREATE TABLE IF NOT EXISTS reactions (
+    job_key TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    emoji TEXT NOT NULL,
+    PRIMARY KEY (job_key, message_id, emoji)
+);
+"""
+
+@dataclass
+class ChannelCursor:
+    channel_id: int
+    # The last processed snowflake. The history is read from newest to oldest, so the job resumes before it.
+    cursor: Optional[int] = None
+    scanned: int = 0
+    deleted: int = 0
+    failed: int = 0
+    status: str = STATUS_RUNNING
+    # The channel created for the job, such as the destination post of a migrated forum post
+    target: Optional[int] = None
+
+@dataclass
+class ExportShard:
+    '''
+    A time range of an exported history, (high exclusive, low inclusive), and the bytes of its part file written
+    up to the cursor. The shards are numbered from the newest.
+    '''
+    shard: int
+    high: Optional[int]
+    low: int
+    cursor: Optional[int] = None
+    scanned: int = 0
+    size: int = 0
+    status: str = STATUS_RUNNING
+
+    @property
+    def remaining(self) -> tuple[Optional[int], int]:
+        '''
+        The time range left to export
+        '''
+        return (self.cursor if self.cursor is not None else self.high, self.low)
+
+class JobJournal:
+    '''
+    All the SQLite calls run in one worker thread so they never block the event loop
+    '''
+    def __init__(self, filename: str) -> None:
+        self.filename: str = filename
+        self._conn: Optional[sqlite3.Connection] = None
+        self._closed: bool = False
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-journal")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    async def _run(self, func: Callable[..., Any], *args) -> Any:
+        def __call() -> Any:
+            conn: sqlite3.Connection = self._connect()
+            with conn:
+                return func(conn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, __call)
+
+    def close(self) -> None:
+        '''
+        Close the database and stop the worker thread, e.g. when the extension is unloaded
+        '''
+        def __close() -> None:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.submit(__close).result()
+        self._executor.shutdown()
+
+    @staticmethod
+    def _start(conn: sqlite3.Connection, job_key: str, kind: str, guild_id: int) -> bool:
+        row = conn.execute("SELECT status FROM jobs WHERE job_key = ?", (job_key,)).fetchone()
+        if row is not None and row[0] == STATUS_RUNNING:
+            return True
+        conn.execute("DELETE FROM cursors WHERE job_key = ?", (job_key,))
+        conn.execute("DELETE FROM export_shards WHERE job_key = ?", (job_key,))
+        conn.execute("DELETE FROM reactions WHERE job_key = ?", (job_key,))
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_key, kind, guild_id, status, updated) VALUES (?, ?, ?, ?, ?)",
+            (job_key, kind, guild_id, STATUS_RUNNING, time.time())
+        )
+        return False
+
+    async def start(self, job_key: str, kind: str, guild_id: int) -> bool:
+        '''
+        Start a job or pick up the unfinished one with the same key
+        Returns whether the job is resumed
+        '''
+        return await self._run(self._start, job_key, kind, int(guild_id))
+
+    @staticmethod
+    def _finish(conn: sqlite3.Connection, job_key: str) -> None:
+        conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE job_key = ?", (STATUS_DONE, time.time(), job_key))
+
+    async def finish(self, job_key: str) -> None:
+        await self._run(self._finish, job_key)
+
+    @staticmethod
+    def _get_cursor(conn: sqlite3.Connection, job_key: str, channel_id: int) -> ChannelCursor:
+        row = conn.execute(
+            "SELECT cursor, scanned, deleted, failed, status, target FROM cursors WHERE job_key = ? AND channel_id = ?",
+            (job_key, channel_id)
+        ).fetchone()
+        if row is None:
+            return ChannelCursor(channel_id)
+        return ChannelCursor(channel_id, *row)
+
+    async def get_cursor(self, job_key: str, channel_id: int) -> ChannelCursor:
+        return await self._run(self._get_cursor, job_key, int(channel_id))
+
+    @staticmethod
+    def _save_cursor(conn: sqlite3.Connection, job_key: str, cur: ChannelCursor) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO cursors (job_key, channel_id, cursor, scanned, deleted, failed, status, target) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_key, cur.channel_id, cur.cursor, cur.scanned, cur.deleted, cur.failed, cur.status, cur.target)
+        )
+        conn.execute("UPDATE jobs SET updated = ? WHERE job_key = ?", (time.time(), job_key))
+
+    async def save_cursor(self, job_key: str, cur: ChannelCursor) -> None:
+        # The jobs cancelled on unload save their cursors after the journal is closed. Their last checkpoint is kept.
+        if self._closed:
+            return
+        await self._run(self._save_cursor, job_key, cur)
+
+    @staticmethod
+    def _list_export_shards(conn: sqlite3.Connection, job_key: str) -> list[ExportShard]:
+        return [ExportShard(*_) for _ in conn.execute(
+            "SELECT shard, high, low, cursor, scanned, size, status FROM export_shards WHERE job_key = ? ORDER BY shard",
+            (job_key,)
+        )]
+
+    async def list_export_shards(self, job_key: str) -> list[ExportShard]:
+        '''
+        The shards of the export, newest first
+        '''
+        return await self._run(self._list_export_shards, job_key)
+
+    @staticmethod
+    def _save_export_shards(conn: sqlite3.Connection, job_key: str, shards: list[ExportShard]) -> None:
+        conn.executemany(
+            "INSERT OR REPLACE INTO export_shards (job_key, shard, high, low, cursor, scanned, size, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((job_key, _.shard, _.high, _.low, _.cursor, _.scanned, _.size, _.status) for _ in shards)
+        )
+        conn.execute("UPDATE jobs SET updated = ? WHERE job_key = ?", (time.time(), job_key))
+
+    async def save_export_shards(self, job_key: str, shards: list[ExportShard]) -> None:
+        '''
+        Save the shards of the export in one transaction
+        '''
+        await self._run(self._save_export_shards, job_key, list(shards))
+
+    @staticmethod
+    def _clear_export_shards(conn: sqlite3.Connection, job_key: str) -> None:
+        conn.execute("DELETE FROM export_shards WHERE job_key = ?", (job_key,))
+
+    async def clear_export_shards(self, job_key: str) -> None:
+        await self._run(self._clear_export_shards, job_key)
+
+    @staticmethod
+    def _add_reactions(conn: sqlite3.Connection, job_key: str, reactions: list[tuple[int, int, str]]) -> None:
+        conn.executemany(
+            "INSERT OR IGNORE INTO reactions (job_key, channel_id, message_id, emoji) VALUES (?, ?, ?, ?)",
+            [(job_key, *_) for _ in reactions]
+        )
+
+    async def add_reactions(self, job_key: str, reactions: list[tuple[int, int, str]]) -> None:
+        '''
+        Record the (channel_id, message_id, emoji) of the reactions left for the deferred pass of the job
+        '''
+        # Like the cursors, the reactions of the jobs cancelled on unload are kept up to the last checkpoint
+        if self._closed:
+            return
+        await self._run(self._add_reactions, job_key, list(reactions))
+
+    @staticmethod
+    def _list_reactions(conn: sqlite3.Connection, job_key: str) -> list[tuple[int, int, str]]:
+        return [tuple(_) for _ in conn.execute(
+            "SELECT channel_id, message_id, emoji FROM reactions WHERE job_key = ? ORDER BY message_id", (job_key,)
+        )]
+
+    async def list_reactions(self, job_key: str) -> list[tuple[int, int, str]]:
+        return await self._run(self._list_reactions, job_key)
+
+    @staticmethod
+    def _remove_reactions(conn: sqlite3.Connection, job_key: str, reactions: list[tuple[int, int, str]]) -> None:
+        conn.executemany(
+            "DELETE FROM reactions WHERE job_key = ? AND message_id = ? AND emoji = ?",
+            [(job_key, message_id, emoji) for _, message_id, emoji in reactions]
+        )
+
+    async def remove_reactions(self, job_key: str, reactions: list[tuple[int, int, str]]) -> None:
+        await self._run(self._remove_reactions, job_key, list(reactions))
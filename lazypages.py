@@ -0,0 +1,107 @@
+'''
+Lazy pages for the paginator. A page is only rendered when it is shown, and
+only a small window of rendered pages is kept in memory.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import itertools
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Union
+
+# The paginator extension is imported by the first paginated command
+if TYPE_CHECKING:
+    from interactions.ext.paginators import Page, Paginator
+
+LINES_PER_PAGE: int = 20
+PAGE_WINDOW: int = 5
+PAGE_SIZE: int = 4000
+
+class LazyPages(Sequence):
+    '''
+    `source` is either a sequence of items, or a callable returning a new iterator of the items.
+    The iterator source is read again up to the page to render, so the items are never stored.
+    '''
+    def __init__(
+        self,
+        source: Union[Sequence, Callable[[], Iterable[Any]]],
+        render: Callable[[Any], str] = str,
+        *,
+        prefix: str = "",
+        suffix: str = "",
+        empty: str = "",
+        lines_per_page: int = LINES_PER_PAGE,
+        window: int = PAGE_WINDOW
+    ) -> None:
+        self.source: Union[Sequence, Callable[[], Iterable[Any]]] = source
+        self.render: Callable[[Any], str] = render
+        self.prefix: str = prefix
+        self.suffix: str = suffix
+        self.empty: str = empty
+        self.lines_per_page: int = max(lines_per_page, 1)
+        self.window: int = max(window, 1)
+        self._count: Optional[int] = None
+        self._rendered: OrderedDict[int, "Page"] = OrderedDict()
+
+    def _item_count(self) -> int:
+        if self._count is None:
+            if isinstance(self.source, Sequence):
+                self._count = len(self.source)
+            else:
+                self._count = sum(1 for _ in self.source())
+        return self._count
+
+    def __len__(self) -> int:
+        return max(-(-self._item_count() // self.lines_per_page), 1)
+
+    def _items(self, index: int) -> Iterable[Any]:
+        start: int = index * self.lines_per_page
+        if isinstance(self.source, Sequence):
+            return self.source[start:start + self.lines_per_page]
+        return itertools.islice(self.source(), start, start + self.lines_per_page)
+
+    def _render_page(self, index: int) -> "Page":
+        from interactions.ext.paginators import Page
+        content: str = "\n".join(self.render(_) for _ in self._items(index)) or self.empty
+        limit: int = PAGE_SIZE - len(self.prefix) - len(self.suffix) - 2
+        if len(content) > limit:
+            content = content[:limit - 3] + "..."
+        return Page(content, prefix=self.prefix, suffix=self.suffix)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union["Page", list["Page"]]:
+        if isinstance(index, slice):
+            return [self[_] for _ in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("page index out of range")
+        page: Optional["Page"] = self._rendered.get(index)
+        if page is None:
+            page = self._render_page(index)
+            self._rendered[index] = page
+            if len(self._rendered) > self.window:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(index)
+        return page
+
+def lazy_paginator(client: interactions.Client, source: Union[Sequence, Callable[[], Iterable[Any]]], render: Callable[[Any], str] = str, **kwargs) -> "Paginator":
+    '''
+    Create a paginator rendering the pages on demand. The keyword arguments are passed to `LazyPages`.
+    '''
+    from interactions.ext.paginators import Paginator
+    return Paginator(client, pages=LazyPages(source, render, **kwargs))
@@ -0,0 +1,171 @@
+'''
+Non-blocking logging for this extension. The records are queued and written by
+a background thread, and repeated errors are aggregated into summaries.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# Window of the error aggregation in seconds
+LOG_REPEAT_WINDOW: float = 60.0
+# Tracebacks logged for one error at one call site in a window. The others are only counted in the summary.
+LOG_REPEAT_LIMIT: int = 3
+
+@dataclass
+class _Route:
+    logger: logging.Logger
+    handlers: list[logging.Handler]
+    propagate: bool
+
+@dataclass
+class _Repeats:
+    logger: logging.Logger
+    started: float
+    logged: int = 0
+    suppressed: int = 0
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message and the traceback are formatted by the listener thread instead of the event loop
+        return copy.copy(record)
+
+class _Dispatcher(logging.Handler):
+    '''
+    Hand the records over to the original handlers of their logger in the listener thread
+    '''
+    def __init__(self, routes: dict[str, _Route]) -> None:
+        super().__init__()
+        self.routes: dict[str, _Route] = routes
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        route: Optional[_Route] = self.routes.get(record.name)
+        if route is None:
+            return False
+        for handler in route.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        if route.propagate and route.logger.parent is not None:
+            route.logger.parent.callHandlers(record)
+        return True
+
+class LogPipeline:
+    '''
+    While started, the installed loggers only put their records in a queue, and a `QueueListener` thread passes
+    them on to the handlers the loggers had before. `stop()` writes the queued records and gives the handlers back.
+    `exception()` logs at most `LOG_REPEAT_LIMIT` tracebacks of an error at a call site per window, and
+    `flush_summaries()` logs how many more were suppressed.
+    '''
+    def __init__(self, window: float = LOG_REPEAT_WINDOW, limit: int = LOG_REPEAT_LIMIT) -> None:
+        self.window: float = window
+        self.limit: int = limit
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.handler: _DeferredQueueHandler = _DeferredQueueHandler(self.queue)
+        self._routes: dict[str, _Route] = {}
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        # (logger name, file, line, error type, error code) -> repeats in the current window
+        self._repeats: dict[tuple[str, str, int, str, Optional[int]], _Repeats] = {}
+        self._next_summary: float = time.monotonic() + window
+
+    def install(self, logger: logging.Logger) -> logging.Logger:
+        '''
+        Route the logger through the queue while the pipeline is started
+        '''
+        handlers: list[logging.Handler] = [_ for _ in logger.handlers if _ is not self.handler]
+        route: Optional[_Route] = self._routes.get(logger.name)
+        if route is None:
+            self._routes[logger.name] = _Route(logger, handlers, logger.propagate)
+        else:
+            # Handlers added to the logger since it was installed
+            route.handlers.extend(_ for _ in handlers if _ not in route.handlers)
+        if self._listener is not None:
+            logger.handlers = [self.handler]
+            logger.propagate = False
+        return logger
+
+    def start(self) -> None:
+        if self._listener is not None:
+            return
+        self._listener = logging.handlers.QueueListener(self.queue, _Dispatcher(self._routes))
+        self._listener.start()
+        for route in self._routes.values():
+            self.install(route.logger)
+
+    def stop(self) -> None:
+        self.flush_summaries(force=True)
+        if self._listener is None:
+            return
+        # Write the queued records before the handlers are given back
+        self._listener.stop()
+        self._listener = None
+        for route in self._routes.values():
+            route.logger.handlers = route.handlers
+            route.logger.propagate = route.propagate
+
+    def exception(self, logger: logging.Logger, message: Optional[str] = None, *, code: Optional[int] = None) -> None:
+        '''
+        Log the exception being handled, unless it was logged `limit` times at this call site in the window
+        The error code defaults to the code of the HTTP exceptions
+        '''
+        exc: Optional[BaseException] = sys.exc_info()[1]
+        if code is None:
+            code = getattr(exc, "code", None)
+        caller = sys._getframe(1)
+        key: tuple[str, str, int, str, Optional[int]] = (
+            logger.name, os.path.basename(caller.f_code.co_filename), caller.f_lineno, type(exc).__name__, code
+        )
+        now: float = time.monotonic()
+        if now >= self._next_summary:
+            self.flush_summaries()
+        repeats: Optional[_Repeats] = self._repeats.get(key)
+        if repeats is None:
+            repeats = self._repeats[key] = _Repeats(logger, now)
+        if repeats.logged >= self.limit:
+            repeats.suppressed += 1
+            return
+        repeats.logged += 1
+        # The traceback is formatted by the handlers, in the listener thread while the pipeline is started
+        logger.error(message or self._describe(key), exc_info=True)
+
+    @staticmethod
+    def _describe(key: tuple[str, str, int, str, Optional[int]]) -> str:
+        _, filename, line, error, code = key
+        return f"{error}{f' {code}' if code is not None else ''} at {filename}:{line}"
+
+    def flush_summaries(self, *, force: bool = False) -> None:
+        '''
+        Log the suppressed errors of the windows that ended, and start new windows for them
+        '''
+        now: float = time.monotonic()
+        self._next_summary = now + self.window
+        for key, repeats in list(self._repeats.items()):
+            if not force and now - repeats.started < self.window:
+                self._next_summary = min(self._next_summary, repeats.started + self.window)
+                continue
+            del self._repeats[key]
+            if repeats.suppressed:
+                repeats.logger.error(
+                    f"{self._describe(key)} repeated {repeats.suppressed} more times in the last {now - repeats.started:.0f} seconds"
+                )
+
+log_pipeline: LogPipeline = LogPipeline()
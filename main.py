@@ -17,99 +17,85 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
+import time
+# The start of the import, for the startup profile
+_import_started: float = time.perf_counter()
 import interactions
-from interactions.ext.paginators import Paginator
 import datetime
-import aiofiles
-import aiofiles.os
+import io
 import os
-from typing import Optional, cast
+from typing import TYPE_CHECKING, Optional
 import asyncio
 import traceback
+import weakref
 from src import logutil
 
-from src.moduleutil import giturl_parse
-from importlib import import_module
-from types import ModuleType
+from .channeledit import EditTarget, apply_channel_edits, collect_thread_targets
+from .channelexport import ExportStats, export_channel
+from .deletion import delete_listed, scan_and_delete
+from .export import FORMAT_CSV, FORMAT_JSONL, FORMAT_TXT, MEMBER_FIELDS, file_suffix, write_rows
+from .guildsettings import GuildSettings, SettingsStore
+from .jobs import JOB_RUNNING, Job, JobManager
+from .journal import JobJournal
+from .lazypages import lazy_paginator
+from .logqueue import LOG_REPEAT_WINDOW, log_pipeline
+from .memberindex import MemberIndex
+from .messageindex import MessageIndex
+from .metrics import RateLimitLogCounter, metrics
+from .migration import MigrationStats, migrate_channel
+from .permissions import PermissionIndex
+from .progress import ProgressReporter
+from .reactions import ReactionCleaner
+from .roles import ROLE_ADD, ROLE_REMOVE, ROLE_REMOVE_ALL, RoleEditStats, apply_role_edits
+from .scheduler import PRIORITY_BACKGROUND, job_context, request_scheduler
+from .sweep import SweepStats, sweep_guild
+from .threads import thread_directory
 
-from pydantic import BaseModel
+if TYPE_CHECKING:
+    from interactions.ext.paginators import Paginator
 
-logger = logutil.init_logger("Discord-Utilities")
+logger = log_pipeline.install(logutil.init_logger("Discord-Utilities"))
 
-libmigrate_loaded: bool = False
-libmigrate: ModuleType = None
+permission_index: PermissionIndex = PermissionIndex()
+# `operators.json` is only read to import the operators of the older versions
+settings_store: SettingsStore = SettingsStore(
+    f"{os.path.dirname(__file__)}/settings.db",
+    legacy_operators_filename=f"{os.path.dirname(__file__)}/operators.json"
+)
+settings_store.on_change = permission_index.set_guild
+member_index: MemberIndex = MemberIndex()
 
-def __import_git_module(url: str) -> tuple[Optional[ModuleType], bool]:
-    ret_module: ModuleType = None
-    ret_loaded: bool = False
-    try:
-        url, modname, validated = giturl_parse(url)
-        if validated:
-            ret_module = import_module(f"...{modname}.lib", package=__name__)
-            # 等价于：
-            # from .. import github_d_com__retr0_h_init_s_libdiscord_h_ipy_h_migrate.lib as libmigrate
-            ret_loaded = True
-    except ImportError:
-        logger.error(f"Module Library {modname} import error or is not loaded!")
-        return None, False
-    else:
-        return ret_module, ret_loaded
+# The message metadata of the channels scanned once is kept up to date from the gateway events, so the later
+# deletions in them look up the messages of the user instead of scanning the history again
+MESSAGE_INDEX_ENABLED: bool = True
+message_index: MessageIndex = MessageIndex(f"{os.path.dirname(__file__)}/messages.db")
 
-libmigrate, libmigrate_loaded = __import_git_module("https://github.com/retr0-init/libdiscord-ipy-migrate.git")
+job_journal: JobJournal = JobJournal(f"{os.path.dirname(__file__)}/jobs.db")
+job_manager: JobManager = JobManager()
 
-class Operators(BaseModel):
-    operator_users: list[int]
-    operator_roles: list[int]
+# The channel exports too large to upload stay here
+EXPORT_DIR: str = f"{os.path.dirname(__file__)}/exports"
 
-elevation_roles: list[int] = []
-elevation_members: list[int] = []
-operators: Operators = None
-
-operators_store_filename: str = f"{os.path.dirname(__file__)}/operators.json"
+METRICS_FILENAME: str = f"{os.path.dirname(__file__)}/metrics.json"
+METRICS_DUMP_SECONDS: int = 60
 
 async def my_check(ctx: interactions.BaseContext) -> bool:
     '''
     Check the permission to run the privileged command
     The ROLE_ID needs to be set with the elevate command
     '''
-    res: bool = await interactions.is_owner()(ctx)
-    r: bool = any(map(ctx.author.has_role, elevation_roles)) if len(elevation_roles) > 0 else False
-    u: bool = any(map(ctx.author.id.__eq__, elevation_members)) if len(elevation_members) > 0 else False
-    return res or r or u
-
-async def _save_operator_file() -> None:
-    async with aiofiles.open(operators_store_filename, "w", encoding="utf-8") as f:
-        await f.write(operators.json())
-
-async def _create_empty_operator_file() -> None:
-    global operators
-    operators = Operators(operator_users = list(), operator_roles = list())
-    await _save_operator_file()
-
-async def _validate_operators() -> None:
-    # Read the operators config file. If not, create one
-    global operators
-    if operators:
-        return
-    if not os.path.exists(operators_store_filename):
-        await _create_empty_operator_file()
-    else:
-        async with aiofiles.open(operators_store_filename, "r", encoding="utf-8") as f:
-            temp_str: str = await f.read()
-            try:
-                operators = Operators.parse_raw(temp_str)
-            except pydantic.ValidationError:
-                await _create_empty_operator_file()
+    # The settings of a guild are loaded from the database at the first command in the guild
+    if not settings_store.is_loaded(ctx.guild_id or 0):
+        await settings_store.get(ctx.guild_id or 0)
+    return permission_index.is_privileged(ctx)
 
 async def operator_check(ctx: interactions.BaseContext) -> bool:
     """
     Permission check for operators. It includes the elevated roles
     """
-    await _validate_operators()
-    res: bool = await my_check(ctx)
-    r: bool = any(map(ctx.author.has_role, operators.operator_roles)) if len(operators.operator_roles) > 0 else False
-    u: bool = any(map(ctx.author.id.__eq__, operators.operator_users)) if len(operators.operator_users) > 0 else False
-    return res or r or u
+    if not settings_store.is_loaded(ctx.guild_id or 0):
+        await settings_store.get(ctx.guild_id or 0)
+    return permission_index.is_operator(ctx)
 
 '''
 Useful utilities
@@ -131,10 +117,140 @@ class Retr0initDiscordUtilities(interactions.Extension):
         name = "user",
         description = "User related utilities"
     )
-    cmd_guild_deleteAllUrMsg_members: list[int] = []
+    module_group_j: interactions.SlashCommand = module_base.group(
+        name = "jobs",
+        description = "Background jobs of this guild"
+    )
+
+    def __init__(self, bot: interactions.Client) -> None:
+        setup_started: float = time.perf_counter()
+        # The records are written by a background thread from now on
+        log_pipeline.start()
+        self.command_started: weakref.WeakKeyDictionary[interactions.BaseContext, float] = weakref.WeakKeyDictionary()
+        self.ratelimit_counter: RateLimitLogCounter = RateLimitLogCounter(metrics)
+        bot.http.logger.addHandler(self.ratelimit_counter)
+        self.add_extension_prerun(self.__command_prerun)
+        self.add_extension_postrun(self.__command_postrun)
+        setup_seconds: float = time.perf_counter() - setup_started
+        metrics.observe("utility_startup_seconds", IMPORT_SECONDS, phase="import")
+        metrics.observe("utility_startup_seconds", setup_seconds, phase="setup")
+        logger.info(f"Loaded in {(IMPORT_SECONDS + setup_seconds) * 1000:.1f} ms (imports {IMPORT_SECONDS * 1000:.1f} ms)")
+
+    async def async_start(self) -> None:
+        self.dump_metrics.start()
+        self.flush_log_summaries.start()
+        if MESSAGE_INDEX_ENABLED:
+            await message_index.load()
+
+    async def __command_prerun(self, ctx: interactions.BaseContext, *args, **kwargs) -> None:
+        self.command_started[ctx] = time.monotonic()
+        if not self.dump_metrics.started:
+            # The extension was loaded after the startup
+            self.dump_metrics.start()
+            self.flush_log_summaries.start()
+
+    async def __command_postrun(self, ctx: interactions.BaseContext, *args, **kwargs) -> None:
+        start: Optional[float] = self.command_started.pop(ctx, None)
+        if start is not None:
+            metrics.observe("utility_command_seconds", time.monotonic() - start, command=ctx.invoke_target)
+
+    @interactions.Task.create(interactions.IntervalTrigger(seconds=METRICS_DUMP_SECONDS))
+    async def dump_metrics(self) -> None:
+        try:
+            await metrics.dump_json(METRICS_FILENAME)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    @interactions.Task.create(interactions.IntervalTrigger(seconds=LOG_REPEAT_WINDOW))
+    async def flush_log_summaries(self) -> None:
+        log_pipeline.flush_summaries()
+
+    @interactions.listen(interactions.events.MemberUpdate)
+    async def on_member_update(self, event: interactions.events.MemberUpdate) -> None:
+        permission_index.invalidate_member(event.guild_id, event.after.id)
+        member_index.on_member_update(event.guild_id, event.after)
+
+    @interactions.listen(interactions.events.MemberAdd)
+    async def on_member_add(self, event: interactions.events.MemberAdd) -> None:
+        member_index.on_member_add(event.guild_id, event.member)
+
+    @interactions.listen(interactions.events.MemberRemove)
+    async def on_member_remove(self, event: interactions.events.MemberRemove) -> None:
+        permission_index.invalidate_member(event.guild_id, event.member.id)
+        member_index.on_member_remove(event.guild_id, event.member.id)
+
+    @interactions.listen(interactions.events.GuildLeft)
+    async def on_guild_left(self, event: interactions.events.GuildLeft) -> None:
+        member_index.drop_guild(event.guild_id)
+        message_index.forget_guild(event.guild_id)
+        thread_directory.invalidate_guild(event.guild_id)
+
+    @interactions.listen(interactions.events.Ready)
+    async def on_ready(self, event: interactions.events.Ready) -> None:
+        message_index.session_started()
+        # The thread events missed while disconnected are not replayed
+        thread_directory.clear()
+
+    @interactions.listen(interactions.events.MessageCreate)
+    async def on_message_create(self, event: interactions.events.MessageCreate) -> None:
+        if MESSAGE_INDEX_ENABLED:
+            message_index.on_message_create(event.message._guild_id, event.message)
+
+    @interactions.listen(interactions.events.MessageDelete)
+    async def on_message_delete(self, event: interactions.events.MessageDelete) -> None:
+        message_index.on_message_delete(event.message._channel_id, [event.message.id])
+
+    @interactions.listen(interactions.events.MessageDeleteBulk)
+    async def on_message_delete_bulk(self, event: interactions.events.MessageDeleteBulk) -> None:
+        message_index.on_message_delete(event.channel_id, event.ids)
+
+    @interactions.listen(interactions.events.ChannelDelete)
+    async def on_channel_delete(self, event: interactions.events.ChannelDelete) -> None:
+        message_index.forget_channel(event.channel.id)
+        thread_directory.invalidate_channel(event.channel.id)
+
+    @interactions.listen(interactions.events.ThreadCreate)
+    async def on_thread_create(self, event: interactions.events.ThreadCreate) -> None:
+        thread_directory.invalidate_channel(event.thread.parent_id, event.thread._guild_id)
 
-    async def _update_operators(self, *, operator_uid: Optional[int] = None, operator_rid: Optional[int] = None) -> tuple[bool, bool]:
-        await _validate_operators()
+    @interactions.listen(interactions.events.ThreadUpdate)
+    async def on_thread_update(self, event: interactions.events.ThreadUpdate) -> None:
+        thread_directory.invalidate_channel(event.thread.parent_id, event.thread._guild_id)
+
+    @interactions.listen(interactions.events.ThreadListSync)
+    async def on_thread_list_sync(self, event: interactions.events.ThreadListSync) -> None:
+        # Sent when the bot gains access to channels, with the active threads of those channels
+        for channel_id in event.channel_ids:
+            thread_directory.invalidate_channel(channel_id)
+        for thread in event.threads:
+            thread_directory.invalidate_channel(thread.parent_id, thread._guild_id)
+
+    @interactions.listen(interactions.events.ThreadDelete)
+    async def on_thread_delete(self, event: interactions.events.ThreadDelete) -> None:
+        message_index.forget_channel(event.thread.id)
+        thread_directory.invalidate_channel(event.thread.parent_id, event.thread._guild_id)
+
+    @interactions.listen(interactions.events.RoleDelete)
+    async def on_role_delete(self, event: interactions.events.RoleDelete) -> None:
+        permission_index.invalidate_guild(event.guild_id)
+
+    def drop(self) -> None:
+        if self.dump_metrics.started:
+            self.dump_metrics.stop()
+        if self.flush_log_summaries.started:
+            self.flush_log_summaries.stop()
+        self.bot.http.logger.removeHandler(self.ratelimit_counter)
+        job_manager.close()
+        job_journal.close()
+        settings_store.close()
+        message_index.close()
+        request_scheduler.close()
+        # Write the queued records and the suppressed error counts
+        log_pipeline.stop()
+        super().drop()
+
+    async def _update_operators(self, guild_id: int, *, operator_uid: Optional[int] = None, operator_rid: Optional[int] = None) -> tuple[bool, bool]:
+        operators: GuildSettings = await settings_store.get(guild_id)
         ret_uid: bool = False
         ret_rid: bool = False
 
@@ -147,19 +263,15 @@ class Retr0initDiscordUtilities(interactions.Extension):
         if operator_rid in operators.operator_roles and operator_uid in operators.operator_users:
             return False, False
 
-        if operator_uid and operator_uid not in operators.operator_users:
-            operators.operator_users.append(operator_uid)
-            ret_uid = True
-        if operator_rid and operator_rid not in operators.operator_roles:
-            operators.operator_roles.append(operator_rid)
-            ret_rid = True
-
-        await _save_operator_file()
+        if operator_uid:
+            ret_uid = settings_store.add(guild_id, "operator_users", operator_uid)
+        if operator_rid:
+            ret_rid = settings_store.add(guild_id, "operator_roles", operator_rid)
 
         return ret_uid, ret_rid
 
-    async def _remove_operators(self, *, operator_uid: Optional[int] = None, operator_rid: Optional[int] = None) -> tuple[bool, bool]:
-        await _validate_operators()
+    async def _remove_operators(self, guild_id: int, *, operator_uid: Optional[int] = None, operator_rid: Optional[int] = None) -> tuple[bool, bool]:
+        operators: GuildSettings = await settings_store.get(guild_id)
         ret_uid: bool = False
         ret_rid: bool = False
 
@@ -172,31 +284,27 @@ class Retr0initDiscordUtilities(interactions.Extension):
         if operator_rid in operators.operator_roles and operator_uid not in operators.operator_users:
             return False, False
 
-        if operator_uid and operator_uid in operators.operator_users:
-            operators.operator_users.remove(operator_uid)
-            ret_uid = True
-        if operator_rid and operator_rid in operators.operator_roles:
-            operators.operator_roles.remove(operator_rid)
-            ret_rid = True
-
-        await _save_operator_file()
+        if operator_uid:
+            ret_uid = settings_store.remove(guild_id, "operator_users", operator_uid)
+        if operator_rid:
+            ret_rid = settings_store.remove(guild_id, "operator_roles", operator_rid)
 
         return ret_uid, ret_rid
 
     @module_base.subcommand("operator_show", sub_cmd_description="Show Elevation settings")
     async def cmd_operatorShow(self, ctx: interactions.SlashContext):
         await ctx.defer()
-        await _validate_operators()
-        display_str: str = "There is no current operator elevation setting." if len(operators.operator_roles) == 0 and len(operators.operator_users) == 0 else ""
-        if len(operators.operator_roles) > 0:
-            display_str += "### Operator Roles\n"
-            for r in operators.operator_roles:
-                display_str += f"- {ctx.guild.get_role(r).name}\n"
-        if len(operators.operator_users) > 0:
-            display_str += "### Operator Members\n"
-            for u in operators.operator_users:
-                display_str += f"- {ctx.guild.get_member(u)}\n"
-        pag: Paginator = Paginator.create_from_string(self.bot, display_str)
+        operators: GuildSettings = await settings_store.get(ctx.guild_id)
+        def __display_lines():
+            if len(operators.operator_roles) > 0:
+                yield "### Operator Roles"
+                for r in operators.operator_roles:
+                    yield f"- {ctx.guild.get_role(r).name}"
+            if len(operators.operator_users) > 0:
+                yield "### Operator Members"
+                for u in operators.operator_users:
+                    yield f"- {ctx.guild.get_member(u)}"
+        pag: Paginator = lazy_paginator(self.bot, __display_lines, empty="There is no current operator elevation setting.")
         await pag.send(ctx)
 
     @module_base.subcommand("operator_role", sub_cmd_description="Elevate certain role to run operator commands")
@@ -208,7 +316,7 @@ class Retr0initDiscordUtilities(interactions.Extension):
         opt_type = interactions.OptionType.ROLE
     )
     async def cmd_operatorRole(self, ctx: interactions.SlashContext, role: interactions.Role):
-        await self._update_operators(operator_rid=role.id)
+        await self._update_operators(ctx.guild_id, operator_rid=role.id)
         await ctx.send(f"Role {role.name} has been elevated for operator utility commands!")
 
     @module_base.subcommand("operator_member", sub_cmd_description="Elevate certain member to run operator commands")
@@ -220,31 +328,32 @@ class Retr0initDiscordUtilities(interactions.Extension):
         opt_type = interactions.OptionType.USER
     )
     async def operatorMember(self, ctx: interactions.SlashContext, member: interactions.User):
-        await self._update_operators(operator_uid=member.id)
+        await self._update_operators(ctx.guild_id, operator_uid=member.id)
         await ctx.send(f"Member {member.display_name}({member.username}) has been elevated for operator utility commands!")
     
     @module_base.subcommand("operator_clear", sub_cmd_description="Clear all operator elevations")
     @interactions.check(interactions.is_owner())
     async def operatorClear(self, ctx: interactions.SlashContext):
-        await _validate_operators()
-        operators.operator_users.clear()
-        operators.operator_roles.clear()
-        await _save_operator_file()
+        await settings_store.get(ctx.guild_id)
+        settings_store.clear(ctx.guild_id, "operator_users", "operator_roles")
         await ctx.send("All operator elevations have been removed!")
 
     @module_base.subcommand("elevate_show", sub_cmd_description="Show Elevation settings")
     async def cmd_elevateShow(self, ctx: interactions.SlashContext):
         await ctx.defer()
-        display_str: str = "There is no current elevation setting." if len(elevation_roles) == 0 and len(elevation_members) == 0 else ""
-        if len(elevation_roles) > 0:
-            display_str += "### Elevated Roles\n"
-            for r in elevation_roles:
-                display_str += f"- {ctx.guild.get_role(r).name}\n"
-        if len(elevation_members) > 0:
-            display_str += "### Elevated Members\n"
-            for u in elevation_members:
-                display_str += f"- {ctx.guild.get_member(u)}\n"
-        pag: Paginator = Paginator.create_from_string(self.bot, display_str)
+        gs: GuildSettings = await settings_store.get(ctx.guild_id)
+        elevation_roles: list[int] = gs.elevation_roles
+        elevation_members: list[int] = gs.elevation_members
+        def __display_lines():
+            if len(elevation_roles) > 0:
+                yield "### Elevated Roles"
+                for r in elevation_roles:
+                    yield f"- {ctx.guild.get_role(r).name}"
+            if len(elevation_members) > 0:
+                yield "### Elevated Members"
+                for u in elevation_members:
+                    yield f"- {ctx.guild.get_member(u)}"
+        pag: Paginator = lazy_paginator(self.bot, __display_lines, empty="There is no current elevation setting.")
         await pag.send(ctx)
 
     @module_base.subcommand("elevate_role", sub_cmd_description="Elevate certain role to run privileged commands")
@@ -256,8 +365,8 @@ class Retr0initDiscordUtilities(interactions.Extension):
         opt_type = interactions.OptionType.ROLE
     )
     async def cmd_elevateRole(self, ctx: interactions.SlashContext, role: interactions.Role):
-        if role.id not in elevation_roles:
-            elevation_roles.append(role.id)
+        await settings_store.get(ctx.guild_id)
+        settings_store.add(ctx.guild_id, "elevation_roles", role.id)
         await ctx.send(f"Role {role.name} has been elevated for all utility commands!")
 
     @module_base.subcommand("elevate_member", sub_cmd_description="Elevate certain member to run privileged commands")
@@ -269,17 +378,25 @@ class Retr0initDiscordUtilities(interactions.Extension):
         opt_type = interactions.OptionType.USER
     )
     async def cmd_elevateMember(self, ctx: interactions.SlashContext, member: interactions.User):
-        if member.id not in elevation_members:
-            elevation_members.append(member.id)
+        await settings_store.get(ctx.guild_id)
+        settings_store.add(ctx.guild_id, "elevation_members", member.id)
         await ctx.send(f"Member {member.display_name}({member.username}) has been elevated for all utility commands!")
     
     @module_base.subcommand("elevate_clear", sub_cmd_description="Clear all privilege elevations")
     @interactions.check(interactions.is_owner())
     async def cmd_elevateClear(self, ctx: interactions.SlashContext):
-        elevation_members.clear()
-        elevation_roles.clear()
+        await settings_store.get(ctx.guild_id)
+        settings_store.clear(ctx.guild_id, "elevation_members", "elevation_roles")
         await ctx.send("All privilege elevations have been removed!")
 
+    @module_base.subcommand("metrics", sub_cmd_description="Export the metrics of this extension in the Prometheus text format")
+    @interactions.check(interactions.is_owner())
+    async def cmd_metrics(self, ctx: interactions.SlashContext):
+        await ctx.send(
+            file=interactions.File(io.BytesIO(metrics.render_prometheus().encode("utf-8")), file_name="metrics.prom"),
+            ephemeral=True
+        )
+
     @module_group.subcommand("members_older_than", sub_cmd_description="(Operator) Get the list of members whose join date is longer than...")
     @interactions.max_concurrency(interactions.Buckets.GUILD, 2)
     @interactions.check(operator_check)
@@ -301,34 +418,208 @@ class Retr0initDiscordUtilities(interactions.Extension):
         required = False,
         opt_type = interactions.OptionType.INTEGER
     )
-    async def cmd_guild_membersOlderThan(self, ctx: interactions.SlashContext, weeks: int = 0, days: int = 30, hours: int = 0):
+    @interactions.slash_option(
+        name = "role",
+        description = "Only the members with this role",
+        required = False,
+        opt_type = interactions.OptionType.ROLE
+    )
+    @interactions.slash_option(
+        name = "bots",
+        description = "Whether to include the bots",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="true", value=1),
+            interactions.SlashCommandChoice(name="false", value=0)
+        ]
+    )
+    @interactions.slash_option(
+        name = "file_format",
+        description = "The format of the member list file",
+        required = False,
+        opt_type = interactions.OptionType.STRING,
+        choices = [
+            interactions.SlashCommandChoice(name="ID list", value=FORMAT_TXT),
+            interactions.SlashCommandChoice(name="CSV", value=FORMAT_CSV),
+            interactions.SlashCommandChoice(name="JSON Lines", value=FORMAT_JSONL)
+        ]
+    )
+    @interactions.slash_option(
+        name = "compress",
+        description = "Whether to gzip the member list file",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="true", value=1),
+            interactions.SlashCommandChoice(name="false", value=0)
+        ]
+    )
+    async def cmd_guild_membersOlderThan(self, ctx: interactions.SlashContext, weeks: int = 0, days: int = 30, hours: int = 0, role: Optional[interactions.Role] = None, bots: Optional[int] = 0, file_format: Optional[str] = FORMAT_TXT, compress: Optional[int] = 0):
         await ctx.defer()
         now: interactions.Timestamp = interactions.Timestamp.now()
         td: datetime.timedelta = datetime.timedelta(days=days, weeks=weeks, hours=hours)
         channel: interactions.TYPE_GUILD_CHANNEL = ctx.channel
-        valid_members: list[interactions.Member] = [mem for mem in ctx.guild.members if now - mem.joined_at >= td and not mem.bot]
-        valid_members_str: list[str] = [f"- {mem.display_name}({mem.username}) ({now.__sub__(mem.joined_at).days} days)" for mem in valid_members]
-        pag: Paginator = Paginator.create_from_string(self.bot, '\n'.join(valid_members_str), prefix=f"### Members joined more than {weeks}w{days}d{hours}h")
+        valid_members: list[tuple[float, int]] = (await member_index.get(ctx.guild)).older_than(
+            (now - td).timestamp(), include_bots=(bots == 1), role_id=role.id if role else None
+        )
+        def __member_line(item: tuple[float, int]) -> str:
+            joined, member_id = item
+            mem: Optional[interactions.Member] = ctx.guild.get_member(member_id)
+            name: str = f"{mem.display_name}({mem.username})" if mem is not None else str(member_id)
+            return f"- {name} ({int((now.timestamp() - joined) // 86400)} days)"
+        pag: Paginator = lazy_paginator(self.bot, valid_members, __member_line, prefix=f"### Members joined more than {weeks}w{days}d{hours}h")
         await pag.send(ctx)
-        async with aiofiles.tempfile.NamedTemporaryFile(prefix=f"users_{weeks}w_{days}d_{hours}h-", suffix=".txt", delete=False) as afp:
-            write_str: str = str([str(mem.id) for mem in valid_members])
-            await afp.write(str.encode(write_str))
+        def __member_rows():
+            for joined, member_id in valid_members:
+                mem: Optional[interactions.Member] = ctx.guild.get_member(member_id)
+                yield {
+                    "id": str(member_id),
+                    "username": mem.username if mem is not None else "",
+                    "joined_at": datetime.datetime.fromtimestamp(joined, datetime.timezone.utc).isoformat(),
+                    "days_in_guild": int((now.timestamp() - joined) // 86400)
+                }
+        # aiofiles is only needed by this command
+        import aiofiles.os
+        import aiofiles.tempfile
+        async with aiofiles.tempfile.NamedTemporaryFile(prefix=f"users_{weeks}w_{days}d_{hours}h-", suffix=file_suffix(file_format, compress == 1), delete=False) as afp:
+            await write_rows(afp, __member_rows(), MEMBER_FIELDS, file_format, compress=(compress == 1))
             filename: str = afp.name
             await afp.close()
             await channel.send(f"All members joined more than {weeks}w{days}d{hours}h", file=filename)
             await aiofiles.os.remove(filename)
         
+    @module_group.subcommand("bulk_roles", sub_cmd_description="(Privileged) Add or remove a role for all members whose join date is longer than...")
+    @interactions.check(my_check)
+    @interactions.slash_option(
+        name = "action",
+        description = "What to do with the roles of the members",
+        required = True,
+        opt_type = interactions.OptionType.STRING,
+        choices = [
+            interactions.SlashCommandChoice(name="add the role", value=ROLE_ADD),
+            interactions.SlashCommandChoice(name="remove the role", value=ROLE_REMOVE),
+            interactions.SlashCommandChoice(name="remove all roles", value=ROLE_REMOVE_ALL)
+        ]
+    )
+    @interactions.slash_option(
+        name = "role",
+        description = "The role to add or remove",
+        required = False,
+        opt_type = interactions.OptionType.ROLE
+    )
+    @interactions.slash_option(
+        name = "weeks",
+        description = "Joined longer than...",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER
+    )
+    @interactions.slash_option(
+        name = "days",
+        description = "Joined longer than...",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER
+    )
+    @interactions.slash_option(
+        name = "hours",
+        description = "Joined longer than...",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER
+    )
+    @interactions.slash_option(
+        name = "members_with",
+        description = "Only the members with this role",
+        required = False,
+        opt_type = interactions.OptionType.ROLE
+    )
+    @interactions.slash_option(
+        name = "bots",
+        description = "Whether to include the bots",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="true", value=1),
+            interactions.SlashCommandChoice(name="false", value=0)
+        ]
+    )
+    @interactions.slash_option(
+        name = "dry_run",
+        description = "Only count the members that would change",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="true", value=1),
+            interactions.SlashCommandChoice(name="false", value=0)
+        ]
+    )
+    async def cmd_guild_bulk_roles(self, ctx: interactions.SlashContext, action: str, role: Optional[interactions.Role] = None, weeks: int = 0, days: int = 0, hours: int = 0, members_with: Optional[interactions.Role] = None, bots: Optional[int] = 0, dry_run: Optional[int] = 0) -> None:
+        if action != ROLE_REMOVE_ALL and role is None:
+            await ctx.send("Please choose the role to add or remove!", ephemeral=True)
+            return
+        if role is not None and action != ROLE_REMOVE_ALL and not role.is_assignable:
+            await ctx.send(f"The role {role.name} is managed or not below the top role of the bot!", ephemeral=True)
+            return
+        # The members may be chunked before the first query
+        await ctx.defer()
+        now: interactions.Timestamp = interactions.Timestamp.now()
+        td: datetime.timedelta = datetime.timedelta(days=days, weeks=weeks, hours=hours)
+        member_ids: list[tuple[float, int]] = (await member_index.get(ctx.guild)).older_than(
+            (now - td).timestamp(), include_bots=(bots == 1), role_id=members_with.id if members_with else None
+        )
+        members: list[interactions.Member] = [_ for _ in (ctx.guild.get_member(m) for _, m in member_ids) if _ is not None]
+        what: str = "Removing all roles from"
+        if action == ROLE_ADD:
+            what = f"Adding {role.name} to"
+        elif action == ROLE_REMOVE:
+            what = f"Removing {role.name} from"
+        title: str = f"{'(Dry run) ' if dry_run == 1 else ''}{what} the members joined more than {weeks}w{days}d{hours}h"
+        status_msg: interactions.Message = await ctx.send(f"{title}...")
+        ctx_ch: interactions.MessageableMixin = ctx.channel
+        async def __run() -> None:
+            progress: ProgressReporter = ProgressReporter(status_msg, title, unit="members", total=len(members))
+            async def __report(stats: RoleEditStats) -> None:
+                progress.update(stats.handled, edited=stats.edited, unchanged=stats.unchanged, failed=stats.failed)
+            async with progress:
+                stats: RoleEditStats = await apply_role_edits(
+                    self.bot, ctx.guild, members,
+                    add=[role.id] if action == ROLE_ADD else (),
+                    remove=[role.id] if action == ROLE_REMOVE else (),
+                    remove_all=(action == ROLE_REMOVE_ALL),
+                    reason=f"Bulk role edit by {ctx.author.username}",
+                    dry_run=(dry_run == 1),
+                    on_progress=__report
+                )
+            await progress.finish()
+            await ctx_ch.send(
+                f"{title}: {stats.members} members, {stats.edited} {'would change' if dry_run == 1 else 'changed'}, "
+                f"{stats.unchanged} unchanged, {stats.failed} failed. {stats.roles_added} roles added, {stats.roles_removed} roles removed."
+            )
+        job, created = job_manager.submit(
+            f"bulk_roles:{ctx.guild_id}:{action}:{role.id if role else 0}:{dry_run}", "bulk_roles", ctx.guild_id, ctx.author.id, title, __run
+        )
+        if not created:
+            await status_msg.edit(content=f"The same role edit is already running in job `#{job.job_id}`.")
+
     @module_group.subcommand("delete_all_ur_msg", sub_cmd_description="Delete all your messages in this guild and soft ban you to further delete msg")
-    @interactions.max_concurrency(interactions.Buckets.GUILD, 2)
-    async def cmd_guild_deleteAllUrMsg(self, ctx: interactions.SlashContext) -> None:
+    @interactions.slash_option(
+        name = "reactions",
+        description = "When to remove your reactions from the other messages",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="after deleting the messages", value=1),
+            interactions.SlashCommandChoice(name="while deleting the messages", value=0)
+        ]
+    )
+    async def cmd_guild_deleteAllUrMsg(self, ctx: interactions.SlashContext, reactions: Optional[int] = 1) -> None:
         # TODO remove it after fully tested development
         await ctx.send("Please use `/utility channel delete_user_messages` instead! This command is currently still in development.", ephemeral=True)
         return
 
-        if ctx.author.id in self.cmd_guild_deleteAllUrMsg_members:
+        job_key: str = f"delete_all_ur_msg:{ctx.guild_id}:{ctx.author.id}"
+        if job_manager.find(job_key) is not None:
             await ctx.send("You are already running this command!", ephemeral=True)
             return
-        self.cmd_guild_deleteAllUrMsg_members.append(ctx.author.id)
         this_channel: interactions.GuildChannel = ctx.channel
         current_author: interactions.User = ctx.author
         confirmation_msg: str = "DELETE ME"
@@ -344,123 +635,51 @@ class Retr0initDiscordUtilities(interactions.Extension):
         try:
             modal_ctx: interactions.ModalContext = await ctx.bot.wait_for_modal(modal, timeout=modal_timeout)
         except asyncio.TimeoutError:
-            self.cmd_guild_deleteAllUrMsg_members.remove(current_author.id)
             return
         modal_text: str = list(modal_ctx.responses.values())[0]
         all_main_channels: list[interactions.GuildChannel] = await ctx.guild.fetch_channels()
-        async def __delete_reactions_from_message(msg: interactions.Message) -> None:
-            try:
-                for react in msg.reactions:
-                    usr_list: list[interactions.User] = await react.users().fetch()
-                    if any(current_author.id == usr.id for usr in usr_list):
-                        await msg.remove_reaction(react.emoji, member=current_author)
-            except Exception as e:
-                logger.error(traceback.format_exc())
-        def __is_delete(msg: Optional[interactions.Message], user_id: int) -> bool:
-            return msg and (msg.author.id == user_id or (msg.interaction_metadata and msg.interaction_metadata._user_id == user_id))
-        async def __delete_all_msgs_in_messagable(channel: interactions.MessageableMixin) -> None:
-            """
-            Delete all messages in MessagableMixin. Skip extra exceptions.
-            """
-            if channel is None:
-                logger.error("Channel is None")
+        reaction_cleaner: ReactionCleaner = ReactionCleaner(
+            self.bot, current_author.id, deferred=(reactions == 1), journal=job_journal, job_key=job_key
+        )
+        async def __run_sweep() -> None:
+            if await job_journal.start(job_key, "delete_all_ur_msg", ctx.guild_id):
+                await this_channel.send("Resuming the interrupted message deletion...")
+            progress: ProgressReporter = await ProgressReporter.send(this_channel, f"Deleting the messages of {current_author.mention} in this guild")
+            def __report_sweep(counts: SweepStats) -> None:
+                progress.update(counts.scanned, deleted=counts.deleted, channels=f"{counts.channels}/{counts.found}")
+            async with progress:
+                stats: SweepStats = await sweep_guild(
+                    self.bot, ctx.guild_id, all_main_channels, current_author.id, job_journal, job_key,
+                    reaction_cleaner=reaction_cleaner, index=message_index if MESSAGE_INDEX_ENABLED else None, on_progress=__report_sweep
+                )
+                # Reactions are removed in a lower priority pass after the messages
+                progress.update(reactions="removing")
+                with job_context(ctx.guild_id, f"{job_key}:reactions", PRIORITY_BACKGROUND):
+                    await reaction_cleaner.run_deferred()
+            progress.update(reactions=f"{reaction_cleaner.count_removed} removed")
+            if stats.incomplete:
+                # The cursors of the incomplete channels stay in the journal for the rerun
+                await progress.finish(f"{stats.incomplete} channels could not be read completely.")
+                await this_channel.send(
+                    f"{stats.incomplete} channels could not be read completely. Run the command again to resume them."
+                )
                 return
-            archived: bool = False
-            archived_operated: bool = False
-            skip_this_loop: bool = False
-            msg: interactions.Message = None
-            if isinstance(channel, interactions.ThreadChannel):
-                channel: interactions.ThreadChannel = cast(interactions.ThreadChannel, channel)
-                archived = channel.archived
-            history: interactions.ChannelHistory = channel.history(0)
-            while True:
-                try:
-                    if not skip_this_loop:
-                        msg = await history.__anext__()
-                        skip_this_loop = False
-                    if __is_delete(msg, current_author.id):
-                        if archived and not archived_operated:
-                            try:
-                                await channel.edit(archived=False)
-                                archived_operated = True
-                            except Exception:
-                                logger.error(traceback.format_exc())
-                                return
-                        await msg.delete()
-                    else:
-                        await __delete_reactions_from_message(msg)
-                except StopAsyncIteration:
-                    break
-                except interactions.errors.HTTPException as e:
-                    match int(e.code):
-                        case 50083:
-                            """Operation in archived thread"""
-                            skip_this_loop = True
-                            archived = True
-                            try:
-                                await channel.edit(archived=False)
-                            except Exception:
-                                logger.error(traceback.format_exc())
-                                return
-                        case 10003:
-                            """Unknown channel"""
-                            return
-                        case 10008:
-                            """Unknown message"""
-                            return
-                        case 50001:
-                            """No Access"""
-                            return
-                        case 50013:
-                            """Lack permission"""
-                            return
-                        case 50021:
-                            """Cannot execute on system message"""
-                            pass
-                        case 160005:
-                            """Thread is locked"""
-                            pass
-                        case _:
-                            """Default"""
-                            pass
-                except Exception:
-                    logger.error(traceback.format_exc())
-            if archived:
-                try:
-                    await channel.edit(archived=True)
-                except Exception:
-                    logger.error(traceback.format_exc())
-        if modal_text.strip() == confirmation_msg:
-            await modal_ctx.send("Deleting your messages...", ephemeral=True)
-            for ch in all_main_channels:
-                if isinstance(ch, interactions.MessageableMixin):
-                    ch = cast(interactions.MessageableMixin, ch)
-                    await __delete_all_msgs_in_messagable(ch)
-                    ch = cast(interactions.GuildText, ch)
-                    if isinstance(ch, interactions.GuildText):
-                        thread_list: interactions.ThreadList = await ch.fetch_active_threads()
-                        for thread in thread_list.threads:
-                            await __delete_all_msgs_in_messagable(thread)
-                        thread_list = await ch.fetch_archived_threads()
-                        for thread in thread_list.threads:
-                            await __delete_all_msgs_in_messagable(thread)
-                if isinstance(ch, interactions.GuildForum):
-                    ch: interactions.GuildForum = cast(interactions.GuildForum, ch)
-                    posts = ch.get_posts()
-                    for post in posts:
-                        await __delete_all_msgs_in_messagable(post)
-                    _posts = await self.bot.http.list_public_archived_threads(channel_id=ch.id)
-                    posts = [int(_["id"]) for _ in _posts["threads"]]
-                    for p in posts:
-                        post: interactions.GuildForumPost = await self.bot.fetch_channel(channel_id=p)
-                        await __delete_all_msgs_in_messagable(post)
+            await progress.finish("Message deletion complete!")
+            await job_journal.finish(job_key)
             await this_channel.send("Message deletion complete!")
             _dm_ch = current_author.get_dm()
             if _dm_ch:
                 await _dm_ch.send(f"Message delete in {this_channel.guild.name} completed!")
+        if modal_text.strip() == confirmation_msg:
+            job, created = job_manager.submit(
+                job_key, "delete_all_ur_msg", ctx.guild_id, current_author.id, f"Delete all messages of {current_author.mention}", __run_sweep
+            )
+            if created:
+                await modal_ctx.send(f"Deleting your messages in job `#{job.job_id}`...", ephemeral=True)
+            else:
+                await modal_ctx.send("You are already running this command!", ephemeral=True)
         else:
             await modal_ctx.send("Operation cancelled!", ephemeral=True)
-        self.cmd_guild_deleteAllUrMsg_members.remove(current_author.id)
 
     @module_group_c.subcommand("rate_limit", sub_cmd_description="(Privileged) Rate limit a channel")
     @interactions.check(my_check)
@@ -477,17 +696,38 @@ class Retr0initDiscordUtilities(interactions.Extension):
         opt_type = interactions.OptionType.INTEGER
     )
     async def cmd_channel_rate_limit(self, ctx: interactions.SlashContext, channel: interactions.TYPE_GUILD_CHANNEL, rate: int) -> None:
-        await ctx.send(f"Setting the rate limit of `{rate}` to {channel.mention}...")
-        ctx_ch: interactions.MessageableMixin = ctx.channel
-        rate = 0 if rate <= 0 else rate
-        if isinstance(channel, interactions.GuildForum) or hasattr(channel, "default_forum_layout"):
-            channel.rate_limit_per_user = rate
-            active_posts: list[interactions.GuildForumPost] = await channel.fetch_posts()
-            for post in active_posts:
-                await post.edit(rate_limit_per_user=rate)
-            await ctx_ch.send(f"Everyone in {channel.mention} can send message every `{rate}` seconds!")
+        if isinstance(channel, interactions.GuildCategory):
+            await ctx.send("This channel type is not implemented!")
             return
-        await ctx_ch.send("This channel type is not implemented!")
+        rate = 0 if rate <= 0 else rate
+        ctx_ch: interactions.MessageableMixin = ctx.channel
+        status_msg: interactions.Message = await ctx.send(f"Setting the rate limit of `{rate}` to {channel.mention}...")
+        async def __run() -> None:
+            data: dict = {"rate_limit_per_user": rate}
+            targets: list[EditTarget] = [EditTarget(int(channel.id))]
+            if isinstance(channel, (interactions.GuildForum, interactions.GuildText)):
+                # The new threads and posts inherit the rate limit
+                data["default_thread_rate_limit_per_user"] = rate
+                targets.extend(await collect_thread_targets(self.bot, channel))
+            progress: ProgressReporter = ProgressReporter(
+                status_msg, f"Setting the rate limit of `{rate}` to {channel.mention}", unit="channels", total=len(targets)
+            )
+            async def __report(edited: int, failed: int, total: int) -> None:
+                progress.update(edited + failed, edited=edited, failed=failed)
+            async with progress:
+                count_edited, count_failed = await apply_channel_edits(
+                    self.bot, targets, data, reason=f"Rate limit set by {ctx.author.username}", on_progress=__report
+                )
+            await progress.finish()
+            await ctx_ch.send(
+                f"Everyone in {channel.mention} can send message every `{rate}` seconds! "
+                f"{count_edited} channels updated. {count_failed} channels failed to update."
+            )
+        job, created = job_manager.submit(
+            f"rate_limit:{channel.id}:{rate}", "rate_limit", ctx.guild_id, ctx.author.id, f"Set the rate limit of `{rate}` to {channel.mention}", __run
+        )
+        if not created:
+            await status_msg.edit(content=f"The rate limit of `{rate}` is already being set to {channel.mention} in job `#{job.job_id}`.")
 
     @module_group_c.subcommand("archive", sub_cmd_description="(Privileged) Archive a forum post")
     @interactions.check(my_check)
@@ -530,12 +770,23 @@ class Retr0initDiscordUtilities(interactions.Extension):
         interactions.OptionType.STRING,
         required=True
     )
-    async def cmd_channel_delete_messages(self, ctx: interactions.SlashContext, user: interactions.Member, channel_id: str):
+    @interactions.slash_option(
+        "days",
+        "Only delete the messages of the last days. All messages by default.",
+        interactions.OptionType.INTEGER,
+        required=False,
+        min_value=1
+    )
+    async def cmd_channel_delete_messages(self, ctx: interactions.SlashContext, user: interactions.Member, channel_id: str, days: Optional[int] = None):
         try:
             channel = await self.bot.fetch_channel(channel_id)
         except:
             await ctx.send("Channel ID is invalid!", ephemeral=True)
             return
+        job_key: str = f"delete_user_messages:{channel.id}:{user.id}"
+        if job_manager.find(job_key) is not None:
+            await ctx.send(f"The messages of {user.mention} in {channel.mention} are already being deleted.", ephemeral=True)
+            return
         dm = await user.fetch_dm(force=True)
         button: interactions.Button = interactions.Button(
             style=interactions.ButtonStyle.DANGER,
@@ -553,29 +804,55 @@ class Retr0initDiscordUtilities(interactions.Extension):
         else:
             await ctx.channel.send("The user agreed to delete the message. Proceed with the deletion.")
             await component.ctx.send("The user agreed to delete the message. Proceed with the deletion.")
-            msg_to_delete: list[interactions.Message] = []
-            count_msg_deleted: int = 0
-            count_msg_not_deleted: int = 0
-            async for message in channel.history(limit=0):
-                if message.author.id == user.id:
-                    msg_to_delete.append(message)
-            archived: bool = False
-            if isinstance(channel, interactions.ThreadChannel):
-                archived = channel.archived
-            if archived:
-                await channel.edit(archived=False)
-            for msg in msg_to_delete:
-                if msg is None:
-                    continue
+            async def __run() -> None:
+                count_msg_deleted: int = 0
+                count_msg_not_deleted: int = 0
+                archived: bool = False
+                if isinstance(channel, interactions.ThreadChannel):
+                    archived = channel.archived
+                if archived:
+                    await channel.edit(archived=False)
+                # The thread is archived again also when the deletion fails or is cancelled
                 try:
-                    await channel.delete_message(msg)
-                    count_msg_deleted += 1
-                except:
-                    count_msg_not_deleted += 1
-            if archived:
-                await channel.edit(archived=True)
-            await dm.send(f"Messages Deleted. Deleted {count_msg_deleted} messages. {count_msg_not_deleted} messages failed to delete.")
-            await ctx.channel.send(f"Message deletion completed. Deleted {count_msg_deleted} messages. {count_msg_not_deleted} messages failed to delete.")
+                    if await job_journal.start(job_key, "delete_user_messages", ctx.guild_id or 0):
+                        await ctx.channel.send("Resuming the interrupted message deletion...")
+                    progress: ProgressReporter = await ProgressReporter.send(ctx.channel, f"Deleting the messages of {user.mention} in {channel.mention}")
+                    since: Optional[float] = time.time() - days * 86400 if days else None
+                    async with progress:
+                        indexed: Optional[list[int]] = None
+                        if MESSAGE_INDEX_ENABLED:
+                            indexed = await message_index.lookup(channel, ctx.guild_id, user.id, since=since)
+                        if indexed is not None:
+                            count_msg_deleted, count_msg_not_deleted = await delete_listed(
+                                self.bot, channel.id, indexed, kind="delete_user_messages", progress=progress
+                            )
+                        else:
+                            count_msg_deleted, count_msg_not_deleted = await scan_and_delete(
+                                self.bot, channel, lambda message: message.author_id == user.id,
+                                cursor=await job_journal.get_cursor(job_key, channel.id),
+                                on_checkpoint=lambda cur: job_journal.save_cursor(job_key, cur),
+                                kind="delete_user_messages",
+                                progress=progress,
+                                since=since,
+                                index=message_index if MESSAGE_INDEX_ENABLED else None
+                            )
+                    await progress.finish(f"Deleted {count_msg_deleted} messages. {count_msg_not_deleted} messages failed to delete.")
+                    await job_journal.finish(job_key)
+                finally:
+                    if archived:
+                        try:
+                            await channel.edit(archived=True)
+                        except Exception:
+                            log_pipeline.exception(logger)
+                await dm.send(f"Messages Deleted. Deleted {count_msg_deleted} messages. {count_msg_not_deleted} messages failed to delete.")
+                await ctx.channel.send(f"Message deletion completed. Deleted {count_msg_deleted} messages. {count_msg_not_deleted} messages failed to delete.")
+            job, created = job_manager.submit(
+                job_key, "delete_user_messages", ctx.guild_id, ctx.author.id, f"Delete the messages of {user.mention} in {channel.mention}", __run
+            )
+            if created:
+                await ctx.channel.send(f"The messages are deleted in job `#{job.job_id}`.")
+            else:
+                await ctx.channel.send(f"The messages of {user.mention} in {channel.mention} are already being deleted in job `#{job.job_id}`.")
         finally:
             button.disabled = True
             await dm_msg.edit(components=button)
@@ -597,16 +874,6 @@ class Retr0initDiscordUtilities(interactions.Extension):
         required=True
     )
     async def cmd_channel_migrate(self, ctx: interactions.SlashContext, origin: interactions.GuildChannel, destination: interactions.GuildChannel) -> None:
-        global libmigrate
-        global libmigrate_loaded
-        if not libmigrate_loaded:
-            libmigrate, libmigrate_loaded = __import_git_module("https://github.com/retr0-init/libdiscord-ipy-migrate.git")
-            if not libmigrate_loaded:
-                await ctx.send(
-                    "Required library https://github.com/retr0-init/libdiscord-ipy-migrate.git not loaded. Please contact the admin to load it!",
-                    ephemeral=True,
-                    suppress_embeds=True)
-                return
         valid_dest_types: list = [interactions.GuildText, interactions.GuildForum]
         valid_orig_types: list = [interactions.GuildForumPost, interactions.GuildPublicThread]
         if not any(isinstance(origin, _) for _ in valid_orig_types + valid_dest_types):
@@ -645,17 +912,84 @@ class Retr0initDiscordUtilities(interactions.Extension):
             )
             return
         
-        await ctx.send(f"Migrating {origin.mention} to {destination.mention}...", ephemeral=True)
-        ch_send = ctx.channel
-        if check_valid(valid_orig_dest_pair[:2]):
-            await libmigrate.migrate_channel(origin, destination, ctx.bot)
-            await ch_send.send("Migration completed!")
+        if not check_valid(valid_orig_dest_pair[:2]) and not check_valid(valid_orig_dest_pair[2:]):
+            await ctx.send("Something went wrong. Please contact the admin!", ephemeral=True)
             return
-        if check_valid(valid_orig_dest_pair[2:]):
-            await libmigrate.migrate_thread(origin, destination)
-            await ch_send.send("Migration completed!")
+        ch_send = ctx.channel
+        job_key: str = f"migrate:{origin.id}:{destination.id}"
+        async def __run() -> None:
+            if await job_journal.start(job_key, "migrate", ctx.guild_id):
+                await ch_send.send(f"Resuming the interrupted migration of {origin.mention} to {destination.mention}...")
+            progress: ProgressReporter = await ProgressReporter.send(ch_send, f"Migrating {origin.mention} to {destination.mention}")
+            async with progress:
+                stats: MigrationStats = await migrate_channel(ctx.bot, origin, destination, job_journal, job_key, progress=progress)
+            if stats.posts_failed:
+                # The cursors of the failed posts stay in the journal for the rerun
+                names: str = ", ".join(stats.posts_failed[:10]) + (f" and {len(stats.posts_failed) - 10} more" if len(stats.posts_failed) > 10 else "")
+                await progress.finish(f"{len(stats.posts_failed)} posts failed to migrate: {names}")
+                await ch_send.send(
+                    f"{len(stats.posts_failed)} posts of {origin.mention} failed to migrate: {names}. Run the command again to resume them."
+                )
+                return
+            await job_journal.finish(job_key)
+            await progress.finish(f"Migration completed! Migrated {stats.migrated} messages. {stats.failed} messages failed to migrate.")
+        job, created = job_manager.submit(job_key, "migrate", ctx.guild_id, ctx.author.id, f"Migrate {origin.mention} to {destination.mention}", __run)
+        if created:
+            await ctx.send(f"Migrating {origin.mention} to {destination.mention} in job `#{job.job_id}`...", ephemeral=True)
+        else:
+            await ctx.send(f"{origin.mention} is already being migrated to {destination.mention} in job `#{job.job_id}`.", ephemeral=True)
+
+    @module_group_c.subcommand("export", sub_cmd_description="(Privileged) Export the message history of a channel or thread")
+    @interactions.check(my_check)
+    @interactions.slash_option(
+        name = "channel",
+        description = "The channel or thread to export. Defaults to the current channel",
+        required = False,
+        opt_type = interactions.OptionType.CHANNEL
+    )
+    @interactions.slash_option(
+        name = "attachments",
+        description = "Whether to include the attachment URLs",
+        required = False,
+        opt_type = interactions.OptionType.INTEGER,
+        choices = [
+            interactions.SlashCommandChoice(name="true", value=1),
+            interactions.SlashCommandChoice(name="false", value=0)
+        ]
+    )
+    async def cmd_channel_export(self, ctx: interactions.SlashContext, channel: Optional[interactions.GuildChannel] = None, attachments: Optional[int] = 0) -> None:
+        channel = channel or ctx.channel
+        if not isinstance(channel, interactions.MessageableMixin):
+            await ctx.send("This channel has no messages to export!", ephemeral=True)
             return
-        await ctx.send("Something went wrong. Please contact the admin!", ephemeral=True)
+        ch_send: interactions.MessageableMixin = ctx.channel
+        filesize_limit: int = ctx.guild.filesize_limit
+        job_key: str = f"export:{channel.id}:{attachments}"
+        async def __run() -> None:
+            if await job_journal.start(job_key, "export", ctx.guild_id):
+                await ch_send.send(f"Resuming the interrupted export of {channel.mention}...")
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            path: str = f"{EXPORT_DIR}/{channel.id}{'_attachments' if attachments == 1 else ''}.jsonl.gz"
+            progress: ProgressReporter = await ProgressReporter.send(ch_send, f"Exporting {channel.mention}")
+            async with progress:
+                stats: ExportStats = await export_channel(
+                    ctx.bot, channel, job_journal, job_key, path, attachment_urls=(attachments == 1), progress=progress
+                )
+            await job_journal.finish(job_key)
+            await progress.finish(f"Exported {stats.messages} messages of {channel.mention}.")
+            if not stats.messages:
+                await ch_send.send(f"{channel.mention} has no messages to export.")
+                os.remove(path)
+            elif stats.size <= filesize_limit:
+                await ch_send.send(f"The message history of {channel.mention}", file=path)
+                os.remove(path)
+            else:
+                await ch_send.send(f"The export of {channel.mention} is too large to upload. It is saved as `{path}` on the bot host.")
+        job, created = job_manager.submit(job_key, "export", ctx.guild_id, ctx.author.id, f"Export {channel.mention}", __run)
+        if created:
+            await ctx.send(f"Exporting {channel.mention} in job `#{job.job_id}`...", ephemeral=True)
+        else:
+            await ctx.send(f"{channel.mention} is already being exported in job `#{job.job_id}`.", ephemeral=True)
 
     @module_group_u.subcommand(
         "remove_all_roles", sub_cmd_description="(Privileged) Remove all of the roles from a user"
@@ -668,5 +1002,45 @@ class Retr0initDiscordUtilities(interactions.Extension):
         required=True
     )
     async def cmd_user_remove_all_roles(self, ctx: interactions.SlashContext, user: interactions.Member) -> None:
-        await user.remove_roles(user.roles)
+        # One member edit instead of one request per role
+        stats: RoleEditStats = await apply_role_edits(self.bot, ctx.guild, [user], remove_all=True, reason=f"Roles removed by {ctx.author.username}")
+        if stats.failed:
+            await ctx.send(f"Failed to remove the roles of {user.display_name}!")
+            return
         await ctx.send(f"User {user.display_name} removed all roles")
+
+    @module_group_j.subcommand("list", sub_cmd_description="(Privileged) List the background jobs of this guild")
+    @interactions.check(my_check)
+    async def cmd_jobs_list(self, ctx: interactions.SlashContext) -> None:
+        jobs: list[Job] = sorted(job_manager.list(ctx.guild_id), key=lambda _: (not _.active, -_.job_id))
+        def __job_line(job: Job) -> str:
+            since: float = job.started if job.status == JOB_RUNNING else job.finished if job.finished else job.created
+            line: str = f"- `#{job.job_id}` **{job.status}** <t:{int(since)}:R> {job.description} by <@{job.user_id}>"
+            return f"{line} (`{job.error}`)" if job.error else line
+        pag: Paginator = lazy_paginator(self.bot, jobs, __job_line, prefix="### Background jobs", empty="No jobs")
+        await pag.send(ctx)
+
+    @module_group_j.subcommand("cancel", sub_cmd_description="Cancel a background job of this guild")
+    @interactions.slash_option(
+        name = "job_id",
+        description = "The number of the job in `/utility jobs list`",
+        required = True,
+        opt_type = interactions.OptionType.INTEGER,
+        min_value = 1
+    )
+    async def cmd_jobs_cancel(self, ctx: interactions.SlashContext, job_id: int) -> None:
+        job: Optional[Job] = job_manager.jobs.get(job_id)
+        if job is None or job.guild_id != int(ctx.guild_id or 0):
+            await ctx.send(f"Job `#{job_id}` is not found!", ephemeral=True)
+            return
+        # Only the user who started the job or the privileged users can cancel it
+        if job.user_id != int(ctx.author.id) and not await my_check(ctx):
+            await ctx.send("You can only cancel your own jobs!", ephemeral=True)
+            return
+        if job_manager.cancel(job_id):
+            await ctx.send(f"Job `#{job_id}` is cancelled.")
+        else:
+            await ctx.send(f"Job `#{job_id}` is already {job.status}.", ephemeral=True)
+
+# Everything above runs when the extension is loaded or reloaded
+IMPORT_SECONDS: float = time.perf_counter() - _import_started
@@ -0,0 +1,157 @@
+'''
+Join-date index of the guild members. The members are kept sorted by their
+join date, so an "older than" query is a bisect and a slice.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import bisect
+import math
+import os
+from typing import Iterable, Optional
+from src import logutil
+
+from .logqueue import log_pipeline
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+# Seconds to wait for the members of a guild to be chunked before indexing it
+MEMBER_CHUNK_TIMEOUT: float = 60.0
+
+class GuildJoinIndex:
+    def __init__(self) -> None:
+        # Sorted (joined_at timestamp, member_id) of all members and of the human members
+        self.all_members: list[tuple[float, int]] = []
+        self.humans: list[tuple[float, int]] = []
+        # member_id -> (joined_at timestamp, is_bot, role_ids)
+        self.members: dict[int, tuple[float, bool, frozenset[int]]] = {}
+        self.role_members: dict[int, set[int]] = {}
+
+    @classmethod
+    def from_members(cls, members: Iterable[interactions.Member]) -> "GuildJoinIndex":
+        '''
+        Index the members of a guild, sorting the join dates once. `add()` keeps the lists sorted for the events.
+        '''
+        idx: GuildJoinIndex = cls()
+        for member in members:
+            if member.joined_at is None:
+                continue
+            roles: frozenset[int] = frozenset(int(_) for _ in member._role_ids)
+            idx.members[int(member.id)] = (member.joined_at.timestamp(), member.bot, roles)
+        idx.all_members = sorted((joined, member_id) for member_id, (joined, _, _) in idx.members.items())
+        idx.humans = [_ for _ in idx.all_members if not idx.members[_[1]][1]]
+        for member_id, (_, _, roles) in idx.members.items():
+            for role_id in roles:
+                idx.role_members.setdefault(role_id, set()).add(member_id)
+        return idx
+
+    def add(self, member: interactions.Member) -> None:
+        member_id: int = int(member.id)
+        if member_id in self.members:
+            self.remove(member_id)
+        if member.joined_at is None:
+            return
+        joined: float = member.joined_at.timestamp()
+        roles: frozenset[int] = frozenset(int(_) for _ in member._role_ids)
+        self.members[member_id] = (joined, member.bot, roles)
+        bisect.insort(self.all_members, (joined, member_id))
+        if not member.bot:
+            bisect.insort(self.humans, (joined, member_id))
+        for role_id in roles:
+            self.role_members.setdefault(role_id, set()).add(member_id)
+
+    def _remove_sorted(self, sorted_list: list[tuple[float, int]], item: tuple[float, int]) -> None:
+        pos: int = bisect.bisect_left(sorted_list, item)
+        if pos < len(sorted_list) and sorted_list[pos] == item:
+            del sorted_list[pos]
+
+    def remove(self, member_id: int) -> None:
+        entry: Optional[tuple[float, bool, frozenset[int]]] = self.members.pop(int(member_id), None)
+        if entry is None:
+            return
+        joined, is_bot, roles = entry
+        self._remove_sorted(self.all_members, (joined, int(member_id)))
+        if not is_bot:
+            self._remove_sorted(self.humans, (joined, int(member_id)))
+        for role_id in roles:
+            self.role_members.get(role_id, set()).discard(int(member_id))
+
+    def update_roles(self, member: interactions.Member) -> None:
+        entry: Optional[tuple[float, bool, frozenset[int]]] = self.members.get(int(member.id))
+        if entry is None:
+            self.add(member)
+            return
+        joined, is_bot, old_roles = entry
+        roles: frozenset[int] = frozenset(int(_) for _ in member._role_ids)
+        for role_id in old_roles - roles:
+            self.role_members.get(role_id, set()).discard(int(member.id))
+        for role_id in roles - old_roles:
+            self.role_members.setdefault(role_id, set()).add(int(member.id))
+        self.members[int(member.id)] = (joined, is_bot, roles)
+
+    def older_than(self, cutoff: float, *, include_bots: bool = False, role_id: Optional[int] = None) -> list[tuple[float, int]]:
+        '''
+        (joined_at timestamp, member_id) of the members who joined at or before the cutoff timestamp, oldest first
+        '''
+        sorted_list: list[tuple[float, int]] = self.all_members if include_bots else self.humans
+        res: list[tuple[float, int]] = sorted_list[:bisect.bisect_right(sorted_list, (cutoff, math.inf))]
+        if role_id is not None:
+            role_members: set[int] = self.role_members.get(int(role_id), set())
+            res = [_ for _ in res if _[1] in role_members]
+        return res
+
+class MemberIndex:
+    '''
+    Join-date indices of the guilds. A guild is indexed at its first query and then kept up to date by the gateway events.
+    The members received in the gateway chunks fire no member events, so a guild is only indexed once it is chunked.
+    '''
+    def __init__(self, chunk_timeout: float = MEMBER_CHUNK_TIMEOUT) -> None:
+        self.guilds: dict[int, GuildJoinIndex] = {}
+        self.chunk_timeout: float = chunk_timeout
+
+    async def get(self, guild: interactions.Guild) -> GuildJoinIndex:
+        idx: Optional[GuildJoinIndex] = self.guilds.get(int(guild.id))
+        if idx is not None:
+            return idx
+        if not guild.chunked.is_set():
+            try:
+                await asyncio.wait_for(guild.gateway_chunk(presences=False), self.chunk_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"The members of {guild.id} are not chunked after {self.chunk_timeout} seconds")
+        idx = GuildJoinIndex.from_members(guild.members)
+        if guild.chunked.is_set():
+            # An index of a partial member cache is built again at the next query
+            self.guilds[int(guild.id)] = idx
+        return idx
+
+    def on_member_add(self, guild_id: int, member: interactions.Member) -> None:
+        idx: Optional[GuildJoinIndex] = self.guilds.get(int(guild_id))
+        if idx is not None:
+            idx.add(member)
+
+    def on_member_remove(self, guild_id: int, member_id: int) -> None:
+        idx: Optional[GuildJoinIndex] = self.guilds.get(int(guild_id))
+        if idx is not None:
+            idx.remove(member_id)
+
+    def on_member_update(self, guild_id: int, member: interactions.Member) -> None:
+        idx: Optional[GuildJoinIndex] = self.guilds.get(int(guild_id))
+        if idx is not None:
+            idx.update_roles(member)
+
+    def drop_guild(self, guild_id: int) -> None:
+        self.guilds.pop(int(guild_id), None)
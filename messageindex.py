@@ -0,0 +1,317 @@
+'''
+Local index of the message metadata. The deletions look up the messages of a
+user in it instead of scanning the whole history of the channel.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import itertools
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Union
+
+from .history import MessageMeta, ShardedHistory, time_snowflake
+
+FLUSH_DELAY: float = 2.0
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    interaction_user_id INTEGER,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (channel_id, author_id);
+CREATE INDEX IF NOT EXISTS messages_interaction_user ON messages (channel_id, interaction_user_id);
+CREATE TABLE IF NOT EXISTS scanned_messages (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    interaction_user_id INTEGER,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scanned_messages_channel ON scanned_messages (channel_id);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    synced_until INTEGER NOT NULL
+);
+"""
+
+def message_metadata(guild_id: Optional[int], message: Union[interactions.Message, MessageMeta]) -> tuple[int, int, int, int, Optional[int], float]:
+    '''
+    The row of the message in the index
+    '''
+    if not isinstance(message, MessageMeta):
+        message = MessageMeta.from_message(message)
+    return (message.id, int(guild_id or 0), message.channel_id, message.author_id, message.interaction_user_id, message.timestamp)
+
+class MessageIndex:
+    '''
+    Every message older than `synced_until` of a channel is in the index. A full history scan records the
+    messages and sets it. The messages created after it are recorded from the gateway events, which are
+    only complete since the current gateway session started. Older gaps are filled by scanning the history
+    after `synced_until` before a lookup.
+    The rows of a full scan are staged apart, and replace the rows of the channel once the scan is complete,
+    so the messages deleted while the channel was not recorded do not stay in the index.
+    The writes are queued and written in one transaction, like the guild settings.
+    '''
+    def __init__(self, filename: str) -> None:
+        self.filename: str = filename
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-index")
+        # channel_id -> (guild_id, synced_until). The events are only recorded for these channels.
+        self._synced: Optional[dict[int, tuple[int, int]]] = None
+        # Channels being scanned in full. Their events are recorded too.
+        self._tracked: set[int] = set()
+        # channel_id -> IDs of the messages deleted during the scan of a tracked channel. The scan may still
+        # read them after the deletion was written, so they are not staged again.
+        self._deleted: dict[int, set[int]] = {}
+        self._session_start: Optional[int] = None
+        # ("add", row), ("stage", row), ("remove", channel_id, message_ids) or ("sync", ...) waiting for the next flush
+        self._pending: list[tuple] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    async def _run(self, func: Callable[..., Any], *args) -> Any:
+        def __call() -> Any:
+            conn: sqlite3.Connection = self._connect()
+            with conn:
+                return func(conn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, __call)
+
+    async def load(self) -> None:
+        '''
+        Read the synced channels, before the events are recorded
+        '''
+        if self._synced is None:
+            def __load(conn: sqlite3.Connection) -> list[tuple[int, int, int]]:
+                # No scan survives a restart
+                conn.execute("DELETE FROM scanned_messages")
+                return conn.execute("SELECT channel_id, guild_id, synced_until FROM channels").fetchall()
+            rows: list[tuple[int, int, int]] = await self._run(__load)
+            self._synced = {channel_id: (guild_id, synced_until) for channel_id, guild_id, synced_until in rows}
+            # The events are recorded from now on
+            self.session_started()
+
+    def session_started(self) -> None:
+        '''
+        A new gateway session does not replay the events missed while disconnected
+        '''
+        self._session_start = max(self._session_start or 0, time_snowflake(time.time()))
+
+    def _recorded(self, channel_id: int) -> bool:
+        return channel_id in self._tracked or (self._synced is not None and channel_id in self._synced)
+
+    def _add(self, row: tuple[int, int, int, int, Optional[int], float]) -> None:
+        channel_id: int = row[2]
+        if channel_id in self._tracked:
+            if row[0] not in self._deleted.get(channel_id, ()):
+                self._queue(("stage", row))
+        if self.is_synced(channel_id):
+            self._queue(("add", row))
+
+    def on_message_create(self, guild_id: Optional[int], message: interactions.Message) -> None:
+        if self._recorded(int(message._channel_id)):
+            self._add(message_metadata(guild_id, message))
+
+    def on_message_delete(self, channel_id: int, message_ids: list[int]) -> None:
+        if self._recorded(int(channel_id)):
+            if int(channel_id) in self._deleted:
+                self._deleted[int(channel_id)].update(int(_) for _ in message_ids)
+            self._queue(("remove", int(channel_id), [int(_) for _ in message_ids]))
+
+    def record(self, guild_id: Optional[int], message: Union[interactions.Message, MessageMeta]) -> None:
+        '''
+        Record a message read from the history
+        Only the channels whose deletions are recorded keep the message, i.e. the synced channels and the
+        tracked ones, whose rows are staged until the scan is complete
+        '''
+        row: tuple[int, int, int, int, Optional[int], float] = message_metadata(guild_id, message)
+        if self._recorded(row[2]):
+            self._add(row)
+
+    def track(self, channel_id: int) -> int:
+        '''
+        Start recording the events of the channel before its first full scan
+        Returns the `synced_until` of the channel once the scan is complete
+        '''
+        self._tracked.add(int(channel_id))
+        self._deleted[int(channel_id)] = set()
+        return time_snowflake(time.time())
+
+    def untrack(self, channel_id: int) -> None:
+        '''
+        Drop the staged rows of a scan that did not complete
+        '''
+        if int(channel_id) in self._tracked:
+            self._tracked.discard(int(channel_id))
+            self._deleted.pop(int(channel_id), None)
+            self._queue(("drop_scan", int(channel_id)))
+
+    @staticmethod
+    def _set_synced(conn: sqlite3.Connection, channel_id: int, guild_id: int, synced_until: int, replace: bool) -> None:
+        if replace:
+            # The staged rows of the complete scan replace the rows of the channel
+            conn.execute("DELETE FROM messages WHERE channel_id = ?", (channel_id,))
+            conn.execute("INSERT OR REPLACE INTO messages SELECT * FROM scanned_messages WHERE channel_id = ?", (channel_id,))
+            conn.execute("DELETE FROM scanned_messages WHERE channel_id = ?", (channel_id,))
+        conn.execute(
+            "INSERT OR REPLACE INTO channels (channel_id, guild_id, synced_until) VALUES (?, ?, ?)", (channel_id, guild_id, synced_until)
+        )
+
+    async def mark_synced(self, channel_id: int, guild_id: Optional[int], synced_until: int) -> None:
+        '''
+        Mark the channel synced after a complete scan, in one transaction with the rows of a tracked scan
+        '''
+        await self.load()
+        replace: bool = int(channel_id) in self._tracked
+        # Queued behind the staged rows. The events from now on are written to the rows of the channel.
+        self._queue(("sync", int(channel_id), int(guild_id or 0), synced_until, replace))
+        self._synced[int(channel_id)] = (int(guild_id or 0), synced_until)
+        self._tracked.discard(int(channel_id))
+        self._deleted.pop(int(channel_id), None)
+        await self.flush()
+
+    def is_synced(self, channel_id: int) -> bool:
+        return self._synced is not None and int(channel_id) in self._synced
+
+    async def catch_up(self, channel: interactions.MessageableMixin, guild_id: Optional[int]) -> None:
+        '''
+        Scan the history after `synced_until` if the events since then may be missing
+        '''
+        synced_until: int = self._synced[int(channel.id)][1]
+        if self._session_start is not None and synced_until >= self._session_start:
+            return
+        until: int = time_snowflake(time.time())
+        history: ShardedHistory = ShardedHistory(channel, after=synced_until - 1, raw=True)
+        try:
+            async for message in history:
+                self.record(guild_id, message)
+        finally:
+            history.close()
+        if history.complete:
+            # The events of the current session cover the rest
+            await self.mark_synced(channel.id, guild_id, until)
+
+    @staticmethod
+    def _lookup(conn: sqlite3.Connection, channel_id: int, user_id: int, include_interactions: bool, since: Optional[float]) -> list[int]:
+        query: str = "SELECT message_id FROM messages WHERE channel_id = ? AND (author_id = ?"
+        params: list = [channel_id, user_id]
+        if include_interactions:
+            query += " OR interaction_user_id = ?"
+            params.append(user_id)
+        query += ")"
+        if since is not None:
+            query += " AND timestamp >= ?"
+            params.append(since)
+        return [_[0] for _ in conn.execute(query + " ORDER BY message_id DESC", params)]
+
+    async def lookup(
+        self, channel: interactions.MessageableMixin, guild_id: Optional[int], user_id: int, *, include_interactions: bool = False, since: Optional[float] = None
+    ) -> Optional[list[int]]:
+        '''
+        IDs of the messages of the user in the channel, newest first, or None if the channel is not indexed
+        With `include_interactions`, the messages of the commands run by the user are included
+        '''
+        await self.load()
+        if not self.is_synced(channel.id):
+            return None
+        await self.catch_up(channel, guild_id)
+        await self.flush()
+        return await self._run(self._lookup, int(channel.id), int(user_id), include_interactions, since)
+
+    def forget_channel(self, channel_id: int) -> None:
+        tracked: bool = int(channel_id) in self._tracked
+        self._tracked.discard(int(channel_id))
+        self._deleted.pop(int(channel_id), None)
+        if (self._synced is not None and self._synced.pop(int(channel_id), None) is not None) or tracked:
+            self._queue(("forget_channel", int(channel_id)))
+
+    def forget_guild(self, guild_id: int) -> None:
+        if self._synced is not None:
+            for channel_id in [k for k, v in self._synced.items() if v[0] == int(guild_id)]:
+                del self._synced[channel_id]
+        self._queue(("forget_guild", int(guild_id)))
+
+    def _queue(self, op: tuple) -> None:
+        self._pending.append(op)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # Coalesce the burst of events into one transaction
+        await asyncio.sleep(FLUSH_DELAY)
+        await self.flush()
+
+    def _write(self, ops: list[tuple]) -> None:
+        conn: sqlite3.Connection = self._connect()
+        with conn:
+            # The operations are written in order, the consecutive rows in one statement
+            for kind, group in itertools.groupby(ops, key=lambda _: _[0]):
+                if kind in ("add", "stage"):
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO {'messages' if kind == 'add' else 'scanned_messages'} "
+                        "(message_id, guild_id, channel_id, author_id, interaction_user_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                        (_[1] for _ in group)
+                    )
+                    continue
+                for op in group:
+                    if kind == "remove":
+                        conn.executemany("DELETE FROM messages WHERE message_id = ?", ((_,) for _ in op[2]))
+                        conn.executemany("DELETE FROM scanned_messages WHERE message_id = ?", ((_,) for _ in op[2]))
+                    elif kind == "sync":
+                        self._set_synced(conn, *op[1:])
+                    elif kind == "drop_scan":
+                        conn.execute("DELETE FROM scanned_messages WHERE channel_id = ?", (op[1],))
+                    elif kind == "forget_channel":
+                        conn.execute("DELETE FROM messages WHERE channel_id = ?", (op[1],))
+                        conn.execute("DELETE FROM scanned_messages WHERE channel_id = ?", (op[1],))
+                        conn.execute("DELETE FROM channels WHERE channel_id = ?", (op[1],))
+                    elif kind == "forget_guild":
+                        conn.execute("DELETE FROM messages WHERE guild_id = ?", (op[1],))
+                        conn.execute("DELETE FROM scanned_messages WHERE guild_id = ?", (op[1],))
+                        conn.execute("DELETE FROM channels WHERE guild_id = ?", (op[1],))
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        ops: list[tuple] = self._pending
+        self._pending = []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, ops)
+
+    def close(self) -> None:
+        '''
+        Write the pending changes synchronously, e.g. when the extension is unloaded
+        '''
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        ops: list[tuple] = self._pending
+        self._pending = []
+        self._executor.submit(self._write, ops).result()
+        self._executor.shutdown()
@@ -0,0 +1,141 @@
+'''
+Metrics of the commands, the API calls and the bulk jobs. They can be rendered
+in the Prometheus text format or dumped to a JSON file.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import bisect
+import json
+import logging
+import time
+from typing import Optional
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+Labels = tuple[tuple[str, str], ...]
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _render_labels(labels: Labels, extra: Optional[tuple[str, str]] = None) -> str:
+    items: list[tuple[str, str]] = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.started: float = time.time()
+        self._last_snapshot: tuple[float, dict[str, dict[Labels, float]]] = (time.monotonic(), {})
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        series: dict[Labels, float] = self.counters.setdefault(name, {})
+        key: Labels = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        series: dict[Labels, Histogram] = self.histograms.setdefault(name, {})
+        key: Labels = _labels(labels)
+        hist: Optional[Histogram] = series.get(key)
+        if hist is None:
+            hist = series[key] = Histogram()
+        hist.observe(value)
+
+    def render_prometheus(self) -> str:
+        lines: list[str] = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_render_labels(labels)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in series.items():
+                cumulative: int = 0
+                for bound, count in zip(hist.buckets + (float("inf"),), hist.counts):
+                    cumulative += count
+                    le: str = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{name}_bucket{_render_labels(labels, ('le', le))} {cumulative}")
+                lines.append(f"{name}_sum{_render_labels(labels)} {hist.sum}")
+                lines.append(f"{name}_count{_render_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        '''
+        The metrics as a dict. The counters also get their rate per second since the previous snapshot.
+        '''
+        now: float = time.monotonic()
+        last_time, last_counters = self._last_snapshot
+        elapsed: float = max(now - last_time, 1e-9)
+        counters: dict = {}
+        for name, series in self.counters.items():
+            counters[name] = [
+                {
+                    "labels": dict(labels),
+                    "value": value,
+                    "rate": (value - last_counters.get(name, {}).get(labels, 0)) / elapsed
+                }
+                for labels, value in series.items()
+            ]
+        self._last_snapshot = (now, {k: dict(v) for k, v in self.counters.items()})
+        histograms: dict = {
+            name: [
+                {
+                    "labels": dict(labels),
+                    "count": hist.count,
+                    "sum": hist.sum,
+                    "buckets": dict(zip([str(_) for _ in hist.buckets] + ["+Inf"], hist.counts))
+                }
+                for labels, hist in series.items()
+            ]
+            for name, series in self.histograms.items()
+        }
+        return {"time": time.time(), "started": self.started, "counters": counters, "histograms": histograms}
+
+    async def dump_json(self, filename: str) -> None:
+        import aiofiles
+        async with aiofiles.open(filename, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(self.snapshot()))
+
+class RateLimitLogCounter(logging.Handler):
+    '''
+    Count the 429 responses. The HTTP client retries them internally and only logs a warning.
+    '''
+    def __init__(self, registry: "Metrics") -> None:
+        super().__init__(logging.WARNING)
+        self.registry: Metrics = registry
+
+    def emit(self, record: logging.LogRecord) -> None:
+        msg: str = record.getMessage()
+        if "global ratelimit" in msg:
+            self.registry.inc("utility_ratelimit_hits_total", scope="global")
+        elif "rate limited" in msg or "exceeded its ratelimit" in msg:
+            self.registry.inc("utility_ratelimit_hits_total", scope="route")
+
+metrics: Metrics = Metrics()
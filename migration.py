@@ -0,0 +1,302 @@
+'''
+Channel migration pipeline. The history of the origin is prefetched ahead into
+a bounded buffer while the earlier messages are reposted to the destination.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import io
+import os
+import re
+import traceback
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional, Union
+from src import logutil
+
+from .history import HISTORY_PAGE_SIZE
+from .journal import STATUS_DONE, ChannelCursor, JobJournal
+from .logqueue import log_pipeline
+from .metrics import metrics
+from .progress import ProgressReporter, history_fraction
+from .scheduler import request_scheduler
+from .threads import thread_directory
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+# Messages read ahead of the reposted one. Their attachments are downloaded while they wait.
+PREFETCH_BUFFER: int = 50
+DOWNLOAD_CONCURRENCY: int = 4
+# Forum posts migrated at the same time. The messages of one post are always reposted in order.
+POST_CONCURRENCY: int = 4
+# Reposted messages between the saved cursors. A resumed migration reposts at most this many messages twice.
+MIGRATE_CHECKPOINT_EVERY: int = 50
+MESSAGE_LENGTH_MAX: int = 2000
+WEBHOOK_NAME: str = "Utility Migration"
+
+MIGRATED_TYPES: tuple[interactions.MessageType, ...] = (
+    interactions.MessageType.DEFAULT,
+    interactions.MessageType.REPLY,
+    interactions.MessageType.APPLICATION_COMMAND,
+    interactions.MessageType.CONTEXT_MENU_COMMAND,
+)
+
+@dataclass
+class RepostPayload:
+    message_id: int
+    content: Optional[str]
+    embeds: list[interactions.Embed]
+    files: list[interactions.File]
+    username: str
+    avatar_url: Optional[str]
+
+@dataclass
+class MigrationStats:
+    migrated: int = 0
+    failed: int = 0
+    skipped: int = 0
+    posts: int = 0
+    posts_done: int = 0
+    # Names of the forum posts whose migration failed. Their cursors stay pending for a rerun.
+    posts_failed: list[str] = field(default_factory=list)
+    # Estimated fraction of the history migrated, for the single channel migrations
+    fraction: Optional[float] = None
+
+    @property
+    def handled(self) -> int:
+        return self.migrated + self.failed + self.skipped
+
+def webhook_username(name: str) -> str:
+    '''
+    Discord rejects webhook names containing "discord" or "clyde", or longer than 80 characters
+    '''
+    name = re.sub(r"(?i)discord|clyde", lambda m: m.group(0)[:-1] + "\u200b" + m.group(0)[-1], name).strip()
+    return name[:80] or "Unknown"
+
+async def _download(client: interactions.Client, attachment: interactions.Attachment) -> interactions.File:
+    data: bytes = await client.http.request_cdn(attachment.url, attachment)
+    return interactions.File(io.BytesIO(data), file_name=attachment.filename, description=attachment.description)
+
+async def transform_message(client: interactions.Client, message: interactions.Message, upload_limit: int) -> Optional[RepostPayload]:
+    '''
+    The repost of the message, or None if there is nothing to repost
+    The attachments larger than the upload limit, or failing to download, are linked instead
+    '''
+    if message.type not in MIGRATED_TYPES:
+        return None
+    files: list[interactions.File] = []
+    links: list[str] = []
+    for attachment in message.attachments:
+        if attachment.size > upload_limit:
+            links.append(attachment.url)
+            continue
+        try:
+            files.append(await _download(client, attachment))
+        except Exception:
+            log_pipeline.exception(logger)
+            links.append(attachment.url)
+    content: str = "\n".join([message.content or "", *links]).strip()
+    if message.sticker_items:
+        # Webhooks cannot send stickers
+        content = "\n".join([content, *(f"*Sticker: {_.name}*" for _ in message.sticker_items)]).strip()
+    # Only the embeds sent with the message. The link previews are generated again from the content.
+    embeds: list[interactions.Embed] = [_ for _ in message.embeds if _.type == interactions.EmbedType.RICH]
+    if not content and not embeds and not files:
+        return None
+    return RepostPayload(
+        int(message.id),
+        content[:MESSAGE_LENGTH_MAX] or None,
+        embeds,
+        files,
+        webhook_username(message.author.display_name),
+        message.author.display_avatar.url
+    )
+
+async def _repost(webhook: interactions.Webhook, payload: RepostPayload, *, thread: Optional[int] = None, thread_name: Optional[str] = None) -> interactions.Message:
+    # The sends into different posts of a forum do not wait for each other
+    return await request_scheduler.run("execute_webhook", thread or webhook.id, lambda: webhook.send(
+        payload.content,
+        embeds=payload.embeds or None,
+        files=payload.files or None,
+        username=payload.username,
+        avatar_url=payload.avatar_url,
+        allowed_mentions=interactions.AllowedMentions.none(),
+        wait=True,
+        thread=thread,
+        thread_name=thread_name
+    ))
+
+async def migrate_history(
+    client: interactions.Client,
+    origin: interactions.MessageableMixin,
+    webhook: interactions.Webhook,
+    cur: ChannelCursor,
+    stats: MigrationStats,
+    *,
+    upload_limit: int,
+    thread_name: Optional[str] = None,
+    on_checkpoint: Optional[Callable[[ChannelCursor], Awaitable[None]]] = None
+) -> None:
+    '''
+    Repost the history of the origin after the cursor through the webhook, from the oldest message
+    With `thread_name`, the first repost creates a post in the forum of the webhook and `cur.target` keeps its ID
+    Stage 1 reads the history into the bounded buffer, stage 2 downloads and transforms the buffered messages
+    concurrently, and stage 3 reposts them in order.
+    '''
+    buffer: asyncio.Queue = asyncio.Queue(PREFETCH_BUFFER)
+    downloads: asyncio.Semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    newest: Optional[int] = int(origin.last_message_id) if getattr(origin, "last_message_id", None) else None
+
+    async def __transform(message: interactions.Message) -> tuple[int, Optional[RepostPayload]]:
+        async with downloads:
+            return int(message.id), await transform_message(client, message, upload_limit)
+
+    async def __prefetch() -> None:
+        # Every message is newer than its channel, and the starter message of a post has the ID of the post
+        after: int = cur.cursor or int(origin.id) - 1
+        try:
+            while True:
+                # Paced by the scheduler with the history reads of the other jobs
+                messages: list[interactions.Message] = sorted(
+                    await request_scheduler.run("get_messages", origin.id, lambda: origin.fetch_messages(limit=HISTORY_PAGE_SIZE, after=after)),
+                    key=lambda _: int(_.id)
+                )
+                for message in messages:
+                    await buffer.put(asyncio.create_task(__transform(message)))
+                if len(messages) < HISTORY_PAGE_SIZE:
+                    break
+                after = int(messages[-1].id)
+        except Exception as e:
+            # The reposter raises it after the messages read before the error
+            await buffer.put(e)
+        else:
+            await buffer.put(None)
+
+    prefetcher: asyncio.Task = asyncio.create_task(__prefetch())
+    try:
+        while True:
+            item: Union[asyncio.Task, Exception, None] = await buffer.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            message_id, payload = await item
+            if payload is None:
+                stats.skipped += 1
+            else:
+                try:
+                    if thread_name is not None and cur.target is None:
+                        sent: interactions.Message = await _repost(webhook, payload, thread_name=thread_name)
+                        cur.target = int(sent._channel_id)
+                    else:
+                        await _repost(webhook, payload, thread=cur.target)
+                    stats.migrated += 1
+                    metrics.inc("utility_messages_migrated_total")
+                except interactions.errors.HTTPException:
+                    stats.failed += 1
+                    metrics.inc("utility_messages_failed_total", kind="migrate")
+                    log_pipeline.exception(logger)
+            cur.cursor = message_id
+            cur.scanned += 1
+            if newest is not None:
+                stats.fraction = 1 - history_fraction(origin.id, newest, message_id)
+            if on_checkpoint is not None and cur.scanned % MIGRATE_CHECKPOINT_EVERY == 0:
+                await on_checkpoint(cur)
+        cur.status = STATUS_DONE
+        if on_checkpoint is not None:
+            await on_checkpoint(cur)
+    finally:
+        prefetcher.cancel()
+        while not buffer.empty():
+            item = buffer.get_nowait()
+            if isinstance(item, asyncio.Task):
+                item.cancel()
+
+async def collect_posts(client: interactions.Client, forum: interactions.GuildForum) -> list[interactions.GuildForumPost]:
+    '''
+    The active and archived posts of the forum, oldest first
+    '''
+    return await thread_directory.threads(client, forum)
+
+async def migrate_channel(
+    client: interactions.Client,
+    origin: interactions.GuildChannel,
+    destination: Union[interactions.GuildText, interactions.GuildForum],
+    journal: JobJournal,
+    job_key: str,
+    *,
+    progress: Optional[ProgressReporter] = None,
+    post_concurrency: int = POST_CONCURRENCY
+) -> MigrationStats:
+    '''
+    Migrate a text channel or a thread into a text channel, a forum post into a forum, or all posts of a forum
+    into a forum. The posts of a forum are migrated concurrently.
+    The cursors of the job are read from and saved to the journal, so an interrupted migration resumes.
+    A failed forum post is listed in `posts_failed` and the other posts go on, so the job is only finished
+    by the caller when the list is empty.
+    '''
+    stats: MigrationStats = MigrationStats()
+    upload_limit: int = destination.guild.filesize_limit
+    webhook: interactions.Webhook = await destination.create_webhook(WEBHOOK_NAME)
+
+    def __report() -> None:
+        if progress is None:
+            return
+        if stats.posts:
+            progress.update(stats.handled, fraction=stats.posts_done / stats.posts,
+                posts=f"{stats.posts_done}/{stats.posts}", migrated=stats.migrated, failed=stats.failed)
+        else:
+            progress.update(stats.handled, fraction=stats.fraction,
+                migrated=stats.migrated, failed=stats.failed)
+
+    async def __checkpoint(cur: ChannelCursor) -> None:
+        await journal.save_cursor(job_key, cur)
+        __report()
+
+    async def __migrate_one(channel: interactions.MessageableMixin, thread_name: Optional[str]) -> None:
+        cur: ChannelCursor = await journal.get_cursor(job_key, channel.id)
+        if cur.status != STATUS_DONE:
+            await migrate_history(
+                client, channel, webhook, cur, stats,
+                upload_limit=upload_limit, thread_name=thread_name, on_checkpoint=__checkpoint
+            )
+        stats.posts_done += 1
+        __report()
+
+    try:
+        if isinstance(origin, interactions.GuildForum):
+            posts: list[interactions.GuildForumPost] = await collect_posts(client, origin)
+            stats.posts = len(posts)
+            semaphore: asyncio.Semaphore = asyncio.Semaphore(max(post_concurrency, 1))
+            async def __migrate_post(post: interactions.GuildForumPost) -> None:
+                async with semaphore:
+                    try:
+                        await __migrate_one(post, post.name)
+                    except Exception:
+                        # One broken post does not stop the others
+                        log_pipeline.exception(logger)
+                        stats.posts_failed.append(post.name)
+            await asyncio.gather(*(__migrate_post(_) for _ in posts))
+        elif isinstance(destination, interactions.GuildForum):
+            await __migrate_one(origin, origin.name)
+        else:
+            await __migrate_one(origin, None)
+    finally:
+        try:
+            await webhook.delete()
+        except Exception:
+            logger.error(traceback.format_exc())
+    return stats
@@ -0,0 +1,88 @@
+'''
+Permission index for the privileged and operator checks. The settings are
+kept in sets and the decisions are cached per member, so a check is an
+in-memory lookup.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+from typing import Optional
+
+from .guildsettings import GuildSettings
+
+_EMPTY: tuple[frozenset[int], ...] = (frozenset(),) * 4
+
+class PermissionIndex:
+    '''
+    The settings of each guild are kept in sets, and the decisions are cached per guild and member
+    '''
+    def __init__(self) -> None:
+        # guild_id -> (elevation_roles, elevation_members, operator_roles, operator_users)
+        self._guilds: dict[int, tuple[frozenset[int], frozenset[int], frozenset[int], frozenset[int]]] = {}
+        self.owner_ids: Optional[frozenset[int]] = None
+        # guild_id -> member_id -> (privileged, operator)
+        self._decisions: dict[int, dict[int, tuple[bool, bool]]] = {}
+
+    def set_guild(self, settings: GuildSettings) -> None:
+        self._guilds[int(settings.guild_id)] = (
+            frozenset(settings.elevation_roles),
+            frozenset(settings.elevation_members),
+            frozenset(settings.operator_roles),
+            frozenset(settings.operator_users)
+        )
+        self._decisions.pop(int(settings.guild_id), None)
+
+    def invalidate_member(self, guild_id: int, member_id: int) -> None:
+        self._decisions.get(int(guild_id), {}).pop(int(member_id), None)
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        self._decisions.pop(int(guild_id), None)
+
+    def _owners(self, bot: interactions.Client) -> frozenset[int]:
+        if self.owner_ids is None:
+            owners: frozenset[int] = frozenset(int(_) for _ in bot.owner_ids)
+            # The owners are only known after the application info is fetched. Do not cache an empty set.
+            if not owners:
+                return owners
+            self.owner_ids = owners
+        return self.owner_ids
+
+    def _decide(self, ctx: interactions.BaseContext) -> tuple[bool, bool]:
+        guild_id: int = int(ctx.guild_id or 0)
+        author_id: int = int(ctx.author.id)
+        decisions: dict[int, tuple[bool, bool]] = self._decisions.setdefault(guild_id, {})
+        decision: Optional[tuple[bool, bool]] = decisions.get(author_id)
+        if decision is not None:
+            return decision
+        elevation_roles, elevation_members, operator_roles, operator_users = self._guilds.get(guild_id, _EMPTY)
+        role_ids: frozenset[int] = frozenset(int(_) for _ in getattr(ctx.author, "_role_ids", ()))
+        privileged: bool = (
+            author_id in self._owners(ctx.bot)
+            or author_id in elevation_members
+            or not elevation_roles.isdisjoint(role_ids)
+        )
+        operator: bool = privileged or author_id in operator_users or not operator_roles.isdisjoint(role_ids)
+        decision = (privileged, operator)
+        # Do not cache before the owners and the guild settings are known
+        if self.owner_ids is not None and guild_id in self._guilds:
+            decisions[author_id] = decision
+        return decision
+
+    def is_privileged(self, ctx: interactions.BaseContext) -> bool:
+        return self._decide(ctx)[0]
+
+    def is_operator(self, ctx: interactions.BaseContext) -> bool:
+        return self._decide(ctx)[1]
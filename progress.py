@@ -0,0 +1,181 @@
+'''
+Live progress of the long running jobs. One status message is kept updated
+with the counters, the rate and the ETA of the job.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import os
+import time
+import traceback
+from typing import Any, Optional, Union
+from src import logutil
+
+from .logqueue import log_pipeline
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+# At most 4 edits per minute for each job
+PROGRESS_INTERVAL: float = 15.0
+# Weight of the latest interval in the smoothed rate
+RATE_SMOOTHING: float = 0.3
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+def history_fraction(channel_id: int, newest_id: int, current_id: int) -> float:
+    '''
+    Estimated fraction of a history scan from the newest message down to the creation of the channel
+    '''
+    # The timestamp in milliseconds is in the upper bits of a snowflake
+    start: int = int(newest_id) >> 22
+    span: int = start - (int(channel_id) >> 22)
+    if span <= 0:
+        return 1
+    return min(max((start - (int(current_id) >> 22)) / span, 0), 1)
+
+class ProgressReporter:
+    '''
+    `update()` only records the progress. While the reporter is entered, the status message is
+    edited in the background at most once per `interval` with the latest progress, so the
+    updates are coalesced and never wait for the API.
+    '''
+    def __init__(self, message: interactions.Message, title: str, *, unit: str = "messages", total: Optional[int] = None, interval: float = PROGRESS_INTERVAL) -> None:
+        self.message: interactions.Message = message
+        self.title: str = title
+        self.unit: str = unit
+        self.total: Optional[int] = total
+        self.interval: float = interval
+        self.done: int = 0
+        self.fraction: Optional[float] = None
+        self.counts: dict[str, Any] = {}
+        self.started: float = time.monotonic()
+        self.rate: Optional[float] = None
+        # The first update is the baseline of the rate, so a resumed job does not start with a spike
+        self._first_sample: Optional[tuple[float, int]] = None
+        self._last_sample: Optional[tuple[float, int]] = None
+        self._last_content: str = message.content if message is not None else ""
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def send(cls, target: Union[interactions.BaseContext, interactions.MessageableMixin], title: str, **kwargs) -> "ProgressReporter":
+        '''
+        Send the status message to the context or channel and create its reporter
+        '''
+        message: interactions.Message = await target.send(title)
+        return cls(message, title, **kwargs)
+
+    def update(self, done: Optional[int] = None, *, total: Optional[int] = None, fraction: Optional[float] = None, **counts) -> None:
+        '''
+        `done` is the count of units processed, used for the rate
+        `fraction` estimates the progress when the total is unknown
+        The other keyword arguments are shown as counters
+        '''
+        if done is not None:
+            self.done = done
+            if self._first_sample is None:
+                self._first_sample = self._last_sample = (time.monotonic(), done)
+        if total is not None:
+            self.total = total
+        if fraction is not None:
+            self.fraction = fraction
+        self.counts.update(counts)
+
+    def _sample_rate(self, now: float) -> None:
+        if self._last_sample is None:
+            return
+        last_time, last_done = self._last_sample
+        if now - last_time <= 0:
+            return
+        rate: float = (self.done - last_done) / (now - last_time)
+        self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self._last_sample = (now, self.done)
+
+    def _eta(self, elapsed: float) -> Optional[float]:
+        if self.total is not None:
+            if self.rate:
+                return max(self.total - self.done, 0) / self.rate
+            return None
+        if self.fraction:
+            return elapsed * (1 - self.fraction) / self.fraction
+        return None
+
+    def render(self, status: Optional[str] = None) -> str:
+        now: float = time.monotonic()
+        elapsed: float = now - self.started
+        lines: list[str] = [f"**{self.title}**"]
+        if self.counts:
+            lines.append(" · ".join(f"{k.replace('_', ' ').capitalize()}: {v}" for k, v in self.counts.items()))
+        if self.total:
+            lines.append(f"Progress: {self.done}/{self.total} {self.unit} ({self.done * 100 // self.total}%)")
+        elif self.fraction is not None:
+            lines.append(f"Progress: about {int(self.fraction * 100)}%")
+        timing: list[str] = [f"Elapsed: {format_duration(elapsed)}"]
+        if status is None:
+            if self.rate is not None:
+                timing.insert(0, f"Rate: {self.rate:.1f} {self.unit}/s")
+            eta: Optional[float] = self._eta(elapsed)
+            if eta is not None:
+                timing.append(f"ETA: {format_duration(eta)}")
+        elif self._first_sample is not None:
+            first_time, first_done = self._first_sample
+            timing.insert(0, f"Average rate: {(self.done - first_done) / max(now - first_time, 1e-9):.1f} {self.unit}/s")
+        lines.append(" · ".join(timing))
+        if status is not None:
+            lines.append(status)
+        return "\n".join(lines)
+
+    async def _edit(self, content: str) -> None:
+        if content == self._last_content:
+            return
+        try:
+            await self.message.edit(content=content)
+            self._last_content = content
+        except Exception:
+            # The progress must never stop the job
+            logger.error(traceback.format_exc())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self._sample_rate(time.monotonic())
+            await self._edit(self.render())
+
+    async def __aenter__(self) -> "ProgressReporter":
+        self.started = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if exc_type is asyncio.CancelledError:
+            await self._edit(self.render("The job was cancelled."))
+        elif exc_type is not None:
+            await self._edit(self.render("The job stopped because of an error."))
+
+    async def finish(self, status: str = "Done!") -> None:
+        '''
+        Show the final counters with the status
+        '''
+        await self._edit(self.render(status))
@@ -0,0 +1,159 @@
+'''
+Reaction removal engine. It finds out whether a user reacted to a message
+without fetching the complete reactor lists.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import os
+from typing import Optional
+from src import logutil
+
+from .history import MessageMeta
+from .journal import JobJournal
+from .logqueue import log_pipeline
+from .scheduler import request_scheduler
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+REACTOR_PAGE_SIZE: int = 100
+# Deferred removals done between the updates of the journal. A resumed pass repeats at most this many.
+REACTION_CHECKPOINT_EVERY: int = 100
+
+class ReactionCleaner:
+    '''
+    Remove the reactions of one user from messages
+    With `deferred` set, the messages are only recorded and the removal runs in `run_deferred()`
+    With a `journal`, the recorded reactions are saved under `job_key` by `save_pending()`, so the deferred pass
+    of a resumed job still covers the messages scanned before the interruption
+    '''
+    def __init__(
+        self,
+        client: interactions.Client,
+        user_id: int,
+        *,
+        deferred: bool = False,
+        journal: Optional[JobJournal] = None,
+        job_key: Optional[str] = None
+    ) -> None:
+        self.client: interactions.Client = client
+        self.user_id: int = int(user_id)
+        self.deferred: bool = deferred
+        self.journal: Optional[JobJournal] = journal
+        self.job_key: Optional[str] = job_key
+        # channel_id -> (message_id, emoji) already handled in the scan of the channel
+        self.checked: dict[int, set[tuple[int, str]]] = {}
+        # (channel_id, message_id, emoji) of the reactions left for the deferred pass, not saved in the journal yet
+        self.pending: list[tuple[int, int, str]] = []
+        self.count_removed: int = 0
+        self.count_failed: int = 0
+
+    def _impossible(self, count: int, me: bool) -> bool:
+        if count <= 0:
+            return True
+        # The only reactor is the bot itself
+        return count == 1 and me and self.user_id != int(self.client.user.id)
+
+    async def user_reacted(self, channel_id: int, message_id: int, emoji: str) -> bool:
+        '''
+        The reactors are sorted by user ID, so paging from right before the user ID
+        finds the user on the first page if the user reacted at all.
+        '''
+        after: int = self.user_id - 1
+        while True:
+            users: list[dict] = await request_scheduler.run("get_reactions", channel_id, lambda: self.client.http.get_reactions(
+                channel_id, message_id, emoji, limit=REACTOR_PAGE_SIZE, after=after
+            ))
+            if not users:
+                return False
+            for usr in users:
+                uid: int = int(usr["id"])
+                if uid == self.user_id:
+                    return True
+                if uid > self.user_id:
+                    return False
+            if len(users) < REACTOR_PAGE_SIZE:
+                return False
+            after = int(users[-1]["id"])
+
+    async def _remove(self, channel_id: int, message_id: int, emoji: str) -> None:
+        try:
+            if await self.user_reacted(channel_id, message_id, emoji):
+                await request_scheduler.run("remove_reaction", channel_id, lambda: self.client.http.remove_user_reaction(
+                    channel_id, message_id, emoji, self.user_id
+                ))
+                self.count_removed += 1
+        except Exception:
+            self.count_failed += 1
+            raise
+
+    async def clean(self, msg: MessageMeta, *, immediate: bool = False) -> None:
+        '''
+        Remove the user's reactions from the message, or record them for the deferred pass
+        `immediate` skips the deferred pass, e.g. for threads that will be archived again
+        '''
+        channel_id: int = msg.channel_id
+        message_id: int = msg.id
+        checked: set[tuple[int, str]] = self.checked.setdefault(channel_id, set())
+        for emoji, count, me in msg.reactions:
+            if (message_id, emoji) in checked or self._impossible(count, me):
+                continue
+            checked.add((message_id, emoji))
+            if self.deferred and not immediate:
+                self.pending.append((channel_id, message_id, emoji))
+            else:
+                await self._remove(channel_id, message_id, emoji)
+
+    def forget_channel(self, channel_id: int) -> None:
+        '''
+        Drop the handled reactions of a channel whose scan ended
+        '''
+        self.checked.pop(int(channel_id), None)
+
+    async def save_pending(self) -> None:
+        '''
+        Save the recorded reactions in the journal. Called before the cursors move past their messages.
+        '''
+        if self.journal is None or not self.pending:
+            return
+        pending: list[tuple[int, int, str]] = self.pending
+        self.pending = []
+        await self.journal.add_reactions(self.job_key, pending)
+
+    async def run_deferred(self) -> None:
+        '''
+        Remove the reactions recorded by `clean()`, including those saved in the journal by an interrupted run
+        '''
+        if self.journal is None:
+            while self.pending:
+                channel_id, message_id, emoji = self.pending.pop()
+                try:
+                    await self._remove(channel_id, message_id, emoji)
+                except Exception:
+                    log_pipeline.exception(logger)
+            return
+        await self.save_pending()
+        done: list[tuple[int, int, str]] = []
+        for channel_id, message_id, emoji in await self.journal.list_reactions(self.job_key):
+            try:
+                await self._remove(channel_id, message_id, emoji)
+            except Exception:
+                log_pipeline.exception(logger)
+            done.append((channel_id, message_id, emoji))
+            if len(done) >= REACTION_CHECKPOINT_EVERY:
+                await self.journal.remove_reactions(self.job_key, done)
+                done = []
+        await self.journal.remove_reactions(self.job_key, done)
@@ -0,0 +1,136 @@
+'''
+Bulk role engine. The final role set of each member is computed locally and
+applied with one member edit, for many members at once.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, Optional
+from src import logutil
+
+from .logqueue import log_pipeline
+from .metrics import metrics
+from .scheduler import request_scheduler
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+ROLE_EDIT_CONCURRENCY: int = 10
+
+ROLE_ADD: str = "add"
+ROLE_REMOVE: str = "remove"
+ROLE_REMOVE_ALL: str = "remove_all"
+
+@dataclass
+class RoleEditStats:
+    members: int = 0
+    edited: int = 0
+    unchanged: int = 0
+    failed: int = 0
+    roles_added: int = 0
+    roles_removed: int = 0
+
+    @property
+    def handled(self) -> int:
+        return self.edited + self.unchanged + self.failed
+
+def locked_roles(guild: interactions.Guild) -> frozenset[int]:
+    '''
+    The roles the bot cannot add or remove: the managed roles and the roles not below its top role
+    '''
+    return frozenset(int(_.id) for _ in guild.roles if not _.default and not _.is_assignable)
+
+def final_roles(
+    current: frozenset[int], *, add: frozenset[int] = frozenset(), remove: frozenset[int] = frozenset(), remove_all: bool = False, locked: frozenset[int] = frozenset()
+) -> frozenset[int]:
+    '''
+    The role set of the member after the edit. The locked roles stay as they are.
+    '''
+    removed: frozenset[int] = current if remove_all else current & remove
+    return (current - (removed - locked)) | (add - locked)
+
+async def apply_role_edits(
+    client: interactions.Client,
+    guild: interactions.Guild,
+    members: Iterable[interactions.Member],
+    *,
+    add: Iterable[int] = (),
+    remove: Iterable[int] = (),
+    remove_all: bool = False,
+    reason: Optional[str] = None,
+    dry_run: bool = False,
+    concurrency: int = ROLE_EDIT_CONCURRENCY,
+    on_progress: Optional[Callable[[RoleEditStats], Awaitable[None]]] = None
+) -> RoleEditStats:
+    '''
+    Replace the roles of each member with its final role set in one request, skipping the members whose roles
+    do not change. When only one role changes, it is added or removed on its own, so the concurrent changes of
+    the other roles are kept. With `dry_run`, only the counts are computed.
+    `on_progress` is called with the counts after each member
+    '''
+    members = list(members)
+    stats: RoleEditStats = RoleEditStats(members=len(members))
+    locked: frozenset[int] = locked_roles(guild)
+    add_set: frozenset[int] = frozenset(int(_) for _ in add)
+    remove_set: frozenset[int] = frozenset(int(_) for _ in remove)
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def __edit_one(member: interactions.Member) -> None:
+        current: frozenset[int] = frozenset(int(_) for _ in member._role_ids)
+        roles: frozenset[int] = final_roles(current, add=add_set, remove=remove_set, remove_all=remove_all, locked=locked)
+        if roles == current:
+            stats.unchanged += 1
+        elif dry_run:
+            stats.edited += 1
+            stats.roles_added += len(roles - current)
+            stats.roles_removed += len(current - roles)
+        else:
+            changed: frozenset[int] = roles ^ current
+            async with semaphore:
+                try:
+                    # The member event follows, but the next run reads the cache before it
+                    if not remove_all and len(changed) == 1:
+                        role_id: int = next(iter(changed))
+                        if role_id in roles:
+                            await request_scheduler.run("member_role", guild.id, lambda: client.http.add_guild_member_role(
+                                guild.id, member.id, role_id, reason=reason
+                            ))
+                            member._role_ids.append(role_id)
+                        else:
+                            await request_scheduler.run("member_role", guild.id, lambda: client.http.remove_guild_member_role(
+                                guild.id, member.id, role_id, reason=reason
+                            ))
+                            member._role_ids = [_ for _ in member._role_ids if int(_) != role_id]
+                    else:
+                        data: dict = await request_scheduler.run("modify_member", guild.id, lambda: client.http.modify_guild_member(
+                            guild.id, member.id, roles=[str(_) for _ in roles], reason=reason
+                        ))
+                        client.cache.place_member_data(guild.id, data)
+                    stats.edited += 1
+                    stats.roles_added += len(roles - current)
+                    stats.roles_removed += len(current - roles)
+                    metrics.inc("utility_member_role_edits_total", status="edited")
+                except Exception:
+                    stats.failed += 1
+                    metrics.inc("utility_member_role_edits_total", status="failed")
+                    log_pipeline.exception(logger)
+        if on_progress is not None:
+            await on_progress(stats)
+
+    await asyncio.gather(*(__edit_one(_) for _ in members))
+    return stats
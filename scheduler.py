@@ -0,0 +1,199 @@
+'''
+Shared request scheduler for the bulk operations of this extension. Requests
+are paced by per-route token buckets and a global bucket, ordered by priority,
+and shared fairly between guilds and jobs.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import asyncio
+import contextlib
+import contextvars
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Iterator, Optional
+
+from .metrics import metrics
+
+PRIORITY_NORMAL: int = 1
+PRIORITY_BACKGROUND: int = 2
+
+# Discord allows 50 requests per second globally. The replies of the commands do not go through
+# the scheduler, so keep some headroom for them.
+GLOBAL_RATE: tuple[int, float] = (40, 1.0)
+# (requests, per seconds) of each route, per major parameter (usually the channel)
+ROUTE_RATES: dict[str, tuple[int, float]] = {
+    "delete_message": (5, 1.0),
+    "bulk_delete": (1, 1.0),
+    "get_messages": (5, 1.0),
+    "get_reactions": (4, 1.0),
+    "remove_reaction": (4, 1.0),
+    "modify_channel": (5, 5.0),
+    "list_threads": (5, 1.0),
+    # The bulk role edits keep these routes saturated for a long time. A little slower than the limit, so the
+    # jitter of the requests does not turn into a 429 on each of them.
+    "modify_member": (10, 11.0),
+    "member_role": (10, 11.0),
+    "send_message": (5, 5.0),
+    "execute_webhook": (5, 2.0),
+}
+DEFAULT_ROUTE_RATE: tuple[int, float] = (5, 1.0)
+
+class TokenBucket:
+    def __init__(self, capacity: int, per: float) -> None:
+        self.capacity: int = capacity
+        self.rate: float = capacity / per
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        '''
+        Seconds until a token is available
+        '''
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+# (guild_id, job key, priority) of the job running in the current task
+_current_job: contextvars.ContextVar[tuple[int, str, int]] = contextvars.ContextVar(
+    "current_job", default=(0, "", PRIORITY_NORMAL)
+)
+
+@contextlib.contextmanager
+def job_context(guild_id: Optional[int], job_key: str, priority: int = PRIORITY_NORMAL) -> Iterator[None]:
+    '''
+    The requests made in this context, including in the tasks created in it, belong to the job
+    '''
+    token: contextvars.Token = _current_job.set((int(guild_id or 0), job_key, priority))
+    try:
+        yield
+    finally:
+        _current_job.reset(token)
+
+class RequestScheduler:
+    def __init__(self) -> None:
+        self.global_bucket: TokenBucket = TokenBucket(*GLOBAL_RATE)
+        self.route_buckets: dict[tuple[str, int], TokenBucket] = {}
+        # priority -> guild_id -> job key -> waiting (route, future)
+        self._waiting: dict[int, OrderedDict[int, OrderedDict[str, deque]]] = {}
+        self._wake: asyncio.Event = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _bucket(self, route: str, major: int) -> TokenBucket:
+        bucket: Optional[TokenBucket] = self.route_buckets.get((route, major))
+        if bucket is None:
+            bucket = TokenBucket(*ROUTE_RATES.get(route, DEFAULT_ROUTE_RATE))
+            self.route_buckets[(route, major)] = bucket
+        return bucket
+
+    def _try_grant(self, now: float) -> float:
+        '''
+        Grant at most one waiting request. Returns 0 if granted, otherwise how long to wait
+        '''
+        wait: float = self.global_bucket.delay(now)
+        if wait > 0:
+            return wait
+        wait = math.inf
+        for priority in sorted(self._waiting):
+            guilds: OrderedDict[int, OrderedDict[str, deque]] = self._waiting[priority]
+            # Round robin over the guilds, then over the jobs of the guild
+            for guild_id in list(guilds):
+                jobs: OrderedDict[str, deque] = guilds[guild_id]
+                for job_key in list(jobs):
+                    requests: deque = jobs[job_key]
+                    route, major, fut = requests[0]
+                    if fut.done():
+                        requests.popleft()
+                    else:
+                        bucket: TokenBucket = self._bucket(route, major)
+                        delay: float = bucket.delay(now)
+                        if delay > 0:
+                            wait = min(wait, delay)
+                            continue
+                        bucket.take()
+                        self.global_bucket.take()
+                        requests.popleft()
+                        fut.set_result(None)
+                    if requests:
+                        jobs.move_to_end(job_key)
+                    else:
+                        del jobs[job_key]
+                    if jobs:
+                        guilds.move_to_end(guild_id)
+                    else:
+                        del guilds[guild_id]
+                    if not guilds:
+                        del self._waiting[priority]
+                    return 0
+        return wait
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wake.clear()
+            wait: float = self._try_grant(time.monotonic())
+            if wait == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), None if wait == math.inf else wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self, route: str, major: int = 0) -> None:
+        '''
+        Wait until the request on the route may be sent
+        `major` is the major parameter of the route, usually the channel ID
+        '''
+        guild_id, job_key, priority = _current_job.get()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        (self._waiting.setdefault(priority, OrderedDict())
+            .setdefault(guild_id, OrderedDict())
+            .setdefault(job_key, deque())
+            .append((route, int(major), fut)))
+        self._wake.set()
+        start: float = time.monotonic()
+        await fut
+        metrics.observe("utility_ratelimit_wait_seconds", time.monotonic() - start, route=route)
+
+    async def run(self, route: str, major: int, request: Callable[[], Awaitable[Any]]) -> Any:
+        '''
+        Send the request when the route allows it, and record its latency and result
+        '''
+        await self.acquire(route, major)
+        start: float = time.monotonic()
+        status: str = "ok"
+        try:
+            return await request()
+        except Exception as e:
+            status = str(getattr(e, "status", "error"))
+            raise
+        finally:
+            metrics.observe("utility_api_seconds", time.monotonic() - start, route=route)
+            metrics.inc("utility_api_requests_total", route=route, status=status)
+
+    def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+request_scheduler: RequestScheduler = RequestScheduler()
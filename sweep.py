@@ -0,0 +1,224 @@
+'''
+Guild sweep of `delete_all_ur_msg`. The channels and threads of a guild are
+swept concurrently, deleting the messages of a user and cleaning its reactions.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import os
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Optional, cast
+from src import logutil
+
+from .deletion import CHECKPOINT_EVERY
+from .history import HISTORY_SHARDS, MessageMeta, ShardedHistory
+from .journal import STATUS_DONE, ChannelCursor, JobJournal
+from .logqueue import log_pipeline
+from .messageindex import MessageIndex
+from .metrics import metrics
+from .reactions import ReactionCleaner
+from .scheduler import request_scheduler
+from .threads import thread_directory
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+# How many channels and threads are swept at the same time
+GUILD_SWEEP_CONCURRENCY: int = 8
+
+@dataclass
+class SweepStats:
+    scanned: int = 0
+    deleted: int = 0
+    # Channels and threads swept, and found so far
+    channels: int = 0
+    found: int = 0
+    # Channels and threads whose history could not be read completely. They resume when the sweep runs again.
+    incomplete: int = 0
+
+async def sweep_guild(
+    client: interactions.Client,
+    guild_id: int,
+    channels: list[interactions.GuildChannel],
+    user_id: int,
+    journal: JobJournal,
+    job_key: str,
+    *,
+    reaction_cleaner: ReactionCleaner,
+    index: Optional[MessageIndex] = None,
+    concurrency: int = GUILD_SWEEP_CONCURRENCY,
+    shards: int = HISTORY_SHARDS,
+    on_progress: Optional[Callable[[SweepStats], None]] = None
+) -> SweepStats:
+    '''
+    Delete the messages of the user, and of the commands it ran, in the channels and all their threads and posts
+    Each message is deleted on its own, and the reactions of the user on the other messages are given to the
+    `reaction_cleaner`, whose deferred pass is left to the caller. Its recorded reactions are saved with the cursors. The progress of each channel is recorded in its
+    journal cursor so that the sweep can resume. A complete scan from the newest message syncs the channel in the `index`.
+    `on_progress` is called with the counters
+    '''
+    stats: SweepStats = SweepStats()
+    def __report() -> None:
+        if on_progress is not None:
+            on_progress(stats)
+    async def __delete_reactions_from_message(msg: MessageMeta, immediate: bool) -> None:
+        try:
+            await reaction_cleaner.clean(msg, immediate=immediate)
+        except Exception:
+            log_pipeline.exception(logger)
+    async def __save_cursor(cur: ChannelCursor) -> None:
+        # The deferred reactions of the scanned messages are saved first, so a resumed sweep does not lose them
+        await reaction_cleaner.save_pending()
+        await journal.save_cursor(job_key, cur)
+    def __is_delete(msg: Optional[MessageMeta]) -> bool:
+        return msg is not None and (msg.author_id == user_id or msg.interaction_user_id == user_id)
+    async def __delete_all_msgs_in_messagable(channel: interactions.MessageableMixin, cur: ChannelCursor) -> None:
+        """
+        Delete all messages in MessagableMixin. Skip extra exceptions of single messages.
+        The errors of the channel itself end the scan with the cursor pending.
+        The progress is recorded in the cursor so that the job can resume.
+        """
+        archived: bool = False
+        archived_operated: bool = False
+        skip_this_loop: bool = False
+        msg: Optional[MessageMeta] = None
+        if isinstance(channel, interactions.ThreadChannel):
+            channel: interactions.ThreadChannel = cast(interactions.ThreadChannel, channel)
+            archived = channel.archived
+        synced_until: Optional[int] = index.track(channel.id) if index is not None and cur.cursor is None else None
+        # The raw payloads do not go through the message cache
+        history: ShardedHistory = ShardedHistory(channel, before=cur.cursor, shards=shards, raw=True)
+        try:
+            while True:
+                if not skip_this_loop:
+                    if msg is not None:
+                        cur.cursor = history.watermark
+                        cur.scanned += 1
+                        stats.scanned += 1
+                        __report()
+                        metrics.inc("utility_messages_scanned_total", kind="delete_all_ur_msg")
+                        if cur.scanned % CHECKPOINT_EVERY == 0:
+                            await __save_cursor(cur)
+                    # The errors of the history end the scan of the channel before it is complete, so the
+                    # time range of a failed shard is not skipped. A rerun resumes at the cursor.
+                    try:
+                        msg = await history.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    if index is not None:
+                        index.record(guild_id, msg)
+                if __is_delete(msg) and archived and not archived_operated:
+                    # Without unarchiving, nothing can be deleted in the thread. The error ends the scan and the
+                    # thread stays pending for a rerun.
+                    await channel.edit(archived=False)
+                    archived_operated = True
+                try:
+                    skip_this_loop = False
+                    if __is_delete(msg):
+                        await request_scheduler.run("delete_message", channel.id, lambda: client.http.delete_message(channel.id, msg.id))
+                        cur.deleted += 1
+                        stats.deleted += 1
+                        __report()
+                        metrics.inc("utility_messages_deleted_total", kind="delete_all_ur_msg")
+                    else:
+                        await __delete_reactions_from_message(msg, archived)
+                except interactions.errors.HTTPException as e:
+                    match int(e.code):
+                        case 50083:
+                            """Operation in archived thread"""
+                            skip_this_loop = True
+                            archived = True
+                            await channel.edit(archived=False)
+                            archived_operated = True
+                        case 10008:
+                            """Unknown message, already deleted"""
+                            pass
+                        case 10003 | 50001 | 50013:
+                            """Unknown channel, no access or lack permission"""
+                            # The scan ends with the cursor pending, so the channel is counted as incomplete and
+                            # resumes when the sweep runs again
+                            raise
+                        case 50021:
+                            """Cannot execute on system message"""
+                            pass
+                        case 160005:
+                            """Thread is locked"""
+                            pass
+                        case _:
+                            """Default"""
+                            pass
+                except Exception:
+                    log_pipeline.exception(logger)
+        finally:
+            # The shards still running stop with the scan of the channel
+            history.close()
+            reaction_cleaner.forget_channel(channel.id)
+            if index is not None and not history.complete:
+                index.untrack(channel.id)
+            if archived:
+                try:
+                    await channel.edit(archived=True)
+                except Exception:
+                    log_pipeline.exception(logger)
+        # Only a history read completely syncs the channel, or the lookups would miss the messages of a failed shard
+        if synced_until is not None and history.complete:
+            await index.mark_synced(channel.id, guild_id, synced_until)
+    async def __sweep_messagable(channel: Optional[interactions.MessageableMixin]) -> None:
+        if channel is None:
+            logger.error("Channel is None")
+            return
+        cur: ChannelCursor = await journal.get_cursor(job_key, channel.id)
+        if cur.status == STATUS_DONE:
+            return
+        try:
+            await __delete_all_msgs_in_messagable(channel, cur)
+            cur.status = STATUS_DONE
+        finally:
+            await __save_cursor(cur)
+            stats.channels += 1
+            __report()
+    # Channels and threads are swept concurrently. The request scheduler paces the requests under the
+    # per-route and global rate limits, so the semaphore only bounds how many run at once.
+    sweep_semaphore: asyncio.Semaphore = asyncio.Semaphore(max(concurrency, 1))
+    sweep_tasks: list[asyncio.Task] = []
+    async def __sweep_bounded(channel: Optional[interactions.MessageableMixin]) -> None:
+        stats.found += 1
+        __report()
+        async with sweep_semaphore:
+            await __sweep_messagable(channel)
+    async def __sweep_channel(ch: interactions.GuildChannel) -> None:
+        if isinstance(ch, interactions.MessageableMixin):
+            sweep_tasks.append(asyncio.create_task(__sweep_bounded(cast(interactions.MessageableMixin, ch))))
+        if isinstance(ch, (interactions.GuildText, interactions.GuildForum)):
+            # All active and archived threads or posts, built from the cached listings
+            for thread in await thread_directory.threads(client, ch):
+                sweep_tasks.append(asyncio.create_task(__sweep_bounded(thread)))
+    sweep_tasks.extend(asyncio.create_task(__sweep_channel(ch)) for ch in channels)
+    try:
+        # Channel tasks keep adding thread tasks while they run
+        while sweep_tasks:
+            pending: list[asyncio.Task] = sweep_tasks[:]
+            sweep_tasks.clear()
+            for res in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(res, Exception):
+                    stats.incomplete += 1
+                    logger.error("".join(traceback.format_exception(res)))
+    except asyncio.CancelledError:
+        for _ in sweep_tasks:
+            _.cancel()
+        raise
+    return stats
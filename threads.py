@@ -0,0 +1,184 @@
+'''
+Thread listing helpers. They page through all the archived threads instead of
+reading only the first page, and cache the threads of each channel.
+
+Copyright (C) 2024  __retr0.init__
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import interactions
+import asyncio
+import math
+import os
+import time
+from typing import AsyncIterator, Optional
+from src import logutil
+
+from .logqueue import log_pipeline
+from .scheduler import request_scheduler
+
+logger = log_pipeline.install(logutil.init_logger(os.path.basename(__file__)))
+
+ARCHIVED_PAGE_SIZE: int = 100
+# The cached threads are listed again after this many seconds, in case an event was missed
+THREAD_CACHE_TTL: float = 300.0
+
+def archive_snowflake(archive_timestamp: str) -> int:
+    '''
+    The `before` of the next archived threads page. The HTTP client takes a snowflake and sends its time.
+    The time is rounded up to the millisecond of the snowflake, so the threads archived in the same millisecond
+    as the last one are listed again instead of skipped.
+    '''
+    timestamp: float = interactions.Timestamp.fromisoformat(archive_timestamp).timestamp()
+    return (math.ceil(timestamp * 1000) - interactions.DISCORD_EPOCH) << 22
+
+async def iter_archived_thread_payloads(client: interactions.Client, channel_id: int, *, private: bool = False) -> AsyncIterator[dict]:
+    '''
+    Yield the payloads of all archived public or private threads in the channel
+    The pages are ordered by the archive timestamp, which is the cursor of the next page
+    '''
+    before: Optional[int] = None
+    seen: set[str] = set()
+    while True:
+        list_threads = client.http.list_private_archived_threads if private else client.http.list_public_archived_threads
+        data: dict = await request_scheduler.run(
+            "list_threads", channel_id, lambda: list_threads(channel_id, limit=ARCHIVED_PAGE_SIZE, before=before)
+        )
+        threads: list[dict] = data.get("threads", [])
+        new_threads: list[dict] = [_ for _ in threads if _["id"] not in seen]
+        for thread in new_threads:
+            seen.add(thread["id"])
+            yield thread
+        if not data.get("has_more") or not new_threads:
+            return
+        before = archive_snowflake(threads[-1]["thread_metadata"]["archive_timestamp"])
+
+async def fetch_active_thread_payloads(client: interactions.Client, guild_id: int, parent_id: Optional[int] = None) -> list[dict]:
+    '''
+    Payloads of the active threads in the guild, optionally only those in the parent channel
+    '''
+    data: dict = await request_scheduler.run("list_threads", guild_id, lambda: client.http.list_active_threads(guild_id))
+    return [_ for _ in data.get("threads", []) if parent_id is None or int(_["parent_id"]) == int(parent_id)]
+
+class ThreadDirectory:
+    '''
+    The active threads of a guild are listed with one request for all its channels. The archived public and
+    private threads of a channel are paged through completely. The payloads are cached until a thread event
+    of the guild or the channel invalidates them, and the thread objects are built from them without fetching
+    each thread.
+    '''
+    def __init__(self, ttl: float = THREAD_CACHE_TTL) -> None:
+        self.ttl: float = ttl
+        # guild_id -> (listed at, active thread payloads)
+        self._active: dict[int, tuple[float, list[dict]]] = {}
+        # parent_id -> (listed at, archived thread payloads)
+        self._archived: dict[int, tuple[float, list[dict]]] = {}
+        # parent_id -> guild_id of the cached archived threads
+        self._parents: dict[int, int] = {}
+        # The listings in progress, shared by the concurrent callers
+        self._loading: dict[tuple[str, int], asyncio.Future] = {}
+        # Bumped by the invalidations, so a listing started before one is not cached
+        self._generation: int = 0
+
+    async def _cached(self, cache: dict[int, tuple[float, list[dict]]], kind: str, key: int, load) -> list[dict]:
+        entry: Optional[tuple[float, list[dict]]] = cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        fut: Optional[asyncio.Future] = self._loading.get((kind, key))
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[(kind, key)] = fut
+        generation: int = self._generation
+        try:
+            payloads: list[dict] = await load()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # Only the waiting callers see the error
+            fut.exception()
+            raise
+        else:
+            if generation == self._generation:
+                cache[key] = (time.monotonic(), payloads)
+            fut.set_result(payloads)
+            return payloads
+        finally:
+            del self._loading[(kind, key)]
+
+    async def _load_archived(self, client: interactions.Client, channel: interactions.GuildChannel) -> list[dict]:
+        payloads: list[dict] = []
+        for private in (False, True):
+            if private and isinstance(channel, interactions.GuildForum):
+                # Forum posts are always public
+                continue
+            try:
+                async for thread in iter_archived_thread_payloads(client, channel.id, private=private):
+                    payloads.append(thread)
+            except interactions.errors.Forbidden:
+                # Listing private archived threads needs the Manage Threads permission
+                logger.error(f"Missing access to the {'private' if private else 'public'} archived threads of {channel.id}")
+        return payloads
+
+    async def thread_payloads(self, client: interactions.Client, channel: interactions.GuildChannel) -> list[dict]:
+        '''
+        Payloads of the active and archived threads (or forum posts) of the channel
+        '''
+        guild_id: int = int(channel._guild_id)
+        active: list[dict] = await self._cached(self._active, "active", guild_id, lambda: fetch_active_thread_payloads(client, guild_id))
+        self._parents[int(channel.id)] = guild_id
+        archived: list[dict] = await self._cached(self._archived, "archived", int(channel.id), lambda: self._load_archived(client, channel))
+        payloads: dict[int, dict] = {int(_["id"]): _ for _ in archived}
+        # The active listing is newer if a thread was unarchived since
+        payloads.update((int(_["id"]), _) for _ in active if int(_["parent_id"]) == int(channel.id))
+        return list(payloads.values())
+
+    async def threads(self, client: interactions.Client, channel: interactions.GuildChannel) -> list[interactions.ThreadChannel]:
+        '''
+        The active and archived threads (or forum posts) of the channel, oldest first
+        '''
+        threads: list[interactions.ThreadChannel] = [
+            # The client fills the payload in while building the channel, so it gets a copy
+            client.cache.place_channel_data({"guild_id": channel._guild_id, **_}) for _ in await self.thread_payloads(client, channel)
+        ]
+        return sorted(threads, key=lambda _: _.id)
+
+    def invalidate_channel(self, parent_id: Optional[int], guild_id: Optional[int] = None) -> None:
+        '''
+        A thread of the channel was created, changed or deleted
+        The active threads of the guild are listed again too
+        '''
+        self._generation += 1
+        if parent_id is not None:
+            self._archived.pop(int(parent_id), None)
+            guild_id = guild_id or self._parents.get(int(parent_id))
+        if guild_id is not None:
+            self._active.pop(int(guild_id), None)
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        self._generation += 1
+        self._active.pop(int(guild_id), None)
+        for parent_id in [k for k, v in self._parents.items() if v == int(guild_id)]:
+            del self._parents[parent_id]
+            self._archived.pop(parent_id, None)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._active.clear()
+        self._archived.clear()
+        self._parents.clear()
+
+thread_directory: ThreadDirectory = ThreadDirectory()